@@ -0,0 +1,211 @@
+"""
+AUTOTUNE.PY - Подбор параметров CPU-инференса под узел
+
+Перебирает размер пакета, torch.set_num_threads и число межоператорных
+потоков на выборке test_emails, меряет пропускную способность и p95 задержки
+пакета и сохраняет лучшую настройку в config/inference_profile.json.
+ZeroShotMailClassifier применяет профиль своего узла при загрузке модели.
+
+Профили хранятся по сигнатуре узла (архитектура, модель CPU, доступные ядра),
+поэтому один файл обслуживает все типы узлов парка: тюнер запускается на
+каждом типе и дописывает свою запись.
+
+Межоператорные потоки torch задаются один раз до первой параллельной работы,
+поэтому каждое их значение меряется в отдельном процессе. Для бэкендов onnx
+потоки - параметр сессии ONNX Runtime, межоператорные не перебираются.
+
+Пример:
+    python autotune.py --sample 200 --batch-sizes 8 16 32 64 --max-p95-ms 250
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from inference_profile import available_cpus, node_signature, save_profile
+
+logger = logging.getLogger(__name__)
+
+
+# ---------- ЗАМЕРЫ ----------
+def _percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(np.asarray(values, dtype=np.float64), q)) if values else 0.0
+
+
+def _measure_grid(interop: Optional[int], threads_list: List[Optional[int]], batch_sizes: List[int],
+                  texts: List[str], repeats: int) -> Dict:
+    """Замеры в отдельном процессе: одно значение межоператорных потоков, все остальные комбинации"""
+    logging.basicConfig(level=logging.WARNING)
+    # Сохранённый профиль не должен влиять на замеры
+    os.environ['INFERENCE_PROFILE_PATH'] = ''
+    os.environ['MODEL_LOAD_MODE'] = 'lazy'
+
+    torch = None
+    try:
+        import torch
+        if interop:
+            torch.set_num_interop_threads(interop)
+    except ImportError:
+        pass
+
+    from core import classifier
+    from inference_backends import create_backend
+
+    classifier.warmup()
+    if not classifier.model_loaded:
+        raise RuntimeError("Модель не загружена - подбор параметров в демо-режиме невозможен")
+
+    rows = []
+    largest = max(batch_sizes)
+    for threads in threads_list:
+        if threads:
+            if classifier.backend == 'torch':
+                if torch is not None:
+                    torch.set_num_threads(threads)
+            else:
+                classifier.model = create_backend(classifier.backend, classifier.model_name,
+                                                  classifier.device, num_threads=threads)
+        classifier._encode(texts[:largest], batch_size=largest)   # прогрев пула потоков
+
+        for batch_size in batch_sizes:
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for offset in range(0, len(texts), batch_size):
+                    batch_start = time.perf_counter()
+                    classifier._encode(texts[offset:offset + batch_size], batch_size=batch_size)
+                    latencies.append((time.perf_counter() - batch_start) * 1000)
+            elapsed = time.perf_counter() - start
+
+            row = {
+                'batch_size': batch_size,
+                'num_threads': threads,
+                'interop_threads': interop,
+                'throughput_per_sec': len(texts) * repeats / max(elapsed, 1e-9),
+                'p50_ms': _percentile(latencies, 50),
+                'p95_ms': _percentile(latencies, 95)
+            }
+            rows.append(row)
+            print(f"  пакет {batch_size:>3}, потоки {threads or '-':>2}, межоп. {interop or '-':>2}: "
+                  f"{row['throughput_per_sec']:8.1f} писем/с, p95 {row['p95_ms']:8.1f} мс", flush=True)
+
+    return {'model': classifier.model_name, 'backend': classifier.backend, 'rows': rows}
+
+
+def select_best(rows: List[Dict], max_p95_ms: Optional[float] = None) -> Dict:
+    """Максимум пропускной способности среди настроек, укладывающихся в p95"""
+    candidates = rows
+    if max_p95_ms is not None:
+        candidates = [row for row in rows if row['p95_ms'] <= max_p95_ms]
+        if not candidates:
+            logger.warning(f"⚠️ Ни одна настройка не укладывается в p95 {max_p95_ms} мс - беру минимальную p95")
+            return min(rows, key=lambda row: row['p95_ms'])
+    # При равной скорости - меньше потоков: остаются ядра для разбора писем
+    return max(candidates, key=lambda row: (round(row['throughput_per_sec'], 1), -(row['num_threads'] or 0)))
+
+
+def _thread_candidates(cpus: int) -> List[int]:
+    values = {cpus}
+    value = 1
+    while value < cpus:
+        values.add(value)
+        value *= 2
+    return sorted(values)
+
+
+def run_sweep(texts: List[str], batch_sizes: List[int], threads_list: List[int],
+              interop_list: List[int], repeats: int = 1) -> Dict:
+    """Полный перебор; каждое значение межоператорных потоков - свой процесс"""
+    try:
+        import torch  # noqa: F401
+        has_torch = True
+    except ImportError:
+        has_torch = False
+        logger.warning("⚠️ torch не установлен - потоки torch не перебираются")
+
+    backend = os.getenv('INFERENCE_BACKEND', 'torch')
+    if not has_torch and backend == 'torch':
+        threads_list = [None]
+    if not has_torch or backend != 'torch':
+        interop_list = [None]
+
+    context = multiprocessing.get_context('spawn')
+    model, rows = None, []
+    for interop in interop_list:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            measured = executor.submit(_measure_grid, interop, threads_list, batch_sizes, texts, repeats).result()
+        model, backend = measured['model'], measured['backend']
+        rows.extend(measured['rows'])
+    return {'model': model, 'backend': backend, 'rows': rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Подбор параметров CPU-инференса MailLens под узел")
+    parser.add_argument("--test-emails", default="test_emails")
+    parser.add_argument("--sample", type=int, default=200, help="Писем из корпуса для замеров")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 16, 32, 64])
+    parser.add_argument("--threads", type=int, nargs="+", default=None,
+                        help="Значения torch.set_num_threads (по умолчанию степени двойки до числа ядер)")
+    parser.add_argument("--interop", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--repeats", type=int, default=2, help="Проходов выборки на настройку")
+    parser.add_argument("--max-p95-ms", type=float, default=None,
+                        help="Ограничение p95 задержки пакета; лучшая - самая быстрая из укладывающихся")
+    parser.add_argument("-o", "--output", default=os.getenv("INFERENCE_PROFILE_PATH") or "config/inference_profile.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    os.environ['MODEL_LOAD_MODE'] = 'lazy'
+    from compact_embeddings import labeled_corpus
+
+    texts, _ = labeled_corpus(args.test_emails, args.sample)
+    if not texts:
+        print(f"❌ Нет размеченных писем в {args.test_emails}", file=sys.stderr)
+        sys.exit(1)
+
+    cpus = available_cpus()
+    threads_list = sorted({t for t in (args.threads or _thread_candidates(cpus)) if 0 < t <= cpus}) or [cpus]
+    interop_list = sorted({i for i in args.interop if 0 < i <= cpus}) or [1]
+    print(f"🔧 Узел {node_signature()}: {len(texts)} писем, пакеты {args.batch_sizes}, "
+          f"потоки {threads_list}, межоператорные {interop_list}")
+
+    try:
+        sweep = run_sweep(texts, sorted(set(args.batch_sizes)), threads_list, interop_list, args.repeats)
+    except RuntimeError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        sys.exit(1)
+
+    best = select_best(sweep['rows'], args.max_p95_ms)
+    profile = {
+        'node': node_signature(),
+        'cpus': cpus,
+        'model': sweep['model'],
+        'backend': sweep['backend'],
+        'batch_size': best['batch_size'],
+        'num_threads': best['num_threads'],
+        'interop_threads': best['interop_threads'],
+        'throughput_per_sec': best['throughput_per_sec'],
+        'p50_ms': best['p50_ms'],
+        'p95_ms': best['p95_ms'],
+        'max_p95_ms': args.max_p95_ms,
+        'sample_size': len(texts),
+        'tuned_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'sweep': sweep['rows']
+    }
+    save_profile(args.output, profile)
+
+    print(f"✅ Лучшая настройка: пакет {best['batch_size']}, потоки {best['num_threads']}, "
+          f"межоператорные {best['interop_threads']} - {best['throughput_per_sec']:.1f} писем/с, "
+          f"p95 {best['p95_ms']:.1f} мс")
+    print(f"💾 Профиль сохранён: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
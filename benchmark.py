@@ -37,6 +37,7 @@ class EnhancedModelBenchmark:
             "default_threshold": 0.15,  # Пониженный порог
             "max_emails": 500,
             "cache_enabled": True,
+            "batch_size": 32,
             "save_detailed_results": True
         }
         
@@ -308,22 +309,58 @@ class EnhancedModelBenchmark:
         processing_times = []
         confidences = []
         
-        for i, email in enumerate(emails):
+        # Порог выставляем один раз на весь прогон; профиль не трогает настройки других сессий
+        if hasattr(classifier, 'profile'):
+            classifier = classifier.profile(classifier.categories, self.config["default_threshold"])
+        elif hasattr(classifier, 'set_threshold'):
+            classifier.set_threshold(self.config["default_threshold"])
+        
+        # Пакетная классификация, если классификатор её поддерживает
+        use_batch = hasattr(classifier, 'classify_batch')
+        step = self.config["batch_size"] if use_batch else 1
+        
+        for start in range(0, len(emails), step):
+            chunk = emails[start:start + step]
+            
             # Обновляем статус
-            status_text.text(f"📧 Обработка {i+1}/{len(emails)}: {email['filename'][:30]}...")
+            status_text.text(f"📧 Обработка {start+1}-{start+len(chunk)}/{len(emails)}: {chunk[0]['filename'][:30]}...")
             
             # Замер времени
             iteration_start = time.perf_counter()
             
             try:
-                # Классификация с пониженным порогом
-                if hasattr(classifier, 'set_threshold'):
-                    classifier.set_threshold(self.config["default_threshold"])
-                
-                prediction = classifier.classify(email["text"], top_n=3, use_cache=self.config["cache_enabled"])
+                texts = [email["text"] for email in chunk]
+                if use_batch:
+                    predictions = classifier.classify_batch(
+                        texts, batch_size=step, top_n=3, use_cache=self.config["cache_enabled"]
+                    )
+                else:
+                    predictions = [classifier.classify(texts[0], top_n=3, use_cache=self.config["cache_enabled"])]
+                error = None
+            except Exception as e:
+                predictions = [None] * len(chunk)
+                error = e
+            
+            # Время обработки пакета делим поровну между письмами
+            duration = (time.perf_counter() - iteration_start) * 1000 / len(chunk)
+            
+            for email, prediction in zip(chunk, predictions):
+                if error is not None:
+                    results.append({
+                        "filename": email["filename"],
+                        "true_category": email["true_category"],
+                        "predicted_category": "ERROR",
+                        "confidence": 0.0,
+                        "is_undefined": True,
+                        "time_ms": round(duration, 1),
+                        "is_correct": False,
+                        "success": False,
+                        "error": str(error)[:100],
+                        "text_length": email["length"],
+                        "word_count": email["words"]
+                    })
+                    continue
                 
-                # Время обработки
-                duration = (time.perf_counter() - iteration_start) * 1000
                 processing_times.append(duration)
                 
                 # Определяем правильность
@@ -362,34 +399,17 @@ class EnhancedModelBenchmark:
                     result["confidence_level"] = "low"
                 
                 results.append(result)
-                
-            except Exception as e:
-                duration = (time.perf_counter() - iteration_start) * 1000
-                results.append({
-                    "filename": email["filename"],
-                    "true_category": email["true_category"],
-                    "predicted_category": "ERROR",
-                    "confidence": 0.0,
-                    "is_undefined": True,
-                    "time_ms": round(duration, 1),
-                    "is_correct": False,
-                    "success": False,
-                    "error": str(e)[:100],
-                    "text_length": email["length"],
-                    "word_count": email["words"]
-                })
             
             # Обновляем прогресс и метрики
-            progress = (i + 1) / len(emails)
-            progress_bar.progress(progress)
+            processed = start + len(chunk)
+            progress_bar.progress(processed / len(emails))
             
-            if i % 10 == 0:  # Обновляем каждые 10 итераций
-                current_metrics = self._calculate_intermediate_metrics(results, processing_times)
-                metrics_text.text(
-                    f"✅ Обработано: {i+1}/{len(emails)}\n"
-                    f"📊 Точность: {current_metrics.get('accuracy', 0):.1%}\n"
-                    f"⚡ Среднее время: {current_metrics.get('avg_time_ms', 0):.1f} мс"
-                )
+            current_metrics = self._calculate_intermediate_metrics(results, processing_times)
+            metrics_text.text(
+                f"✅ Обработано: {processed}/{len(emails)}\n"
+                f"📊 Точность: {current_metrics.get('accuracy', 0):.1%}\n"
+                f"⚡ Среднее время: {current_metrics.get('avg_time_ms', 0):.1f} мс"
+            )
         
         # Завершение
         total_time = time.time() - start_time
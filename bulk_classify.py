@@ -0,0 +1,289 @@
+"""
+BULK_CLASSIFY.PY - Массовая классификация писем из командной строки
+
+Источники: папка с .eml файлами, mbox файл или Maildir (через индекс
+смещений mail_reader.py). Чтение и разбор писем идут в пуле процессов,
+эмбеддинги - пакетами в основном процессе с моделью. Результаты пишутся
+потоково в JSONL или CSV.
+
+Пример:
+    python bulk_classify.py archive.mbox -o results.jsonl --workers 8 --resume
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import metrics
+from mail_reader import MaildirIndex, MboxIndex, MessageRef, read_message
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FIELDS = [
+    'id', 'filename', 'subject', 'from', 'date', 'language',
+    'predicted_category', 'confidence', 'is_undefined', 'method', 'top_categories', 'error'
+]
+
+_worker_processor = None
+
+
+# ---------- ИСТОЧНИКИ ----------
+def detect_source_type(path: Path) -> str:
+    """Тип источника: maildir, eml_dir или mbox"""
+    if path.is_dir():
+        if all((path / sub).is_dir() for sub in ('cur', 'new')):
+            return 'maildir'
+        return 'eml_dir'
+    return 'mbox'
+
+
+def iter_messages(path: Path, source_type: str) -> Iterator[Tuple[str, MessageRef]]:
+    """Потоковая выдача (id, ссылка на письмо) - сами письма читают воркеры"""
+    if source_type == 'eml_dir':
+        for file_path in sorted(path.rglob('*.eml')):
+            yield str(file_path.relative_to(path)), (str(file_path), 0, file_path.stat().st_size)
+
+    elif source_type == 'maildir':
+        index = MaildirIndex(path)
+        for i, ref in index.iter_refs():
+            yield MaildirIndex.message_id(index.keys[i]), ref
+
+    else:
+        index = MboxIndex(path)
+        try:
+            for i, ref in index.iter_refs():
+                yield f"{path.name}#{i}", ref
+        finally:
+            index.close()
+
+
+# ---------- РАЗБОР В ПУЛЕ ПРОЦЕССОВ ----------
+def parse_message(item: Tuple[str, MessageRef]) -> Dict:
+    """Разбор письма в процессе-воркере (модель здесь не загружается)"""
+    global _worker_processor
+    if _worker_processor is None:
+        from core import EmailProcessor
+        _worker_processor = EmailProcessor()
+
+    message_id, ref = item
+    try:
+        content = read_message(ref)
+    except OSError as e:
+        return {'id': message_id, 'filename': message_id, 'success': False, 'error': str(e)}
+
+    parsed = _worker_processor.parse_email(content, message_id.rsplit('/', 1)[-1])
+    parsed['id'] = message_id
+    # Полный текст и фичи не нужны в основном процессе - не гоняем их через pipe
+    parsed.pop('features', None)
+    parsed.pop('body', None)
+    return parsed
+
+
+def chunks(iterable, size: int):
+    """Списки по size элементов из потока (последний - остаток)"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# ---------- ВЫВОД ----------
+class ResultWriter:
+    """Потоковая запись результатов в JSONL или CSV"""
+
+    def __init__(self, path: Path, fmt: str, append: bool):
+        self.fmt = fmt
+        write_header = not (append and path.exists() and path.stat().st_size > 0)
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8', newline='')
+        self._csv = None
+        if fmt == 'csv':
+            self._csv = csv.DictWriter(self._file, fieldnames=OUTPUT_FIELDS, extrasaction='ignore')
+            if write_header:
+                self._csv.writeheader()
+
+    def write(self, row: Dict):
+        if self._csv is not None:
+            row = dict(row, top_categories=json.dumps(row.get('top_categories', []), ensure_ascii=False))
+            self._csv.writerow(row)
+        else:
+            self._file.write(json.dumps(row, ensure_ascii=False, default=float) + '\n')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _truncate_partial_line(path: Path):
+    """Обрезка оборванной последней записи после аварийной остановки"""
+    if not path.exists():
+        return
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+        if tail.endswith(b'\n'):
+            return
+        cut = tail.rfind(b'\n')
+        f.truncate(size - len(tail) + cut + 1 if cut >= 0 else 0)
+
+
+def load_done_ids(path: Path, fmt: str) -> set:
+    """Идентификаторы уже обработанных писем (для --resume)"""
+    done = set()
+    if not path.exists():
+        return done
+
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                if row.get('id'):
+                    done.add(row['id'])
+        else:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['id'])
+                except (ValueError, KeyError):
+                    continue  # оборванная последняя строка
+    return done
+
+
+def _result_row(parsed: Dict, result: Optional[Dict]) -> Dict:
+    row = {
+        'id': parsed['id'],
+        'filename': parsed.get('filename'),
+        'subject': parsed.get('subject'),
+        'from': parsed.get('from'),
+        'date': parsed.get('date'),
+        'language': parsed.get('language'),
+    }
+    if result is None:
+        row.update({'predicted_category': None, 'confidence': 0.0, 'is_undefined': True,
+                    'method': 'parse-error', 'top_categories': [], 'error': parsed.get('error')})
+    else:
+        row.update({
+            'predicted_category': result.get('predicted_category'),
+            'confidence': float(result.get('confidence', 0.0)),
+            'is_undefined': bool(result.get('is_undefined', True)),
+            'method': result.get('method'),
+            'top_categories': result.get('top_categories', []),
+            'error': None
+        })
+    return row
+
+
+# ---------- ОСНОВНОЙ ЦИКЛ ----------
+def run(source: Path, output: Path, fmt: str, workers: int, batch_size: int, top_n: int,
+        resume: bool, progress_every: int, classifier, metrics_file: Optional[str] = None) -> Dict:
+    """Классификация всех писем источника с потоковой записью результатов"""
+    source_type = detect_source_type(source)
+    if resume:
+        _truncate_partial_line(output)
+    done_ids = load_done_ids(output, fmt) if resume else set()
+    if done_ids:
+        logger.info(f"Продолжение: пропускаю {len(done_ids)} уже обработанных писем")
+
+    messages = (item for item in iter_messages(source, source_type) if item[0] not in done_ids)
+    writer = ResultWriter(output, fmt, append=resume)
+
+    stats = {'processed': 0, 'errors': 0, 'skipped': len(done_ids)}
+    start = time.perf_counter()
+    last_report = 0
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Окно ограничивает число писем в памяти одновременно
+            for window in chunks(messages, batch_size * workers * 2):
+                parsed_list = list(executor.map(parse_message, window, chunksize=max(1, batch_size // 4)))
+
+                for batch in chunks(parsed_list, batch_size):
+                    ok = [p for p in batch if p.get('success')]
+                    texts = [p['cleaned_text'] or p['full_text'] for p in ok]
+                    results = classifier.classify_batch(texts, batch_size=batch_size, top_n=top_n,
+                                                        use_cache=False) if texts else []
+                    result_by_id = {p['id']: r for p, r in zip(ok, results)}
+
+                    for parsed in batch:
+                        result = result_by_id.get(parsed['id'])
+                        if result is None:
+                            stats['errors'] += 1
+                            metrics.ERRORS.inc('parse')
+                        writer.write(_result_row(parsed, result))
+
+                    stats['processed'] += len(batch)
+
+                writer.flush()
+
+                if stats['processed'] - last_report >= progress_every:
+                    last_report = stats['processed']
+                    if metrics_file:
+                        metrics.write_textfile(metrics_file)
+                    elapsed = time.perf_counter() - start
+                    logger.info(
+                        f"📧 Обработано {stats['processed']} писем "
+                        f"({stats['processed'] / max(elapsed, 1e-9):.1f} писем/с), ошибок: {stats['errors']}"
+                    )
+    finally:
+        writer.close()
+        if metrics_file:
+            metrics.write_textfile(metrics_file)
+
+    stats['elapsed_sec'] = time.perf_counter() - start
+    stats['messages_per_sec'] = stats['processed'] / max(stats['elapsed_sec'], 1e-9)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Массовая классификация писем MailLens")
+    parser.add_argument("source", help="Папка с .eml, mbox файл или Maildir")
+    parser.add_argument("-o", "--output", required=True, help="Файл результатов (.jsonl или .csv)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default=None)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Процессы для разбора писем")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--top-n", type=int, default=3)
+    parser.add_argument("--categories", default="config/categories.json")
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("DEFAULT_THRESHOLD", "0.35")))
+    parser.add_argument("--resume", action="store_true", help="Пропустить письма, уже записанные в output")
+    parser.add_argument("--progress-every", type=int, default=1000)
+    parser.add_argument("--metrics-file", default=os.getenv("METRICS_FILE") or None,
+                        help="Файл метрик Prometheus (textfile-коллектор node_exporter)")
+    args = parser.parse_args()
+
+    source = Path(args.source)
+    if not source.exists():
+        print(f"❌ Источник не найден: {source}", file=sys.stderr)
+        sys.exit(1)
+
+    output = Path(args.output)
+    fmt = args.format or ('csv' if output.suffix.lower() == '.csv' else 'jsonl')
+
+    from core import classifier, load_categories
+
+    classifier.set_categories(load_categories(args.categories))
+    classifier.set_threshold(args.threshold)
+    classifier.warmup()
+
+    stats = run(source, output, fmt, max(1, args.workers), args.batch_size, args.top_n,
+                args.resume, args.progress_every, classifier, args.metrics_file)
+
+    print(f"✅ Обработано: {stats['processed']} (пропущено: {stats['skipped']}, ошибок: {stats['errors']})")
+    print(f"⚡ {stats['messages_per_sec']:.1f} писем/с за {stats['elapsed_sec']:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+"""
+CASCADE.PY - Каскад классификации: правила -> лексическая модель -> ученик -> трансформер
+
+Дешёвые уровни отвечают сами, когда уверены, и трансформер для таких писем не
+запускается. Очевидный спам и автоматические уведомления выходят на правилах,
+типовые письма - на лексической модели, остальное идёт в модель эмбеддингов.
+
+    rules       - регулярные выражения HybridMailClassifier (ensemble_model.py)
+                  и правила уведомлений каскада (CASCADE_RULES)
+    lexical     - наивный Байес по хэшированным словам (доли миллисекунды на письмо)
+    distilled   - линейная модель, обученная на оценках трансформера (distillation.py)
+    transformer - ZeroShotMailClassifier
+
+Порог уверенности каждого уровня настраивается. Уверенность правил - доля
+веса группы правил категории, которая совпала с письмом (0.6 - совпали хотя
+бы два признака из трёх), у моделей - вероятность лучшей категории. Каскад считает, какая доля
+трафика выходит на каждом уровне. Команда evaluate показывает точность уровней
+на размеченном корпусе.
+
+Пример:
+    python cascade.py train --test-emails test_emails --holdout 0.2 -o config/lexical_nb.npz
+    python cascade.py evaluate --test-emails test_emails --holdout 0.2 --lexical-model config/lexical_nb.npz \
+        --distilled-model config/distilled.npz
+"""
+
+import os
+import re
+import sys
+import zlib
+import hashlib
+import logging
+import argparse
+import functools
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import metrics
+from near_duplicate import normalize_tokens
+
+logger = logging.getLogger(__name__)
+
+TIERS = ('rules', 'lexical', 'distilled', 'transformer')
+LEXICAL_FEATURES = 2 ** 16
+
+# Ключ правил HybridMailClassifier -> признаки в названии категории пользователя
+RULE_CATEGORY_MARKERS = {
+    'spam': ('spam', 'спам', 'реклам'),
+    'complaint': ('complaint', 'жалоб'),
+    'business': ('business', 'делов', 'бизнес'),
+    'support': ('support', 'поддерж', 'технич'),
+    'news': ('news', 'новост', 'уведомлен', 'рассылк'),
+}
+
+# Правила только каскада (ансамбль HybridMailClassifier их не использует): автоматические уведомления
+CASCADE_RULES = {
+    'news': [
+        (r'не отвечайте на (?:это )?письмо|no-?reply|сформирован\w* автоматически', 0.8),
+        (r'отписаться|unsubscribe|рассылк', 0.7),
+        (r'новост|анонс|дайджест|информируем', 0.6)
+    ]
+}
+
+
+def hashed_token_ids(text: str, n_features: int = LEXICAL_FEATURES) -> np.ndarray:
+    """Номера признаков слов и биграмм текста (хэширование без словаря)"""
+    tokens = normalize_tokens(text)
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    return np.fromiter((zlib.crc32(gram.encode('utf-8', errors='surrogatepass')) % n_features
+                        for gram in grams), dtype=np.int64, count=len(grams))
+
+
+def in_holdout(filename: str, fraction: float) -> bool:
+    """Стабильное разбиение корпуса: письмо в отложенной части (для честной оценки уровней)"""
+    if fraction <= 0:
+        return False
+    digest = hashlib.blake2b(filename.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') / 2 ** 64 < fraction
+
+
+# ---------- ЛЕКСИЧЕСКАЯ МОДЕЛЬ ----------
+class HashedNaiveBayes:
+    """Мультиномиальный наивный Байес по хэшированным словам и биграммам"""
+
+    def __init__(self, n_features: int = LEXICAL_FEATURES, alpha: float = 0.1):
+        self.n_features = n_features
+        self.alpha = alpha
+        self.classes_: List[str] = []
+        self.class_log_prior = None
+        self.feature_log_prob = None   # (n_classes, n_features)
+
+    def fit(self, texts: Sequence[str], labels: Sequence[str]) -> 'HashedNaiveBayes':
+        self.classes_ = sorted(set(labels))
+        class_idx = {label: i for i, label in enumerate(self.classes_)}
+        counts = np.zeros((len(self.classes_), self.n_features), dtype=np.float64)
+        docs = np.zeros(len(self.classes_), dtype=np.float64)
+
+        for text, label in zip(texts, labels):
+            row = class_idx[label]
+            np.add.at(counts[row], hashed_token_ids(text, self.n_features), 1.0)
+            docs[row] += 1
+
+        counts += self.alpha
+        self.feature_log_prob = np.log(counts / counts.sum(axis=1, keepdims=True)).astype(np.float32)
+        self.class_log_prior = np.log(docs / docs.sum())
+        return self
+
+    def predict_proba(self, texts: Sequence[str]) -> np.ndarray:
+        probabilities = np.empty((len(texts), len(self.classes_)), dtype=np.float64)
+        for row, text in enumerate(texts):
+            ids, counts = np.unique(hashed_token_ids(text, self.n_features), return_counts=True)
+            log_prob = self.class_log_prior + self.feature_log_prob[:, ids].astype(np.float64) @ counts
+            log_prob -= log_prob.max()
+            exp = np.exp(log_prob)
+            probabilities[row] = exp / exp.sum()
+        return probabilities
+
+    @property
+    def id(self) -> str:
+        digest = hashlib.blake2b(self.feature_log_prob.tobytes(), digest_size=4).hexdigest()
+        return f"nb{len(self.classes_)}-{digest}"
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez_compressed(path, classes=np.array(self.classes_), alpha=self.alpha,
+                            class_log_prior=self.class_log_prior, feature_log_prob=self.feature_log_prob)
+
+    @classmethod
+    def load(cls, path: str) -> 'HashedNaiveBayes':
+        with np.load(path, allow_pickle=False) as data:
+            model = cls(n_features=data['feature_log_prob'].shape[1], alpha=float(data['alpha']))
+            model.classes_ = [str(c) for c in data['classes']]
+            model.class_log_prior = data['class_log_prior']
+            model.feature_log_prob = data['feature_log_prob']
+        return model
+
+
+# ---------- КАСКАД ----------
+class ClassificationCascade:
+    """Уровни до трансформера и статистика выходов по уровням
+
+    decide() возвращает (уровень, вероятности по категориям) для письма, на
+    котором дешёвый уровень уверен не меньше своего порога, иначе None -
+    письмо идёт в трансформер.
+    """
+
+    def __init__(self, rules=None, lexical=None, rule_cutoff: float = 0.6, lexical_cutoff: float = 0.9,
+                 distilled=None, distilled_cutoff: Optional[float] = None):
+        if rules is None:
+            from ensemble_model import HybridMailClassifier
+            rules = HybridMailClassifier()
+        self.rules = rules
+        # Группы правил: (выражения с весами, суммарный вес группы)
+        groups = dict(rules.rule_based_rules, **CASCADE_RULES)
+        self._rule_groups = {
+            key: ([(re.compile(pattern), weight) for pattern, weight in patterns],
+                  sum(weight for _, weight in patterns))
+            for key, patterns in groups.items()
+        }
+        self._rules_id = hashlib.blake2b(repr(sorted(groups.items())).encode('utf-8'), digest_size=4).hexdigest()
+        self.lexical = lexical
+        self.rule_cutoff = rule_cutoff
+        self.lexical_cutoff = lexical_cutoff
+        self.distilled = distilled
+        # По умолчанию - порог, подобранный при дистилляции
+        if distilled_cutoff is None:
+            distilled_cutoff = getattr(distilled, 'cutoff', None)
+        self.distilled_cutoff = distilled_cutoff if distilled_cutoff is not None else 1.0
+
+        self._exits = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def id(self) -> str:
+        """Часть контекста результата: другие пороги или модель - другие результаты"""
+        lexical_id = self.lexical.id if self.lexical is not None else '-'
+        cascade_id = f"cascade:{self._rules_id}:{self.rule_cutoff:.4f}:{lexical_id}:{self.lexical_cutoff:.4f}"
+        if self.distilled is not None:
+            cascade_id += f":{self.distilled.id}:{self.distilled_cutoff:.4f}"
+        return cascade_id
+
+    @functools.lru_cache(maxsize=64)
+    def _rule_targets(self, categories: Tuple[str, ...]) -> Dict[str, int]:
+        """Ключ правил -> индекс категории (первая категория с признаком в названии)"""
+        targets = {}
+        for key, markers in RULE_CATEGORY_MARKERS.items():
+            for idx, category in enumerate(categories):
+                if any(marker in category.lower() for marker in markers):
+                    targets[key] = idx
+                    break
+        return targets
+
+    @functools.lru_cache(maxsize=64)
+    def _model_columns(self, model, categories: Tuple[str, ...]) -> Tuple[np.ndarray, np.ndarray]:
+        """Классы модели уровня, совпадающие с категориями: (столбцы модели, индексы категорий)"""
+        positions = {category: idx for idx, category in enumerate(categories)}
+        pairs = [(col, positions[name]) for col, name in enumerate(model.classes_) if name in positions]
+        columns = np.array([col for col, _ in pairs], dtype=np.int64)
+        targets = np.array([idx for _, idx in pairs], dtype=np.int64)
+        return columns, targets
+
+    def rule_scores(self, text: str) -> Dict[str, float]:
+        """Уверенность групп правил: доля веса группы, совпавшая с письмом (0..1)"""
+        text_lower = text.lower()
+        scores = {}
+        for key, (patterns, total_weight) in self._rule_groups.items():
+            matched = sum(weight for pattern, weight in patterns if pattern.search(text_lower))
+            if matched > 0:
+                scores[key] = matched / total_weight
+        return scores
+
+    def _rules_decision(self, text: str, categories: Tuple[str, ...]) -> Optional[np.ndarray]:
+        if self.rule_cutoff <= 0:
+            return None
+        targets = self._rule_targets(categories)
+        scores = {key: score for key, score in self.rule_scores(text).items() if key in targets}
+        if not scores or max(scores.values()) < self.rule_cutoff:
+            return None
+
+        probabilities = np.zeros(len(categories), dtype=np.float64)
+        for key, score in scores.items():
+            probabilities[targets[key]] = max(probabilities[targets[key]], score)
+        return probabilities / probabilities.sum()
+
+    def _model_decision(self, model, cutoff: float, text: str, categories: Tuple[str, ...]) -> Optional[np.ndarray]:
+        """Решение уровня с моделью predict_proba/classes_ (лексика, ученик)"""
+        if model is None or cutoff > 1.0:
+            return None
+        columns, targets = self._model_columns(model, categories)
+        if not columns.size:
+            return None
+        # Классы модели вне набора категорий отбрасываются, оставшиеся перенормируются
+        model_probs = model.predict_proba([text])[0][columns]
+        total = model_probs.sum()
+        if total <= 0:
+            return None
+        probabilities = np.zeros(len(categories), dtype=np.float64)
+        probabilities[targets] = model_probs / total
+        if probabilities.max() < cutoff:
+            return None
+        return probabilities
+
+    def _lexical_decision(self, text: str, categories: Tuple[str, ...]) -> Optional[np.ndarray]:
+        return self._model_decision(self.lexical, self.lexical_cutoff, text, categories)
+
+    def _distilled_decision(self, text: str, categories: Tuple[str, ...]) -> Optional[np.ndarray]:
+        return self._model_decision(self.distilled, self.distilled_cutoff, text, categories)
+
+    def decide(self, text: str, categories: Sequence[str]) -> Optional[Tuple[str, np.ndarray]]:
+        categories = tuple(categories)
+        if not categories:
+            return None
+        for tier, decision in (('rules', self._rules_decision), ('lexical', self._lexical_decision),
+                               ('distilled', self._distilled_decision)):
+            probabilities = decision(text, categories)
+            if probabilities is not None:
+                self.record(tier)
+                return tier, probabilities
+        return None
+
+    def record(self, tier: str):
+        with self._lock:
+            self._exits[tier] += 1
+        metrics.CASCADE_EXITS.inc(tier)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            exits = {tier: self._exits.get(tier, 0) for tier in TIERS}
+        total = sum(exits.values())
+        return {
+            'rule_cutoff': self.rule_cutoff,
+            'lexical_cutoff': self.lexical_cutoff,
+            'lexical_model': self.lexical.id if self.lexical is not None else None,
+            'distilled_cutoff': self.distilled_cutoff,
+            'distilled_model': self.distilled.id if self.distilled is not None else None,
+            'exits': exits,
+            'exit_share': {tier: count / total if total else 0.0 for tier, count in exits.items()}
+        }
+
+    def reset_stats(self):
+        with self._lock:
+            self._exits.clear()
+
+
+# ---------- ОЦЕНКА НА РАЗМЕЧЕННОМ КОРПУСЕ ----------
+def _labeled_texts(test_emails_dir: str, holdout: float, part: str) -> Tuple[List[str], List[str]]:
+    """Тексты и метки обучающей (train) или отложенной (holdout) части корпуса"""
+    from core import email_processor, load_labeled_emails
+
+    texts, labels = [], []
+    for email in load_labeled_emails(test_emails_dir):
+        if in_holdout(email['filename'], holdout) != (part == 'holdout'):
+            continue
+        parsed = email_processor.parse_email(email['text'].encode('utf-8'), email['filename'])
+        if parsed.get('success'):
+            texts.append(parsed['cleaned_text'] or parsed['full_text'])
+            labels.append(email['true_category'])
+    return texts, labels
+
+
+def evaluate(classifier, cascade: ClassificationCascade, texts: List[str], labels: List[str]) -> Dict:
+    """Доля выходов и точность на каждом уровне; точность трансформера на тех же письмах"""
+    # Профиль, а не set_categories: категории общего классификатора не меняются
+    classifier = classifier.profile(sorted(set(labels)))
+
+    previous = classifier.cascade
+    try:
+        classifier.set_cascade(None)
+        reference = classifier.classify_batch(texts, use_cache=False)
+        classifier.set_cascade(cascade)
+        cascaded = classifier.classify_batch(texts, use_cache=False)
+    finally:
+        classifier.set_cascade(previous)
+
+    report = {}
+    for tier in TIERS:
+        rows = [i for i, result in enumerate(cascaded) if result.get('cascade_tier') == tier]
+        correct = sum(cascaded[i]['predicted_category'] == labels[i] for i in rows)
+        reference_correct = sum(reference[i]['predicted_category'] == labels[i] for i in rows)
+        report[tier] = {
+            'emails': len(rows),
+            'share': len(rows) / len(texts) if texts else 0.0,
+            'accuracy': correct / len(rows) if rows else None,
+            'transformer_accuracy': reference_correct / len(rows) if rows else None
+        }
+    report['overall'] = {
+        'emails': len(texts),
+        'accuracy': sum(r['predicted_category'] == l for r, l in zip(cascaded, labels)) / max(len(texts), 1),
+        'transformer_accuracy': sum(r['predicted_category'] == l for r, l in zip(reference, labels)) / max(len(texts), 1),
+        'transformer_share': report['transformer']['share']
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Каскад классификации MailLens: обучение и оценка уровней")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = sub.add_parser("train", help="Обучить лексическую модель на размеченном корпусе")
+    train_parser.add_argument("-o", "--output", default=os.getenv("CASCADE_LEXICAL_MODEL") or "config/lexical_nb.npz")
+    train_parser.add_argument("--alpha", type=float, default=0.1)
+
+    eval_parser = sub.add_parser("evaluate", help="Выходы и точность по уровням на отложенной части корпуса")
+    eval_parser.add_argument("--lexical-model", default=os.getenv("CASCADE_LEXICAL_MODEL") or None)
+    eval_parser.add_argument("--rule-cutoff", type=float, default=float(os.getenv("CASCADE_RULE_CUTOFF", "0.6")))
+    eval_parser.add_argument("--lexical-cutoff", type=float, default=float(os.getenv("CASCADE_LEXICAL_CUTOFF", "0.9")))
+    eval_parser.add_argument("--distilled-model", default=os.getenv("CASCADE_DISTILLED_MODEL") or None)
+    eval_parser.add_argument("--distilled-cutoff", type=float, default=None,
+                             help="Порог ученика (по умолчанию - подобранный при дистилляции)")
+
+    for sub_parser in (train_parser, eval_parser):
+        sub_parser.add_argument("--test-emails", default="test_emails")
+        sub_parser.add_argument("--holdout", type=float, default=0.2,
+                                help="Доля корпуса, отложенная для оценки (разбиение по имени файла)")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        texts, labels = _labeled_texts(args.test_emails, args.holdout, 'train')
+        if not texts:
+            print(f"❌ Нет размеченных писем в {args.test_emails}", file=sys.stderr)
+            sys.exit(1)
+        model = HashedNaiveBayes(alpha=args.alpha).fit(texts, labels)
+        model.save(args.output)
+        print(f"✅ Лексическая модель: {len(texts)} писем, {len(model.classes_)} классов -> {args.output}")
+        return
+
+    texts, labels = _labeled_texts(args.test_emails, args.holdout if args.holdout > 0 else 1.0, 'holdout')
+    if not texts:
+        print(f"❌ Нет писем для оценки в {args.test_emails}", file=sys.stderr)
+        sys.exit(1)
+
+    from core import classifier
+
+    lexical = HashedNaiveBayes.load(args.lexical_model) if args.lexical_model else None
+    distilled = None
+    if args.distilled_model:
+        from distillation import DistilledClassifier
+        distilled = DistilledClassifier.load(args.distilled_model)
+    cascade = ClassificationCascade(lexical=lexical, rule_cutoff=args.rule_cutoff,
+                                    lexical_cutoff=args.lexical_cutoff,
+                                    distilled=distilled, distilled_cutoff=args.distilled_cutoff)
+    report = evaluate(classifier, cascade, texts, labels)
+
+    print(f"📊 Каскад на {len(texts)} письмах (правила >= {args.rule_cutoff}, лексика >= {args.lexical_cutoff}, "
+          f"ученик >= {cascade.distilled_cutoff:.3f}):")
+    for tier in TIERS:
+        row = report[tier]
+        accuracy = f"{row['accuracy']:.1%}" if row['accuracy'] is not None else "-"
+        reference = f"{row['transformer_accuracy']:.1%}" if row['transformer_accuracy'] is not None else "-"
+        print(f"  {tier:<12} {row['emails']:>5} писем ({row['share']:6.1%}), точность {accuracy:>6}, "
+              f"трансформер на них {reference:>6}")
+    overall = report['overall']
+    print(f"  Итого: точность {overall['accuracy']:.1%} против {overall['transformer_accuracy']:.1%} "
+          f"без каскада, до трансформера дошло {overall['transformer_share']:.1%} писем")
+
+
+if __name__ == "__main__":
+    main()
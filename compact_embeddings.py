@@ -0,0 +1,383 @@
+"""
+COMPACT_EMBEDDINGS.PY - Компактное хранение эмбеддингов
+
+Две независимые ступени:
+  * проекция - PCA, обученная на нашем корпусе, или обрезка до первых
+    компонент (prefix). Применяется ко всем векторам классификатора
+    (письма, категории, few-shot), поэтому сходство считается в одном
+    пространстве;
+  * квантование хранимых векторов - float16 или int8 с масштабом на вектор.
+    В работе классификатора квантуются только векторы на диске
+    (embedding_store.py): в памяти банк и матрица категорий остаются
+    float32. CompactMatrix используется лишь отчётом - он измеряет, сколько
+    точности и времени стоило бы держать матрицу писем в int8/float16.
+
+Отчёт сравнивает точность на размеченном test_emails с полными векторами:
+    python compact_embeddings.py report --dims 384 256 128 64 --dtypes float32 float16 int8
+    python compact_embeddings.py fit --dim 128 -o config/projector.npz
+"""
+
+import os
+import sys
+import time
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_METHODS = ('pca', 'prefix')
+QUANT_DTYPES = ('float32', 'float16', 'int8')
+
+# Бюджет распакованной во float32 порции матрицы при подсчёте сходства (элементов)
+SIMILARITY_CHUNK_ELEMENTS = 1_000_000
+
+_INT8_MAX = 127.0
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.ascontiguousarray(vectors / np.maximum(norms, 1e-12), dtype=np.float32)
+
+
+# ---------- ПРОЕКЦИЯ ----------
+class EmbeddingProjector:
+    """Понижение размерности нормализованных эмбеддингов
+
+    pca    - проекция на первые dim главных направлений корпуса;
+    prefix - первые dim координат без обучения.
+    Векторы не центрируются: иначе сходство письма с категорией зависит от
+    среднего по корпусу писем и argmax заметно смещается. Результат снова
+    нормализуется, поэтому скалярное произведение остаётся косинусным.
+    """
+
+    def __init__(self, method: str, dim: int, source_model: str = '',
+                 components: Optional[np.ndarray] = None,
+                 fitted_on: int = 0, explained_variance: float = 0.0):
+        if method not in SUPPORTED_METHODS:
+            raise ValueError(f"Неизвестный метод проекции: {method}")
+        if method == 'pca' and components is None:
+            raise ValueError("PCA-проекция требует обученных компонент (EmbeddingProjector.fit)")
+
+        self.method = method
+        self.dim = int(dim)
+        self.source_model = source_model
+        # Транспонированные компоненты (исходная размерность x dim) - сразу под matmul
+        self._components_t = None if components is None else np.ascontiguousarray(components.T, dtype=np.float32)
+        self.fitted_on = int(fitted_on)
+        self.explained_variance = float(explained_variance)
+        self.id = self._make_id()
+
+    @classmethod
+    def fit(cls, embeddings: np.ndarray, dim: int, source_model: str = '') -> 'EmbeddingProjector':
+        """PCA по эмбеддингам корпуса (SVD нецентрированной матрицы - сохраняет скалярные произведения)"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        n, full_dim = embeddings.shape
+        if not 0 < dim <= full_dim:
+            raise ValueError(f"Размерность проекции должна быть от 1 до {full_dim}")
+        if n < 2:
+            raise ValueError("Для PCA нужно хотя бы два вектора")
+
+        _, singular, vt = np.linalg.svd(embeddings.astype(np.float64), full_matrices=False)
+        energy = singular ** 2
+        explained = float(energy[:dim].sum() / max(energy.sum(), 1e-12))
+
+        if vt.shape[0] < dim:
+            # Корпус меньше размерности: дополняем ортогональным базисом
+            basis, _ = np.linalg.qr(np.vstack([vt, np.eye(full_dim)]).T)
+            vt = basis.T
+        components = vt[:dim]
+
+        logger.info(f"PCA {full_dim} -> {dim} по {n} векторам: объяснено {explained:.1%} дисперсии")
+        return cls('pca', dim, source_model, components=components,
+                   fitted_on=n, explained_variance=explained)
+
+    def _make_id(self) -> str:
+        if self.method == 'prefix':
+            return f"prefix{self.dim}"
+        digest = hashlib.blake2b(digest_size=4)
+        digest.update(self._components_t.tobytes())
+        return f"pca{self.dim}-{digest.hexdigest()}"
+
+    def project(self, embeddings: np.ndarray) -> np.ndarray:
+        """Проекция и повторная нормализация (n x dim, float32)"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.method == 'prefix':
+            return _normalize(embeddings[:, :self.dim])
+        return _normalize(embeddings @ self._components_t)
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {
+            'method': np.array(self.method),
+            'dim': np.array(self.dim),
+            'source_model': np.array(self.source_model),
+            'fitted_on': np.array(self.fitted_on),
+            'explained_variance': np.array(self.explained_variance),
+        }
+        if self.method == 'pca':
+            arrays['components'] = self._components_t.T
+        tmp_path = path.with_name(path.name + '.tmp.npz')
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        logger.info(f"Проекция {self.id} сохранена: {path}")
+
+    @classmethod
+    def load(cls, path) -> 'EmbeddingProjector':
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                str(data['method']), int(data['dim']), str(data['source_model']),
+                components=data['components'] if 'components' in data else None,
+                fitted_on=int(data['fitted_on']),
+                explained_variance=float(data['explained_variance'])
+            )
+
+    def info(self) -> Dict:
+        return {
+            'id': self.id,
+            'method': self.method,
+            'dim': self.dim,
+            'source_model': self.source_model,
+            'fitted_on': self.fitted_on,
+            'explained_variance': self.explained_variance
+        }
+
+
+# ---------- КВАНТОВАНИЕ ----------
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Коды и масштабы: int8 - симметрично по max|x| строки, масштаб float32 на вектор"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    if dtype == 'float32':
+        return np.ascontiguousarray(vectors), None
+    if dtype == 'float16':
+        return vectors.astype(np.float16), None
+    if dtype != 'int8':
+        raise ValueError(f"Неподдерживаемый тип квантования: {dtype}")
+
+    scales = np.abs(vectors).max(axis=1) / _INT8_MAX
+    scales[scales == 0] = 1.0
+    codes = np.rint(vectors / scales[:, None])
+    return codes.astype(np.int8), scales.astype(np.float32)
+
+
+def dequantize(codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    vectors = np.asarray(codes, dtype=np.float32)
+    if scales is not None:
+        vectors = vectors * scales[:, None]
+    return vectors
+
+
+def vector_to_blob(vector: np.ndarray, dtype: str) -> bytes:
+    """Один вектор в байты; для int8 впереди 4 байта масштаба"""
+    codes, scales = quantize(vector, dtype)
+    if scales is None:
+        return codes.tobytes()
+    return scales.tobytes() + codes.tobytes()
+
+
+def blob_to_vector(blob: bytes, dtype: str) -> np.ndarray:
+    if dtype != 'int8':
+        return np.frombuffer(blob, dtype=dtype).astype(np.float32)
+    scale = np.frombuffer(blob, dtype=np.float32, count=1)[0]
+    return np.frombuffer(blob, dtype=np.int8, offset=4).astype(np.float32) * scale
+
+
+def bytes_per_vector(dim: int, dtype: str) -> int:
+    if dtype == 'int8':
+        return dim + 4
+    return dim * np.dtype(dtype).itemsize
+
+
+class CompactMatrix:
+    """Матрица векторов в компактной форме (float16 или int8 + масштаб) для отчёта
+
+    similarity() распаковывает во float32 только порцию строк за раз:
+    для int8 масштаб строки применяется к уже посчитанному сходству.
+    Классификатор эту матрицу не использует (см. описание модуля).
+    """
+
+    def __init__(self, codes: np.ndarray, scales: Optional[np.ndarray] = None):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_vectors(cls, vectors: np.ndarray, dtype: str) -> 'CompactMatrix':
+        return cls(*quantize(vectors, dtype))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.codes.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def similarity(self, queries: np.ndarray) -> np.ndarray:
+        """Сходство нормализованных запросов со строками матрицы (n_queries x n_rows)"""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_rows, dim = self.codes.shape
+        if self.codes.dtype == np.float32:
+            return queries @ self.codes.T
+
+        result = np.empty((queries.shape[0], n_rows), dtype=np.float32)
+        step = max(1, SIMILARITY_CHUNK_ELEMENTS // max(dim, 1))
+        for start in range(0, n_rows, step):
+            block = self.codes[start:start + step].astype(np.float32)
+            np.matmul(queries, block.T, out=result[:, start:start + step])
+        if self.scales is not None:
+            result *= self.scales
+        return result
+
+
+# ---------- ОТЧЁТ ----------
+def labeled_corpus(test_emails_dir: str, limit: Optional[int]) -> Tuple[List[str], List[str]]:
+    """Очищенные тексты и метки размеченного корпуса"""
+    from core import email_processor, load_labeled_emails
+
+    texts, labels = [], []
+    for email in load_labeled_emails(test_emails_dir, limit=limit):
+        parsed = email_processor.parse_email(email['text'].encode('utf-8'), email['filename'])
+        if not parsed.get('success'):
+            continue
+        texts.append(parsed['cleaned_text'] or parsed['full_text'])
+        labels.append(email['true_category'])
+    return texts, labels
+
+
+def _encode_full(classifier, texts: List[str], batch_size: int) -> np.ndarray:
+    """Полные векторы модели, в обход проекции и хранилища классификатора"""
+    classifier._ensure_model()
+    if not classifier.model_loaded:
+        raise RuntimeError("Модель не загружена - отчёт в демо-режиме невозможен")
+    projector, classifier.projector = classifier.projector, None
+    try:
+        return classifier._encode(texts, batch_size=batch_size)
+    finally:
+        classifier.projector = projector
+
+
+def accuracy_report(email_vectors: np.ndarray, labels: List[str], category_vectors: np.ndarray,
+                    categories: List[str], dims: List[int], dtypes: List[str],
+                    method: str = 'pca', fit_vectors: Optional[np.ndarray] = None) -> List[Dict]:
+    """Точность argmax-классификации для каждой пары (размерность, тип) против полных float32
+
+    Категории остаются float32 (их мало), письма хранятся в компактной форме.
+    """
+    full_dim = email_vectors.shape[1]
+    category_index = {c.lower().strip(): i for i, c in enumerate(categories)}
+    truth = np.array([category_index.get(label.lower().strip(), -1) for label in labels])
+    labeled = truth >= 0
+
+    full_scores = email_vectors @ category_vectors.T
+    full_pred = full_scores.argmax(axis=1)
+    rows = []
+
+    for dim in dims:
+        if dim >= full_dim:
+            projector = None
+            emails, cats = email_vectors, category_vectors
+        else:
+            if method == 'pca':
+                projector = EmbeddingProjector.fit(
+                    fit_vectors if fit_vectors is not None else email_vectors, dim)
+            else:
+                projector = EmbeddingProjector('prefix', dim)
+            emails, cats = projector.project(email_vectors), projector.project(category_vectors)
+
+        for dtype in dtypes:
+            start = time.perf_counter()
+            scores = CompactMatrix.from_vectors(emails, dtype).similarity(cats).T
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            pred = scores.argmax(axis=1)
+
+            rows.append({
+                'dim': min(dim, full_dim),
+                'dtype': dtype,
+                'method': 'full' if projector is None else method,
+                'bytes_per_vector': bytes_per_vector(min(dim, full_dim), dtype),
+                'compression': bytes_per_vector(full_dim, 'float32') / bytes_per_vector(min(dim, full_dim), dtype),
+                'accuracy': float((pred[labeled] == truth[labeled]).mean()) if labeled.any() else 0.0,
+                'agreement': float((pred == full_pred).mean()),
+                'top1_score_drift': float(np.abs(scores.max(axis=1) - full_scores.max(axis=1)).mean()),
+                'similarity_ms': elapsed_ms,
+                'explained_variance': projector.explained_variance if projector is not None else 1.0
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Компактные эмбеддинги MailLens: проекция и отчёт точности")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    fit_parser = sub.add_parser("fit", help="Обучить проекцию на корпусе и сохранить")
+    fit_parser.add_argument("--method", choices=SUPPORTED_METHODS, default="pca")
+    fit_parser.add_argument("--dim", type=int, default=128)
+    fit_parser.add_argument("-o", "--output", default=os.getenv("EMBEDDING_PROJECTOR_PATH") or "config/projector.npz")
+
+    report_parser = sub.add_parser("report", help="Потеря точности против полных векторов")
+    report_parser.add_argument("--method", choices=SUPPORTED_METHODS, default="pca")
+    report_parser.add_argument("--dims", type=int, nargs="+", default=[384, 256, 128, 64])
+    report_parser.add_argument("--dtypes", choices=QUANT_DTYPES, nargs="+", default=list(QUANT_DTYPES))
+    report_parser.add_argument("--categories", default=None,
+                               help="JSON со списком категорий (по умолчанию - метки корпуса)")
+
+    for sub_parser in (fit_parser, report_parser):
+        sub_parser.add_argument("--test-emails", default="test_emails")
+        sub_parser.add_argument("--limit", type=int, default=None)
+        sub_parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    from core import classifier, load_categories
+
+    texts, labels = labeled_corpus(args.test_emails, args.limit)
+    if not texts:
+        print(f"❌ Нет размеченных писем в {args.test_emails}", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        vectors = _encode_full(classifier, texts, args.batch_size)
+    except RuntimeError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == "fit":
+        if args.method == 'pca':
+            # Названия категорий тоже попадают в подпространство - их векторы короче писем
+            categories = [c for c in load_categories() if c]
+            fit_vectors = np.vstack([vectors, _encode_full(classifier, categories, args.batch_size)])
+            projector = EmbeddingProjector.fit(fit_vectors, args.dim, classifier.model_name)
+        else:
+            projector = EmbeddingProjector('prefix', args.dim, classifier.model_name)
+        projector.save(args.output)
+        print(f"✅ Проекция {projector.id} ({vectors.shape[1]} -> {projector.dim}) сохранена: {args.output}")
+        if projector.method == 'pca':
+            print(f"   Объяснено дисперсии: {projector.explained_variance:.1%} по {projector.fitted_on} векторам")
+        return
+
+    # По умолчанию категории - сами метки корпуса, чтобы точность считалась по точному совпадению
+    if args.categories:
+        categories = [c for c in load_categories(args.categories) if c]
+    else:
+        categories = sorted(set(labels))
+    category_vectors = _encode_full(classifier, categories, args.batch_size)
+    rows = accuracy_report(vectors, labels, category_vectors, categories,
+                           args.dims, args.dtypes, method=args.method,
+                           fit_vectors=np.vstack([vectors, category_vectors]))
+
+    print(f"📊 {len(texts)} писем, {len(categories)} категорий, модель {classifier.model_name}")
+    print(f"{'dim':>5} {'тип':>8} {'байт':>6} {'сжатие':>7} {'точность':>9} {'согласие':>9} {'дрейф':>7} {'дисп.':>6}")
+    for row in rows:
+        print(f"{row['dim']:>5} {row['dtype']:>8} {row['bytes_per_vector']:>6} {row['compression']:>6.1f}x "
+              f"{row['accuracy']:>9.1%} {row['agreement']:>9.1%} {row['top1_score_drift']:>7.4f} "
+              f"{row['explained_variance']:>6.1%}")
+    if args.method == 'pca':
+        print("ℹ️ PCA обучена на тех же письмах: для честной оценки обучайте fit на другом корпусе")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ CORE.PY
 
 import sys
 import os
+import atexit
 import warnings
 import numpy as np
 from datetime import datetime
@@ -11,8 +12,21 @@ import re
 import json
 import logging
 from typing import List, Dict, Tuple, Optional
-import random
 import hashlib
+import time
+import threading
+import types
+from collections import OrderedDict, deque
+
+import latency
+import metrics
+from few_shot import FewShotBank, read_labeled_csv
+from inference_profile import apply_thread_settings, load_profile_for_node
+from keyword_rules import demo_scorer
+from latency import StageTimer
+from near_duplicate import NearDuplicateIndex
+from result_cache import ResultCache
+from text_features import feature_extractor
 
 # Настройка логирования
 logging.basicConfig(
@@ -25,6 +39,64 @@ logger = logging.getLogger(__name__)
 # Отключаем предупреждения
 warnings.filterwarnings('ignore')
 
+# Конфигурация из окружения (см. configuration.env)
+EMBEDDING_STORE_PATH = os.getenv('EMBEDDING_STORE_PATH', '')
+EMBEDDING_STORE_DTYPE = os.getenv('EMBEDDING_STORE_DTYPE', 'float16')
+# Проекция эмбеддингов (PCA/prefix из compact_embeddings.py fit; пусто - полные векторы)
+EMBEDDING_PROJECTOR_PATH = os.getenv('EMBEDDING_PROJECTOR_PATH', '')
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '10000'))
+RESULT_CACHE_MAX_MB = float(os.getenv('RESULT_CACHE_MAX_MB', '64'))
+RESULT_CACHE_POLICY = os.getenv('RESULT_CACHE_POLICY', 'lru')
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', '0')) or None
+# lazy - загрузка при первой классификации, eager - при создании, background - в фоновом потоке
+MODEL_LOAD_MODE = os.getenv('MODEL_LOAD_MODE', 'lazy')
+# Бэкенд инференса: torch, onnx или onnx-int8 (см. inference_backends.py)
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'torch')
+# Профиль CPU-инференса из autotune.py (потоки и размер пакета под тип узла; пусто - не применять)
+INFERENCE_PROFILE_PATH = os.getenv('INFERENCE_PROFILE_PATH', 'config/inference_profile.json')
+# Размер пакета кодирования по умолчанию (профиль инференса его переопределяет)
+ENCODE_BATCH_SIZE = int(os.getenv('ENCODE_BATCH_SIZE', '32'))
+# Режим классификации: centroid (вектор на категорию) или knn (голосование ближайших примеров)
+CLASSIFIER_MODE = os.getenv('CLASSIFIER_MODE', 'centroid')
+KNN_K = int(os.getenv('KNN_K', '10'))
+# Каталог сохранённого few-shot банка (пусто - только в памяти)
+FEW_SHOT_BANK_DIR = os.getenv('FEW_SHOT_BANK_DIR', '')
+# Задержка автосохранения банка (с): изменения за это время сохраняются одной записью (0 - сразу)
+FEW_SHOT_AUTOSAVE_DELAY_S = float(os.getenv('FEW_SHOT_AUTOSAVE_DELAY_S', '2'))
+# Почти-дубликаты: порог сходства SimHash-отпечатков (0 - отключено) и размер индекса
+NEAR_DUP_THRESHOLD = float(os.getenv('NEAR_DUP_THRESHOLD', '0'))
+NEAR_DUP_MAX_ENTRIES = int(os.getenv('NEAR_DUP_MAX_ENTRIES', '50000'))
+# Каскад: правила и лексическая модель до трансформера (cascade.py), пороги уверенности уровней
+CASCADE_ENABLED = os.getenv('CASCADE_ENABLED', '0') == '1'
+CASCADE_RULE_CUTOFF = float(os.getenv('CASCADE_RULE_CUTOFF', '0.6'))
+CASCADE_LEXICAL_CUTOFF = float(os.getenv('CASCADE_LEXICAL_CUTOFF', '0.9'))
+CASCADE_LEXICAL_MODEL = os.getenv('CASCADE_LEXICAL_MODEL', '')
+# Ученик трансформера (distillation.py); пустой порог - подобранный при дистилляции
+CASCADE_DISTILLED_MODEL = os.getenv('CASCADE_DISTILLED_MODEL', '')
+_distilled_cutoff = os.getenv('CASCADE_DISTILLED_CUTOFF', '')
+CASCADE_DISTILLED_CUTOFF = float(_distilled_cutoff) if _distilled_cutoff else None
+# Число профилей (наборов категорий/порогов сессий UI), которые держатся в памяти
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '32'))
+# Бюджет промежуточной матрицы сходств kNN (элементов float32 на порцию писем)
+KNN_CHUNK_ELEMENTS = 4_000_000
+
+SUPPORTED_MODES = ('centroid', 'knn')
+
+# Категории по умолчанию (как в UI)
+DEFAULT_CATEGORIES = [
+    "Деловое предложение",
+    "Жалоба клиента",
+    "Техническая поддержка",
+    "Финансовый запрос",
+    "Спам / Реклама",
+    "HR / Рекрутинг",
+    "Юридическое письмо",
+    "Новости / Анонсы",
+    "Маркетинг / Продажи",
+    "Личное сообщение",
+    "Не определена"
+]
+
 # ========== ENHANCED TEXT PROCESSOR ==========
 class EnhancedTextProcessor:
     """Улучшенная обработка текста"""
@@ -68,82 +140,8 @@ class EnhancedTextProcessor:
     
     @staticmethod
     def extract_features(text: str) -> Dict:
-        """Извлечение фич из текста"""
-        features = {
-            'char_count': len(text),
-            'word_count': len(text.split()),
-            'sentence_count': len(re.split(r'[.!?]+', text)),
-            'exclamation_count': text.count('!'),
-            'question_count': text.count('?'),
-            'uppercase_ratio': sum(1 for c in text if c.isupper()) / max(len(text), 1),
-            'digit_count': sum(c.isdigit() for c in text),
-            'has_greeting': any(word in text.lower() for word in 
-                              ['уважаемый', 'уважаемая', 'здравствуйте', 'добрый день',
-                               'привет', 'дорогой', 'дорогая', 'hello', 'hi', 'dear']),
-            'has_thanks': any(word in text.lower() for word in 
-                             ['спасибо', 'благодарю', 'thank you', 'thanks', 'благодарность']),
-            'has_urgent': any(word in text.lower() for word in 
-                             ['срочно', 'urgent', 'asap', 'немедленно', 'важно', 'important']),
-            'has_meeting': any(word in text.lower() for word in 
-                              ['встреча', 'звонок', 'совещание', 'конференция',
-                               'meeting', 'call', 'conference']),
-            'has_date': bool(re.search(r'\d{1,2}[-./]\d{1,2}[-./]\d{2,4}', text)),
-            'has_time': bool(re.search(r'\d{1,2}[:]\d{2}', text)),
-            'has_money': bool(re.search(r'\$\d+|€\d+|£\d+|\d+\s*(руб|р\.|долл|евро)', text.lower())),
-            'has_url': bool(re.search(r'https?://\S+|www\.\S+', text)),
-            'has_email': bool(re.search(r'\S+@\S+\.\S+', text))
-        }
-        
-        # Эмоциональные фичи
-        positive_words = ['отличн', 'хорош', 'прекрасн', 'супер', 'great', 'good', 'excellent', 'спасиб']
-        negative_words = ['плох', 'ужасн', 'кошмар', 'разочарован', 'bad', 'terrible', 'disappointed', 'жалоб']
-        
-        features['positive_score'] = sum(text.lower().count(word) for word in positive_words)
-        features['negative_score'] = sum(text.lower().count(word) for word in negative_words)
-        
-        # Расчетные фичи
-        if features['word_count'] > 0:
-            features['sentiment_ratio'] = (
-                features['positive_score'] - features['negative_score']
-            ) / features['word_count']
-            
-            # Формальность
-            formal_words = ['прошу', 'предлагаю', 'сообщаю', 'уведомляю', 'информирую']
-            informal_words = ['привет', 'пока', 'ок', 'ладно', 'чё', 'ага']
-            
-            features['formal_score'] = sum(text.lower().count(word) for word in formal_words)
-            features['informal_score'] = sum(text.lower().count(word) for word in informal_words)
-            
-            if features['formal_score'] + features['informal_score'] > 0:
-                features['formality_ratio'] = features['formal_score'] / (
-                    features['formal_score'] + features['informal_score']
-                )
-            else:
-                features['formality_ratio'] = 0.5
-        else:
-            features['sentiment_ratio'] = 0
-            features['formality_ratio'] = 0.5
-        
-        # Сложность текста
-        if features['word_count'] > 0:
-            words = text.split()
-            avg_word_len = np.mean([len(w) for w in words]) if words else 0
-            unique_words = len(set(words))
-            ttr = unique_words / features['word_count'] if features['word_count'] > 0 else 0
-            
-            features['text_complexity'] = min(
-                (avg_word_len * 0.3 + features['sentence_count'] * 0.4 + ttr * 0.3) / 10, 
-                1.0
-            )
-        else:
-            features['text_complexity'] = 0
-        
-        features['is_short'] = features['word_count'] < 20
-        features['is_long'] = features['word_count'] > 500
-        features['has_questions'] = features['question_count'] > 0
-        features['is_emotional'] = features['exclamation_count'] > 2
-        
-        return features
+        """Извлечение фич из текста (словари - за один проход, см. text_features.py)"""
+        return feature_extractor.extract(text)
 
 # ========== EMAIL PROCESSOR ==========
 class EmailProcessor:
@@ -155,7 +153,9 @@ class EmailProcessor:
     def parse_email(self, file_content: bytes, filename: str) -> Dict:
         """Парсинг email файлов с улучшенной обработкой"""
         try:
+            timer = StageTimer()
             content = file_content.decode('utf-8', errors='ignore')
+            timer.lap('decode')
             
             # Базовый парсинг
             subject = "Без темы"
@@ -183,9 +183,11 @@ class EmailProcessor:
                     break
             
             body = '\n'.join(lines[body_start:]) if body_start < len(lines) else content
+            timer.lap('header_parse')
             
             # Очистка и извлечение фич
             cleaned_text = self.text_processor.clean_email_text(body)
+            timer.lap('clean')
             features = self.text_processor.extract_features(cleaned_text)
             
             # Определение языка (простой способ)
@@ -201,6 +203,7 @@ class EmailProcessor:
                 language = 'mixed'
             
             full_text = f"Subject: {subject}\nFrom: {from_addr}\nTo: {to_addr}\nDate: {date}\n\n{body}"
+            timer.lap('features')
             
             return {
                 'filename': filename,
@@ -217,11 +220,13 @@ class EmailProcessor:
                 'char_count': len(body),
                 'success': True,
                 'file_type': filename.split('.')[-1] if '.' in filename else 'txt',
-                'has_attachments': 'Content-Disposition: attachment' in content.lower()
+                'has_attachments': 'Content-Disposition: attachment' in content.lower(),
+                'timings_ms': timer.publish()
             }
             
         except Exception as e:
             logger.error(f"Ошибка парсинга {filename}: {str(e)}")
+            metrics.ERRORS.inc('parse')
             return {
                 'filename': filename,
                 'error': str(e),
@@ -229,26 +234,301 @@ class EmailProcessor:
             }
 
 # ========== ZERO-SHOT ML CLASSIFIER ==========
+class _Shared:
+    """Атрибут классификатора, общий для всех его профилей (хранится в _shared)"""
+    
+    def __set_name__(self, owner, name):
+        self.name = name
+    
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return getattr(obj._shared, self.name)
+    
+    def __set__(self, obj, value):
+        setattr(obj._shared, self.name, value)
+
+
 class ZeroShotMailClassifier:
-    """Настоящий zero-shot классификатор с Sentence Transformers"""
+    """Настоящий zero-shot классификатор с Sentence Transformers
     
-    def __init__(self, model_name: str = "paraphrase-multilingual-MiniLM-L12-v2"):
+    Модель, кэши, хранилище эмбеддингов и few-shot банк общие для процесса.
+    Категории, порог и режим - лёгкое состояние профиля: profile() выдаёт
+    представление с собственными настройками поверх той же модели.
+    """
+    
+    # Тяжёлое и общее состояние: одно на классификатор и все его профили
+    model = _Shared()
+    model_name = _Shared()
+    model_loaded = _Shared()
+    backend = _Shared()
+    device = _Shared()
+    load_state = _Shared()
+    cold_start_ms = _Shared()
+    warmup_ms = _Shared()
+    _load_lock = _Shared()
+    _ready_event = _Shared()
+    _load_thread = _Shared()
+    cache = _Shared()
+    feature_processor = _Shared()
+    embedding_store = _Shared()
+    projector = _Shared()
+    few_shot = _Shared()
+    few_shot_dir = _Shared()
+    _autosave_timer = _Shared()
+    _autosave_lock = _Shared()
+    near_duplicates = _Shared()
+    inference_profile = _Shared()
+    cascade = _Shared()
+    _cascade_id = _Shared()
+    encode_batch_size = _Shared()
+    _hit_latency_ms = _Shared()
+    _miss_latency_ms = _Shared()
+    _name_vectors = _Shared()
+    _vector_epoch = _Shared()
+    _profiles = _Shared()
+    _profiles_lock = _Shared()
+    
+    def __init__(self, model_name: str = "paraphrase-multilingual-MiniLM-L12-v2", cache=None,
+                 load_mode: str = None, backend: str = None):
+        self._shared = types.SimpleNamespace()
         self.model_name = model_name
+        self.backend = backend or INFERENCE_BACKEND
         self.model = None
         self.model_loaded = False
+        
+        # Состояние ленивой загрузки модели
+        self.load_state = "not_loaded"  # not_loaded / loading / ready / failed
+        self.cold_start_ms = None
+        self.warmup_ms = None
+        self._load_lock = threading.Lock()
+        self._ready_event = threading.Event()
+        self._load_thread = None
+        
+        # Профиль инференса узла применяется при загрузке модели
+        self.inference_profile = None
+        self.encode_batch_size = ENCODE_BATCH_SIZE
+        
+        # Few-shot примеры: эмбеддинги кодируются один раз, центроиды - по суммам
+        self.few_shot = FewShotBank()
+        self._autosave_timer = None
+        self._autosave_lock = threading.Lock()
+        atexit.register(self.flush_few_shot_bank)
+        
+        # Кэш результатов: любой объект с get/set/clear/stats/__len__ (ключ включает контекст профиля)
+        self.cache = cache if cache is not None else ResultCache(
+            max_entries=RESULT_CACHE_MAX_ENTRIES,
+            max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024),
+            policy=RESULT_CACHE_POLICY,
+            ttl_seconds=RESULT_CACHE_TTL
+        )
+        self.feature_processor = EnhancedTextProcessor()
+        
+        # Векторы названий категорий - общие для профилей; эпоха растёт при смене пространства
+        self._name_vectors = {}
+        self._vector_epoch = 0
+        
+        # Профили: (категории, порог, режим, k) -> представление, вытеснение LRU
+        self._profiles = OrderedDict()
+        self._profiles_lock = threading.Lock()
+        
+        # Задержки попаданий и промахов кэша (последние N запросов, мс)
+        self._hit_latency_ms = deque(maxlen=1000)
+        self._miss_latency_ms = deque(maxlen=1000)
+        
+        # Индекс почти-дубликатов: результат похожего письма без прохода модели
+        self.near_duplicates = None
+        if NEAR_DUP_THRESHOLD > 0:
+            self.set_near_duplicate_threshold(NEAR_DUP_THRESHOLD)
+        
+        # Каскад дешёвых уровней перед трансформером (опционально)
+        self.cascade = None
+        self._cascade_id = ''
+        if CASCADE_ENABLED:
+            self.enable_cascade(CASCADE_RULE_CUTOFF, CASCADE_LEXICAL_MODEL or None, CASCADE_LEXICAL_CUTOFF,
+                                CASCADE_DISTILLED_MODEL or None,
+                                CASCADE_DISTILLED_CUTOFF)
+        
+        # Персистентное хранилище эмбеддингов писем (опционально)
+        self.embedding_store = None
+        self.projector = None
+        
+        # Устройство определяется при загрузке модели (требует torch)
+        self.device = None
+        self.few_shot_dir = FEW_SHOT_BANK_DIR or None
+        
+        self._init_profile_state()
+        self._update_category_version()
+        
+        # Проекция в пространство меньшей размерности (опционально)
+        if EMBEDDING_PROJECTOR_PATH:
+            self.load_projector(EMBEDDING_PROJECTOR_PATH)
+        
+        if EMBEDDING_STORE_PATH:
+            self.enable_embedding_store(EMBEDDING_STORE_PATH, EMBEDDING_STORE_DTYPE)
+        
+        # Сохранённый few-shot банк: эмбеддинги через mmap, модель не нужна
+        if self.few_shot_dir:
+            self.load_few_shot_bank(self.few_shot_dir)
+        
+        load_mode = load_mode or MODEL_LOAD_MODE
+        if load_mode == "eager":
+            self.warmup()
+        elif load_mode == "background":
+            self.load_in_background()
+        
+        logger.info(f"Zero-shot классификатор инициализирован (загрузка модели: {load_mode})")
+    
+    def _init_profile_state(self):
+        """Собственное состояние профиля: категории, порог, режим и матрица категорий"""
         self.categories = []
         self.threshold = 0.35
-        self.few_shot_examples = {}
-        self.cache = {}
-        self.feature_processor = EnhancedTextProcessor()
+        self.mode = CLASSIFIER_MODE if CLASSIFIER_MODE in SUPPORTED_MODES else 'centroid'
+        self.knn_k = max(1, KNN_K)
+        self._knn_row_categories = None   # (версия категорий, индексы категорий строк банка)
+        
+        # Матрица нормализованных эмбеддингов категорий (n_categories x dim, float32)
+        self.category_matrix = None
+        self._category_vectors = {}
+        
+        # Версия набора категорий и few-shot примеров (входит в ключ кэша)
+        self.category_version = ""
+        self._cache_key_base = None
+        self._base_cascade_id = ''
+        self._result_context = ""
+        self._synced_token = None     # (эпоха векторов, версия банка), с которыми собрана матрица
+        self._state_lock = threading.RLock()
+    
+    def profile(self, categories: List[str], threshold: float = None,
+                mode: str = None, knn_k: int = None) -> 'ZeroShotMailClassifier':
+        """Представление с собственными категориями, порогом и режимом поверх общей модели
+        
+        Профили с одинаковыми настройками переиспользуются, поэтому их запросы
+        попадают в общие пакеты и кэш. Профиль не меняют после создания:
+        другие настройки - другой профиль. Few-shot банк общий: примеры,
+        добавленные через любой профиль, видны всем.
+        """
+        categories = [cat.strip() for cat in categories if cat.strip()]
+        threshold = self.threshold if threshold is None else max(0.01, min(0.99, threshold))
+        mode = mode or self.mode
+        if mode not in SUPPORTED_MODES:
+            raise ValueError(f"Неизвестный режим классификации: {mode}")
+        knn_k = max(1, int(knn_k or self.knn_k))
+        key = (tuple(categories), round(threshold, 6), mode, knn_k)
+        
+        with self._profiles_lock:
+            view = self._profiles.get(key)
+            if view is not None:
+                self._profiles.move_to_end(key)
+                return view
+        
+        view = object.__new__(type(self))
+        view._shared = self._shared
+        view._init_profile_state()
+        view.categories = categories
+        view.threshold = threshold
+        view.mode = mode
+        view.knn_k = knn_k
+        view._rebuild_category_matrix()
+        view._update_category_version()
+        
+        with self._profiles_lock:
+            view = self._profiles.setdefault(key, view)
+            self._profiles.move_to_end(key)
+            while len(self._profiles) > PROFILE_CACHE_SIZE:
+                self._profiles.popitem(last=False)
+        return view
+    
+    def _sync_shared_state(self):
+        """Догоняем общий few-shot банк и пространство эмбеддингов, изменённые через другой профиль"""
+        if self._synced_token == (self._vector_epoch, self.few_shot.version):
+            return
+        with self._state_lock:
+            if self._synced_token == (self._vector_epoch, self.few_shot.version):
+                return
+            # Названия берутся из общего кэша, центроиды - из сумм банка: кодирования нет
+            self._category_vectors.clear()
+            self.category_matrix = None
+            self._knn_row_categories = None
+            self._rebuild_category_matrix()
+            self._update_category_version()
+    
+    @property
+    def is_ready(self) -> bool:
+        """Готовность: попытка загрузки завершена (модель или демо-режим)"""
+        return self._ready_event.is_set()
+    
+    def warmup(self) -> bool:
+        """Явная загрузка модели и прогрев первым кодированием"""
+        self._ensure_model()
+        
+        if self.model_loaded and self.warmup_ms is None:
+            start = time.perf_counter()
+            try:
+                self._encode(["warmup"])
+                self._rebuild_category_matrix()
+            except Exception as e:
+                logger.error(f"Ошибка прогрева модели: {e}")
+            self.warmup_ms = (time.perf_counter() - start) * 1000
+            logger.info(f"🔥 Модель прогрета за {self.warmup_ms:.0f} мс")
         
-        # Информация о системе
-        self.device = self._get_device()
+        return self.model_loaded
+    
+    def load_in_background(self) -> threading.Thread:
+        """Загрузка модели в фоновом потоке (повторный вызов ничего не делает)"""
+        with self._load_lock:
+            if self._load_thread is None and not self._ready_event.is_set():
+                self._load_thread = threading.Thread(
+                    target=self.warmup, name="maillens-model-loader", daemon=True
+                )
+                self._load_thread.start()
+        return self._load_thread
+    
+    def wait_until_ready(self, timeout: float = None) -> bool:
+        """Ожидание завершения загрузки модели"""
+        return self._ready_event.wait(timeout)
+    
+    def _ensure_model(self):
+        """Ленивая загрузка модели при первом обращении (потокобезопасно)"""
+        if self._ready_event.is_set():
+            return
         
-        # Попытка загрузить модель
-        self._try_load_model()
+        with self._load_lock:
+            if self._ready_event.is_set():
+                return
+            
+            self.load_state = "loading"
+            start = time.perf_counter()
+            self.device = self._get_device()
+            self._apply_inference_profile()
+            self._try_load_model()
+            self.cold_start_ms = (time.perf_counter() - start) * 1000
+            
+            self.load_state = "ready" if self.model_loaded else "failed"
+            self._cache_key_base = None
+            self._ready_event.set()
+            logger.info(f"Холодный старт модели: {self.cold_start_ms:.0f} мс. Устройство: {self.device}")
+    
+    def _apply_inference_profile(self):
+        """Потоки и размер пакета из профиля autotune.py для этого типа узла (только CPU)"""
+        if not INFERENCE_PROFILE_PATH or not os.path.exists(INFERENCE_PROFILE_PATH):
+            return
+        if self.device != 'cpu':
+            # Профиль подобран замерами на CPU: для cuda/mps его потоки и пакет не подходят
+            logger.info(f"Профиль инференса не применяется на устройстве {self.device}")
+            return
         
-        logger.info(f"Zero-shot классификатор инициализирован. Устройство: {self.device}")
+        profile = load_profile_for_node(INFERENCE_PROFILE_PATH, self.model_name, self.backend)
+        if profile is None:
+            return
+        if self.backend == 'torch':
+            apply_thread_settings(profile)
+        self.encode_batch_size = int(profile.get('batch_size') or self.encode_batch_size)
+        self.inference_profile = profile
+        logger.info(
+            f"⚙️ Профиль инференса: пакет {self.encode_batch_size}, потоки {profile.get('num_threads')}, "
+            f"межоператорные {profile.get('interop_threads')}"
+        )
     
     def _get_device(self):
         """Определение доступного устройства"""
@@ -264,20 +544,27 @@ class ZeroShotMailClassifier:
             return "cpu"
     
     def _try_load_model(self):
-        """Попытка загрузить модель Sentence Transformers"""
+        """Попытка загрузить модель Sentence Transformers на выбранном бэкенде"""
         try:
-            logger.info(f"🔄 Пытаюсь загрузить Sentence Transformers модель: {self.model_name}")
+            logger.info(f"🔄 Пытаюсь загрузить Sentence Transformers модель: {self.model_name} ({self.backend})")
             
-            from sentence_transformers import SentenceTransformer
+            from inference_backends import create_backend
             
-            if self.device == "cuda":
-                self.model = SentenceTransformer(self.model_name, device='cuda')
-            else:
-                self.model = SentenceTransformer(self.model_name)
+            try:
+                num_threads = (self.inference_profile or {}).get('num_threads')
+                self.model = create_backend(self.backend, self.model_name, self.device,
+                                            num_threads=num_threads)
+            except Exception as e:
+                # ImportError тоже: без onnxruntime/transformers переходим на torch
+                if self.backend == 'torch':
+                    raise
+                logger.error(f"❌ Бэкенд {self.backend} недоступен ({e}), использую torch")
+                self.backend = 'torch'
+                self.model = create_backend('torch', self.model_name, self.device)
             
             self.model_loaded = True
             logger.info(f"✅ Sentence Transformers модель загружена на {self.device}")
-            logger.info(f"   Модель: {self.model_name}")
+            logger.info(f"   Модель: {self.model_name}, бэкенд: {self.backend}")
             logger.info(f"   Zero-shot классификация доступна!")
             
         except ImportError:
@@ -290,25 +577,453 @@ class ZeroShotMailClassifier:
             self.model_loaded = False
             self.model_name = "demo-mode"
     
+    @property
+    def embedding_model_id(self) -> str:
+        """Идентификатор пространства эмбеддингов (модель + бэкенд, если не torch, + проекция)"""
+        model_id = self.model_name if self.backend == 'torch' else f"{self.model_name}:{self.backend}"
+        if self.projector is not None:
+            model_id = f"{model_id}|{self.projector.id}"
+        return model_id
+    
+    def load_projector(self, path: str):
+        """Загрузка сохранённой проекции эмбеддингов"""
+        try:
+            from compact_embeddings import EmbeddingProjector
+            projector = EmbeddingProjector.load(path)
+        except Exception as e:
+            logger.error(f"❌ Не удалось загрузить проекцию эмбеддингов {path}: {e}")
+            return
+        
+        if projector.source_model and projector.source_model != self.model_name:
+            logger.error(
+                f"❌ Проекция {path} обучена для модели {projector.source_model}, "
+                f"а используется {self.model_name} - проекция отключена"
+            )
+            return
+        self.set_projector(projector)
+    
+    def set_projector(self, projector):
+        """Смена проекции: все векторы (категории, few-shot) пересчитываются в новом пространстве"""
+        with self._state_lock:
+            self.projector = projector
+            self._name_vectors = {}
+            self._vector_epoch += 1   # профили пересоберут матрицы при следующем запросе
+            self._category_vectors.clear()
+            self.category_matrix = None
+            self._knn_row_categories = None
+            
+            # Векторы банка были в старом пространстве - примеры уходят в очередь на кодирование
+            if len(self.few_shot):
+                bank = FewShotBank()
+                for category, texts in self.few_shot.examples().items():
+                    for text in texts:
+                        bank.add(category, text)
+                self.few_shot = bank
+                self._rebuild_category_matrix()
+                self._autosave_few_shot()
+            else:
+                self._rebuild_category_matrix()
+            self._update_category_version()
+        if projector is not None:
+            logger.info(f"Проекция эмбеддингов: {projector.id} ({projector.method}, {projector.dim} измерений)")
+    
+    def enable_embedding_store(self, path: str, dtype: str = "float16"):
+        """Подключение персистентного хранилища эмбеддингов"""
+        try:
+            from embedding_store import EmbeddingStore
+            self.embedding_store = EmbeddingStore(path, dtype=dtype)
+        except Exception as e:
+            logger.error(f"❌ Не удалось открыть хранилище эмбеддингов {path}: {e}")
+            self.embedding_store = None
+    
     def set_threshold(self, threshold: float):
         """Установка порога уверенности"""
-        self.threshold = max(0.01, min(0.99, threshold))
+        with self._state_lock:
+            self.threshold = max(0.01, min(0.99, threshold))
+            self._cache_key_base = None
         logger.info(f"Порог уверенности установлен: {self.threshold:.2f}")
     
+    def set_near_duplicate_threshold(self, threshold: float):
+        """Порог сходства почти-дубликатов (0 - индекс отключён)"""
+        if not threshold:
+            self.near_duplicates = None
+            logger.info("Индекс почти-дубликатов отключён")
+            return
+        self.near_duplicates = NearDuplicateIndex(threshold=threshold, max_entries=NEAR_DUP_MAX_ENTRIES)
+        logger.info(f"Индекс почти-дубликатов: порог {threshold:.2f}, "
+                    f"до {self.near_duplicates.max_distance} отличающихся битов")
+    
+    def set_cascade(self, cascade):
+        """Каскад перед трансформером (None - все письма идут в модель)"""
+        self.cascade = cascade
+        # Результаты каскада другие - меняется контекст кэша всех профилей
+        self._cascade_id = cascade.id if cascade is not None else ''
+    
+    def enable_cascade(self, rule_cutoff: float = CASCADE_RULE_CUTOFF, lexical_model_path: str = None,
+                       lexical_cutoff: float = CASCADE_LEXICAL_CUTOFF, distilled_model_path: str = None,
+                       distilled_cutoff: float = CASCADE_DISTILLED_CUTOFF):
+        """Каскад: правила, лексическая модель и ученик трансформера (если заданы пути) с порогами уверенности"""
+        from cascade import ClassificationCascade, HashedNaiveBayes
+        
+        lexical = None
+        if lexical_model_path:
+            try:
+                lexical = HashedNaiveBayes.load(lexical_model_path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"❌ Лексическая модель каскада не загружена ({lexical_model_path}): {e}")
+        distilled = None
+        if distilled_model_path:
+            try:
+                from distillation import DistilledClassifier
+                distilled = DistilledClassifier.load(distilled_model_path)
+            except (ImportError, OSError, ValueError, KeyError) as e:
+                logger.error(f"❌ Ученик трансформера не загружен ({distilled_model_path}): {e}")
+        cascade = ClassificationCascade(lexical=lexical, rule_cutoff=rule_cutoff, lexical_cutoff=lexical_cutoff,
+                                        distilled=distilled, distilled_cutoff=distilled_cutoff)
+        self.set_cascade(cascade)
+        logger.info(f"Каскад включён: правила >= {rule_cutoff:.2f}, "
+                    f"лексика >= {lexical_cutoff:.2f}" + ("" if lexical else " (модель не задана)") +
+                    (f", ученик >= {cascade.distilled_cutoff:.3f}" if distilled else ""))
+    
+    def set_mode(self, mode: str, k: int = None):
+        """Режим классификации: centroid или knn (k ближайших примеров)"""
+        if mode not in SUPPORTED_MODES:
+            raise ValueError(f"Неизвестный режим классификации: {mode}")
+        with self._state_lock:
+            self.mode = mode
+            if k is not None:
+                self.knn_k = max(1, int(k))
+            self._cache_key_base = None
+        logger.info(f"Режим классификации: {self.mode}" + (f" (k={self.knn_k})" if mode == 'knn' else ""))
+    
     def set_categories(self, categories: List[str]):
         """Установка категорий для zero-shot классификации"""
-        self.categories = [cat.strip() for cat in categories if cat.strip()]
+        with self._state_lock:
+            self.categories = [cat.strip() for cat in categories if cat.strip()]
+            self._rebuild_category_matrix()
+            self._update_category_version()
         logger.info(f"Установлено категорий для zero-shot: {len(self.categories)}")
     
-    def add_few_shot_example(self, category: str, example_text: str):
-        """Добавление few-shot примера"""
-        if category not in self.few_shot_examples:
-            self.few_shot_examples[category] = []
+    def add_category(self, category: str):
+        """Добавление одной категории с дозаписью строки в матрицу"""
+        category = category.strip()
+        if not category or category in self.categories:
+            return
         
+        with self._state_lock:
+            # Новый список, а не append: параллельные запросы видят старый или новый целиком
+            self.categories = self.categories + [category]
+            if self.model_loaded and self.category_matrix is not None:
+                try:
+                    vector = self._category_vector(category)
+                    self._category_vectors[category] = vector
+                    self.category_matrix = np.ascontiguousarray(
+                        np.vstack([self.category_matrix, vector[np.newaxis, :]]), dtype=np.float32
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка кодирования категории {category}: {e}")
+                    self.category_matrix = None
+            else:
+                self._rebuild_category_matrix()
+            self._update_category_version()
+        logger.info(f"Добавлена категория: {category}")
+    
+    def remove_category(self, category: str):
+        """Удаление одной категории с удалением строки из матрицы"""
+        if category not in self.categories:
+            return
+        
+        with self._state_lock:
+            idx = self.categories.index(category)
+            self.categories = self.categories[:idx] + self.categories[idx + 1:]
+            self._category_vectors.pop(category, None)
+            if self.category_matrix is not None:
+                if self.categories:
+                    self.category_matrix = np.ascontiguousarray(
+                        np.delete(self.category_matrix, idx, axis=0), dtype=np.float32
+                    )
+                else:
+                    self.category_matrix = None
+            self._update_category_version()
+        logger.info(f"Удалена категория: {category}")
+    
+    @property
+    def few_shot_examples(self) -> Dict[str, List[str]]:
+        """Тексты few-shot примеров по категориям"""
+        return self.few_shot.examples()
+    
+    def add_few_shot_example(self, category: str, example_text: str):
+        """Добавление few-shot примера: одно кодирование, строка матрицы обновляется на месте"""
         clean_text = self.feature_processor.clean_email_text(example_text)
-        self.few_shot_examples[category].append(clean_text)
+        if (category, clean_text) in self.few_shot:
+            logger.info(f"Few-shot пример уже есть в категории: {category}")
+            return
+        
+        vector = None
+        if self.model_loaded:
+            try:
+                vector = self._encode([clean_text])[0]
+            except Exception as e:
+                logger.error(f"Ошибка кодирования few-shot примера {category}: {e}")
+        
+        # Без модели пример закодируется при сборке матрицы
+        self.few_shot.add(category, clean_text, vector)
+        if vector is not None:
+            self._refresh_category_row(category)
+        self._update_category_version()
+        self._autosave_few_shot()
         logger.info(f"Добавлен few-shot пример для категории: {category}")
     
+    def remove_few_shot_example(self, category: str, example_text: str) -> bool:
+        """Удаление few-shot примера (исходный или очищенный текст)"""
+        removed = self.few_shot.remove(category, example_text)
+        if not removed:
+            clean_text = self.feature_processor.clean_email_text(example_text)
+            removed = self.few_shot.remove(category, clean_text)
+        if not removed:
+            return False
+        
+        self._refresh_category_row(category)
+        self._update_category_version()
+        self._autosave_few_shot()
+        logger.info(f"Удалён few-shot пример категории: {category}")
+        return True
+    
+    def import_few_shot_csv(self, source, text_column: str = 'text', category_column: str = 'category',
+                            batch_size: int = 64) -> int:
+        """Массовый импорт размеченных примеров из CSV с кодированием пакетами"""
+        self._ensure_model()
+        added = 0
+        changed = set()
+        batch = []
+        
+        def flush():
+            nonlocal added
+            items = list(dict.fromkeys(batch))  # дубликаты внутри пакета
+            items = [item for item in items if item not in self.few_shot]
+            batch.clear()
+            if not items:
+                return
+            if self.model_loaded:
+                vectors = self._encode([text for _, text in items], batch_size=batch_size)
+                added += self.few_shot.add_many(items, vectors)
+            else:
+                added += sum(self.few_shot.add(category, text) for category, text in items)
+            changed.update(category for category, _ in items)
+        
+        for category, text in read_labeled_csv(source, text_column, category_column):
+            batch.append((category, self.feature_processor.clean_email_text(text)))
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+        
+        if changed:
+            self._rebuild_category_matrix(changed=sorted(changed))
+            self._update_category_version()
+            self._autosave_few_shot()
+        logger.info(f"Импортировано few-shot примеров: {added} ({len(changed)} категорий)")
+        return added
+    
+    def save_few_shot_bank(self, directory: str = None):
+        """Сохранение few-shot банка на диск"""
+        directory = directory or self.few_shot_dir
+        if not directory:
+            raise ValueError("Не задан каталог few-shot банка")
+        self.few_shot.save(directory, self.embedding_model_id)
+    
+    def load_few_shot_bank(self, directory: str = None):
+        """Загрузка few-shot банка; векторы категорий берутся из сохранённых сумм"""
+        directory = directory or self.few_shot_dir
+        start = time.perf_counter()
+        try:
+            self.few_shot = FewShotBank.load(directory, self.embedding_model_id)
+        except Exception as e:
+            logger.error(f"❌ Не удалось загрузить few-shot банк {directory}: {e}")
+            return
+        
+        self._category_vectors.clear()
+        self.category_matrix = None
+        self._knn_row_categories = None
+        self._rebuild_category_matrix()
+        self._update_category_version()
+        logger.info(
+            f"Few-shot банк загружен: {len(self.few_shot)} примеров "
+            f"за {(time.perf_counter() - start) * 1000:.1f} мс"
+        )
+    
+    def _autosave_few_shot(self):
+        """Отложенное сохранение банка: серия изменений пишется на диск один раз"""
+        if not self.few_shot_dir:
+            return
+        if FEW_SHOT_AUTOSAVE_DELAY_S <= 0:
+            self._save_few_shot_quietly()
+            return
+        with self._autosave_lock:
+            if self._autosave_timer is not None:
+                return
+            self._autosave_timer = threading.Timer(FEW_SHOT_AUTOSAVE_DELAY_S, self.flush_few_shot_bank)
+            self._autosave_timer.daemon = True
+            self._autosave_timer.start()
+    
+    def flush_few_shot_bank(self):
+        """Немедленное сохранение отложенных изменений банка (если они есть)"""
+        with self._autosave_lock:
+            timer, self._autosave_timer = self._autosave_timer, None
+        if timer is None:
+            return
+        timer.cancel()
+        self._save_few_shot_quietly()
+    
+    def _save_few_shot_quietly(self):
+        if not self.few_shot_dir:
+            return
+        try:
+            self.save_few_shot_bank()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения few-shot банка: {e}")
+    
+    def _refresh_category_row(self, category: str):
+        """Пересчёт вектора категории и замена её строки в копии матрицы"""
+        with self._state_lock:
+            self._category_vectors.pop(category, None)
+            if not self.model_loaded or category not in self.categories:
+                return
+            
+            try:
+                vector = self._category_vector(category)
+                self._category_vectors[category] = vector
+                if self.category_matrix is not None and self.category_matrix.shape[0] == len(self.categories):
+                    # Копия, а не запись на месте: матрицу может читать параллельный запрос
+                    matrix = self.category_matrix.copy()
+                    matrix[self.categories.index(category)] = vector
+                    self.category_matrix = matrix
+            except Exception as e:
+                logger.error(f"Ошибка обновления вектора категории {category}: {e}")
+                self.category_matrix = None
+    
+    def _update_category_version(self):
+        """Пересчёт версии набора категорий по их содержимому и few-shot примерам"""
+        digest = hashlib.blake2b(digest_size=16)
+        for category in self.categories:
+            digest.update(category.encode('utf-8', errors='surrogatepass'))
+            digest.update(b'\0')
+        bank_version = self.few_shot.version
+        digest.update(bank_version.encode('ascii'))
+        self.category_version = digest.hexdigest()
+        self._synced_token = (self._vector_epoch, bank_version)
+        self._cache_key_base = None
+    
+    def _encode(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        """Кодирование текстов в нормализованные float32 эмбеддинги"""
+        embeddings = self.model.encode(
+            texts,
+            batch_size=batch_size or self.encode_batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        if self.projector is not None:
+            return self.projector.project(embeddings)
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+    
+    def _encode_texts(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        """Эмбеддинги писем: из хранилища, модель - только для новых текстов"""
+        if self.embedding_store is None:
+            return self._encode(texts, batch_size=batch_size)
+        
+        keys = [self.embedding_store.make_key(text, self.embedding_model_id) for text in texts]
+        try:
+            stored = self.embedding_store.get_many(keys)
+        except Exception as e:
+            logger.error(f"Ошибка чтения хранилища эмбеддингов: {e}")
+            stored = {}
+        
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in stored:
+                missing.setdefault(key, text)
+        
+        if missing:
+            encoded = self._encode(list(missing.values()), batch_size=batch_size)
+            new_vectors = dict(zip(missing.keys(), encoded))
+            try:
+                self.embedding_store.put_many(new_vectors, self.embedding_model_id)
+            except Exception as e:
+                logger.error(f"Ошибка записи в хранилище эмбеддингов: {e}")
+            stored.update(new_vectors)
+        
+        embeddings = np.stack([stored[key] for key in keys]).astype(np.float32)
+        
+        # float16/int8 в хранилище слегка сбивают норму - восстанавливаем
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return np.ascontiguousarray(embeddings / np.maximum(norms, 1e-12), dtype=np.float32)
+    
+    def _category_vector(self, category: str) -> np.ndarray:
+        """Нормализованный вектор категории: центроид few-shot примеров или название"""
+        centroid = self.few_shot.centroid(category)
+        if centroid is not None:
+            return centroid
+        vector = self._name_vectors.get(category)
+        if vector is None:
+            vector = self._name_vectors[category] = self._encode([category])[0]
+        return vector
+    
+    def _rebuild_category_matrix(self, changed: List[str] = None):
+        """Сборка матрицы категорий: кодируются только категории без готового вектора"""
+        if not self.model_loaded:
+            return
+        
+        # Примеры, добавленные до загрузки модели, кодируем одним пакетом
+        try:
+            changed = list(changed or []) + self.few_shot.encode_pending(self._encode)
+        except Exception as e:
+            logger.error(f"Ошибка кодирования few-shot примеров: {e}")
+            changed = list(changed or [])
+        
+        for category in changed:
+            self._category_vectors.pop(category, None)
+        
+        # Векторы удалённых категорий больше не нужны
+        for category in list(self._category_vectors):
+            if category not in self.categories:
+                del self._category_vectors[category]
+        
+        try:
+            missing = [c for c in self.categories if c not in self._category_vectors]
+            
+            # Названия без few-shot кодируем одним батчем; общий кэш названий - для всех профилей
+            names_only = [c for c in missing if self.few_shot.centroid(c) is None]
+            to_encode = [c for c in names_only if c not in self._name_vectors]
+            if to_encode:
+                for category, vector in zip(to_encode, self._encode(to_encode)):
+                    self._name_vectors[category] = vector
+            for category in names_only:
+                self._category_vectors[category] = self._name_vectors[category]
+            
+            for category in missing:
+                if category not in self._category_vectors:
+                    self._category_vectors[category] = self._category_vector(category)
+            
+            if self.categories:
+                self.category_matrix = np.ascontiguousarray(
+                    np.stack([self._category_vectors[c] for c in self.categories]), dtype=np.float32
+                )
+            else:
+                self.category_matrix = None
+        except Exception as e:
+            logger.error(f"Ошибка построения матрицы категорий: {e}")
+            self.category_matrix = None
+    
+    def _ensure_category_matrix(self) -> np.ndarray:
+        """Матрица категорий, согласованная с текущим списком категорий"""
+        if self.category_matrix is None or self.category_matrix.shape[0] != len(self.categories):
+            with self._state_lock:
+                if self.category_matrix is None or self.category_matrix.shape[0] != len(self.categories):
+                    self._rebuild_category_matrix()
+        if self.category_matrix is None:
+            raise RuntimeError("Матрица категорий не построена")
+        return self.category_matrix
+    
     def classify(self, text: str, top_n: int = 5, use_cache: bool = True) -> Dict:
         """Основной метод классификации"""
         return self.classify_enhanced(text, use_ensemble=True, top_n=top_n, use_cache=use_cache)
@@ -316,101 +1031,470 @@ class ZeroShotMailClassifier:
     def classify_enhanced(self, text: str, use_ensemble: bool = True, 
                          top_n: int = 5, metadata: Dict = None, use_cache: bool = True) -> Dict:
         """Улучшенная zero-shot классификация"""
+        start_time = time.perf_counter()
+        timer = StageTimer()
+        
         # Валидация
-        if not text or len(text.strip()) < 10:
-            return self._create_result(
-                category="Текст слишком короткий",
-                confidence=0.0,
-                is_undefined=True,
-                method="input-validation"
-            )
+        invalid_result = self._validate_input(text)
+        if invalid_result is not None:
+            return invalid_result
+        self._sync_shared_state()
         
-        if not self.categories:
-            return self._create_result(
-                category="Категории не заданы",
-                confidence=0.0,
-                is_undefined=True,
-                method="no-categories"
-            )
+        # Проверка кэша до любой обработки текста
+        model_ready = self.is_ready
+        if use_cache:
+            cache_key = self._create_cache_key(text, top_n)
+            result = self.cache.get(cache_key)
+            timer.lap('cache_lookup')
+            if result is not None:
+                logger.debug("Использован кэшированный результат")
+                metrics.CACHE_HITS.inc()
+                metrics.record_result(result)
+                elapsed_ms = (time.perf_counter() - start_time) * 1000
+                self._hit_latency_ms.append(elapsed_ms)
+                # Копия: замеры относятся к этому запросу, а не к закэшированному
+                return dict(result, cached=True, processing_time_ms=elapsed_ms,
+                            timings_ms=timer.publish(elapsed_ms))
+            metrics.CACHE_MISSES.inc()
+        
+        # Почти-дубликат ранее классифицированного письма (use_cache влияет только на точный кэш)
+        fingerprint = None
+        if self.near_duplicates is not None:
+            fingerprint = self.near_duplicates.fingerprint(text)
+            match = self.near_duplicates.lookup(fingerprint, self._current_context(), top_n)
+            timer.lap('near_duplicate')
+            if match is not None:
+                result = self._near_duplicate_result(*match, text, timer)
+                if use_cache:
+                    self.cache.set(cache_key, result)
+                return result
         
         # Извлечение фич
         features = self.feature_processor.extract_features(text)
+        timer.lap('features')
+        
+        # Каскад: уверенные дешёвые уровни отвечают без трансформера
+        result = self._cascade_result(text, top_n, timer) if self.cascade is not None else None
+        if result is None:
+            result = self._model_classify(text, features, top_n, timer)
         
-        # Проверка кэша
+        # Добавление фич
+        result['features'] = features
+        result['text_complexity'] = features.get('text_complexity', 0)
+        timer.lap('result_build')
+        
+        result['timings_ms'] = timer.publish()
+        result['processing_time_ms'] = result['timings_ms']['total']
+        metrics.record_result(result)
+        
+        # Кэширование
         if use_cache:
-            cache_key = self._create_cache_key(text, features)
-            if cache_key in self.cache:
-                logger.info("Использован кэшированный результат")
-                result = self.cache[cache_key]
-                result['cached'] = True
-                return result
+            if not model_ready:
+                # Загрузка модели могла сменить её имя (демо-режим) - ключ строится заново
+                cache_key = self._create_cache_key(text, top_n)
+            self.cache.set(cache_key, result)
+            self._miss_latency_ms.append((time.perf_counter() - start_time) * 1000)
+        if fingerprint is not None and not result['method'].startswith('demo'):
+            self.near_duplicates.add(fingerprint, self._current_context(), top_n, result)
+        
+        return result
+    
+    def _model_classify(self, text: str, features: Dict, top_n: int, timer: StageTimer) -> Dict:
+        """Классификация моделью эмбеддингов (демо-режим, если модель недоступна)"""
+        self._ensure_model()
+        timer.restart()  # холодный старт модели не относится к обработке письма
         
-        # Zero-shot классификация
         if self.model_loaded:
             try:
-                result = self._zero_shot_classify(text, features, top_n)
-                result['method'] = 'zero-shot-transformer'
-                result['model_used'] = self.model_name
+                result = self._zero_shot_classify(text, features, top_n, timer)
             except Exception as e:
                 logger.error(f"Ошибка zero-shot классификации: {e}")
+                metrics.ERRORS.inc('zero_shot')
+                timer.restart()
                 result = self._demo_classify(text, features, top_n)
                 result['method'] = 'demo-fallback'
                 result['model_used'] = 'demo-mode'
+                timer.lap('similarity')
         else:
             result = self._demo_classify(text, features, top_n)
             result['method'] = 'demo-mode'
             result['model_used'] = 'demo-mode'
+            timer.lap('similarity')
         
-        # Добавление фич
-        result['features'] = features
-        result['text_complexity'] = features.get('text_complexity', 0)
-        
-        # Кэширование
-        if use_cache:
-            cache_key = self._create_cache_key(text, features)
-            self.cache[cache_key] = result
+        if self.cascade is not None:
+            self.cascade.record('transformer')
+            result['cascade_tier'] = 'transformer'
+        return result
+    
+    def _cascade_result(self, text: str, top_n: int, timer: StageTimer) -> Optional[Dict]:
+        """Результат дешёвого уровня каскада или None, если ни один не уверен"""
+        decision = self.cascade.decide(text, self.categories)
+        timer.lap('cascade')
+        if decision is None:
+            return None
         
+        tier, probabilities = decision
+        result = self._build_result(probabilities, probabilities, top_n, method=f'cascade-{tier}')
+        result['model_used'] = f'cascade-{tier}'
+        result['cascade_tier'] = tier
+        timer.lap('result_build')
         return result
     
-    def _zero_shot_classify(self, text: str, features: Dict, top_n: int) -> Dict:
-        """Настоящая zero-shot классификация с Sentence Transformers"""
-        from sentence_transformers import util
-        import torch
+    def _near_duplicate_result(self, prior: Dict, similarity: float, text: str, timer: StageTimer) -> Dict:
+        """Результат похожего письма с фичами и замерами текущего"""
+        features = self.feature_processor.extract_features(text)
+        timer.lap('features')
+        result = dict(prior, features=features, text_complexity=features.get('text_complexity', 0),
+                      cached=False, near_duplicate=True, near_duplicate_similarity=similarity)
+        result['timings_ms'] = timer.publish()
+        result['processing_time_ms'] = result['timings_ms']['total']
+        metrics.NEAR_DUPLICATE_HITS.inc()
+        metrics.record_result(result)
+        return result
+    
+    def classify_batch(self, texts: List[str], batch_size: int = None, top_n: int = 5,
+                       use_cache: bool = True) -> List[Dict]:
+        """Пакетная классификация: фичи и кэш для всех писем, один проход модели
         
-        # Кодируем текст
-        text_embedding = self.model.encode([text], convert_to_tensor=True, show_progress_bar=False)
+        Результаты совпадают с classify() для каждого письма по отдельности.
+        Время пакетного прохода модели делится поровну между письмами.
+        Почти-дубликаты внутри пакета получают результат первого такого письма.
+        """
+        self._sync_shared_state()
+        model_ready = self.is_ready
+        results: List[Optional[Dict]] = [None] * len(texts)
+        features_by_idx = {}
+        keys_by_idx = {}
+        timers = {}
+        pending = []
+        fingerprints = {}
+        followers = []   # (индекс, индекс похожего письма пакета, сходство)
+        batch_index = None
+        if self.near_duplicates is not None:
+            batch_index = NearDuplicateIndex(self.near_duplicates.threshold, max_entries=len(texts) + 1,
+                                             min_tokens=self.near_duplicates.min_tokens,
+                                             shingle_size=self.near_duplicates.shingle_size)
         
-        # Используем few-shot примеры если есть
-        category_embeddings = []
-        enhanced_categories = []
+        # Валидация и проверка кэша
+        for i, text in enumerate(texts):
+            invalid_result = self._validate_input(text)
+            if invalid_result is not None:
+                results[i] = invalid_result
+                continue
+            
+            timer = timers[i] = StageTimer()
+            if use_cache:
+                cache_key = self._create_cache_key(text, top_n)
+                keys_by_idx[i] = cache_key
+                result = self.cache.get(cache_key)
+                timer.lap('cache_lookup')
+                if result is not None:
+                    metrics.CACHE_HITS.inc()
+                    metrics.record_result(result)
+                    timings = timer.publish()
+                    self._hit_latency_ms.append(timings['total'])
+                    results[i] = dict(result, cached=True, processing_time_ms=timings['total'],
+                                      timings_ms=timings)
+                    continue
+                metrics.CACHE_MISSES.inc()
+            
+            if batch_index is not None:
+                fingerprint = self.near_duplicates.fingerprint(text)
+                match = self.near_duplicates.lookup(fingerprint, self._current_context(), top_n)
+                if match is None:
+                    match = batch_index.lookup(fingerprint, '', top_n)
+                    if match is not None:
+                        timer.lap('near_duplicate')
+                        followers.append((i, match[0]['index'], match[1]))
+                        continue
+                    batch_index.add(fingerprint, '', top_n, {'index': i})
+                timer.lap('near_duplicate')
+                if match is not None:
+                    results[i] = self._near_duplicate_result(*match, text, timer)
+                    if use_cache:
+                        self.cache.set(keys_by_idx[i], results[i])
+                    continue
+                fingerprints[i] = fingerprint
+            
+            pending.append(i)
         
-        for category in self.categories:
-            if category in self.few_shot_examples and self.few_shot_examples[category]:
-                # Используем эмбеддинги few-shot примеров
-                examples = self.few_shot_examples[category][:3]  # Берем до 3 примеров
+        # Фичи только для промахов кэша
+        for i in pending:
+            timers[i].restart()
+            features_by_idx[i] = self.feature_processor.extract_features(texts[i])
+            timers[i].lap('features')
+        
+        if not pending:
+            return results
+        
+        # Каскад: письма, на которых уверен дешёвый уровень, в модель не идут
+        batch_results = {}
+        model_pending = pending
+        if self.cascade is not None:
+            model_pending = []
+            for i in pending:
+                timers[i].restart()
+                result = self._cascade_result(texts[i], top_n, timers[i])
+                if result is None:
+                    model_pending.append(i)
+                else:
+                    batch_results[i] = result
+        
+        # Одинаковые тексты в пакете кодируем один раз
+        unique_texts = []
+        row_by_text = {}
+        for i in model_pending:
+            if texts[i] not in row_by_text:
+                row_by_text[texts[i]] = len(unique_texts)
+                unique_texts.append(texts[i])
+        
+        shared_ms = {}
+        if model_pending:
+            self._ensure_model()
+            if self.model_loaded:
                 try:
-                    example_embeddings = self.model.encode(examples, convert_to_tensor=True)
-                    category_embedding = torch.mean(example_embeddings, dim=0)
-                except:
-                    # Fallback на название категории
-                    category_embedding = self.model.encode([category], convert_to_tensor=True)[0]
+                    stage_start = time.perf_counter()
+                    category_matrix = self._ensure_category_matrix()
+                    embeddings = self._encode_texts(unique_texts, batch_size=batch_size)
+                    encoded_at = time.perf_counter()
+                    scores = self._score_embeddings(embeddings, category_matrix)
+                    probabilities = self._knn_probabilities(embeddings, scores) if self._knn_active() else None
+                    shared_ms = {
+                        'encode': (encoded_at - stage_start) * 1000 / len(model_pending),
+                        'similarity': (time.perf_counter() - encoded_at) * 1000 / len(model_pending)
+                    }
+                    
+                    for i in model_pending:
+                        timers[i].restart()
+                        row = row_by_text[texts[i]]
+                        if probabilities is not None:
+                            result = self._build_result(probabilities[row], scores[row], top_n, method='knn-few-shot')
+                        else:
+                            result = self._similarities_to_result(scores[row], top_n)
+                        timers[i].lap('result_build')
+                        batch_results[i] = result
+                except Exception as e:
+                    logger.error(f"Ошибка пакетной zero-shot классификации: {e}")
+                    metrics.ERRORS.inc('zero_shot')
+                    shared_ms = {}
+                    for i in model_pending:
+                        timers[i].restart()
+                        result = self._demo_classify(texts[i], features_by_idx[i], top_n)
+                        result['method'] = 'demo-fallback'
+                        result['model_used'] = 'demo-mode'
+                        timers[i].lap('similarity')
+                        batch_results[i] = result
             else:
-                # Используем название категории
-                category_embedding = self.model.encode([category], convert_to_tensor=True)[0]
+                for i in model_pending:
+                    timers[i].restart()
+                    result = self._demo_classify(texts[i], features_by_idx[i], top_n)
+                    result['method'] = 'demo-mode'
+                    result['model_used'] = 'demo-mode'
+                    timers[i].lap('similarity')
+                    batch_results[i] = result
             
-            category_embeddings.append(category_embedding)
-            enhanced_categories.append(category)
+            if self.cascade is not None:
+                for i in model_pending:
+                    self.cascade.record('transformer')
+                    batch_results[i]['cascade_tier'] = 'transformer'
+
+        # Демо-результат зависит от ключевых слов самого письма: похожие на него письма считаются сами
+        demo_followers = [item for item in followers if batch_results[item[1]]['method'].startswith('demo')]
+        if demo_followers:
+            followers = [item for item in followers if item not in demo_followers]
+            for i, source_idx, _ in demo_followers:
+                timers[i].restart()
+                features_by_idx[i] = self.feature_processor.extract_features(texts[i])
+                timers[i].lap('features')
+                result = self._cascade_result(texts[i], top_n, timers[i]) if self.cascade is not None else None
+                if result is None:
+                    result = self._demo_classify(texts[i], features_by_idx[i], top_n)
+                    result['method'] = batch_results[source_idx]['method']
+                    result['model_used'] = 'demo-mode'
+                    timers[i].lap('similarity')
+                    if self.cascade is not None:
+                        self.cascade.record('transformer')
+                        result['cascade_tier'] = 'transformer'
+                batch_results[i] = result
+                pending.append(i)
+
+        if use_cache and not model_ready:
+            # Загрузка модели могла сменить её имя (демо-режим) - ключи строятся заново
+            for i in pending + [i for i, _, _ in followers]:
+                keys_by_idx[i] = self._create_cache_key(texts[i], top_n)
+        
+        for i in pending:
+            timer = timers[i]
+            timer.restart()
+            result = batch_results[i]
+            features = features_by_idx[i]
+            result['features'] = features
+            result['text_complexity'] = features.get('text_complexity', 0)
+            timer.lap('result_build')
+            
+            if result.get('cascade_tier', 'transformer') == 'transformer':
+                for stage, ms in shared_ms.items():
+                    timer.add(stage, ms)
+            result['timings_ms'] = timer.publish()
+            result['processing_time_ms'] = result['timings_ms']['total']
+            metrics.record_result(result)
+            
+            if use_cache:
+                self.cache.set(keys_by_idx[i], result)
+                self._miss_latency_ms.append(result['processing_time_ms'])
+            if fingerprints.get(i) is not None and not result['method'].startswith('demo'):
+                self.near_duplicates.add(fingerprints[i], self._current_context(), top_n, result)
+            
+            results[i] = result
+        
+        for i, source_idx, similarity in followers:
+            timers[i].restart()
+            results[i] = self._near_duplicate_result(results[source_idx], similarity, texts[i], timers[i])
+            if use_cache:
+                self.cache.set(keys_by_idx[i], results[i])
+        
+        return results
+    
+    def _validate_input(self, text: str) -> Optional[Dict]:
+        """Результат-заглушка для невалидного ввода или None"""
+        if not text or len(text.strip()) < 10:
+            return self._create_result(
+                category="Текст слишком короткий",
+                confidence=0.0,
+                is_undefined=True,
+                method="input-validation"
+            )
+        
+        if not self.categories:
+            return self._create_result(
+                category="Категории не заданы",
+                confidence=0.0,
+                is_undefined=True,
+                method="no-categories"
+            )
+        
+        return None
+    
+    def _zero_shot_classify(self, text: str, features: Dict, top_n: int,
+                            timer: StageTimer = None) -> Dict:
+        """Настоящая zero-shot классификация с Sentence Transformers"""
+        timer = timer or StageTimer()
+        category_matrix = self._ensure_category_matrix()
+        
+        # Один проход модели: кодируем только текст
+        text_embedding = self._encode_texts([text])[0]
+        timer.lap('encode')
         
-        # Вычисляем косинусное сходство
-        category_tensor = torch.stack(category_embeddings)
-        cos_scores = util.cos_sim(text_embedding, category_tensor)[0]
+        scores = self._score_embeddings(text_embedding[np.newaxis, :], category_matrix)
+        if self._knn_active():
+            probabilities = self._knn_probabilities(text_embedding[np.newaxis, :], scores)
+            timer.lap('similarity')
+            result = self._build_result(probabilities[0], scores[0], top_n, method='knn-few-shot')
+        else:
+            timer.lap('similarity')
+            result = self._similarities_to_result(scores[0], top_n)
+        timer.lap('result_build')
+        return result
+    
+    @staticmethod
+    def _score_embeddings(embeddings: np.ndarray, category_matrix: np.ndarray) -> np.ndarray:
+        """Косинусное сходство = скалярное произведение нормализованных векторов
+        
+        Накопление в float64 делает результат независимым от размера пакета.
+        """
+        scores = embeddings.astype(np.float64) @ category_matrix.T.astype(np.float64)
+        return scores.astype(np.float32)
+    
+    def _knn_active(self) -> bool:
+        """kNN включён и в банке есть закодированные примеры"""
+        return self.mode == 'knn' and self.few_shot.matrix.shape[0] > 0
+    
+    def _knn_categories_of_rows(self) -> np.ndarray:
+        """Индекс категории для каждой строки банка (-1 - категории нет в списке)"""
+        cached = self._knn_row_categories
+        if cached is not None and cached[0] == self.category_version:
+            return cached[1]
+        
+        position = {category: idx for idx, category in enumerate(self.categories)}
+        lookup = np.array([position.get(name, -1) for name in self.few_shot.label_names], dtype=np.int64)
+        row_categories = lookup[self.few_shot.codes] if lookup.size else np.empty(0, dtype=np.int64)
+        self._knn_row_categories = (self.category_version, row_categories)
+        return row_categories
+    
+    def _knn_probabilities(self, embeddings: np.ndarray, category_scores: np.ndarray) -> np.ndarray:
+        """Вероятности категорий голосованием k ближайших примеров (B x C)
         
-        # Конвертируем в numpy
-        scores_np = cos_scores.cpu().numpy()
+        Сходства со всем банком - одно матричное умножение на порцию писем,
+        k лучших - argpartition. Категории без примеров участвуют своим
+        вектором-названием. Веса выбранных соседей пересчитываются в float64,
+        поэтому результат не зависит от размера пакета.
+        """
+        # Под блокировкой банка: параллельное удаление примера переставляет строки
+        with self.few_shot.lock:
+            return self._knn_vote(embeddings, category_scores)
+    
+    def _knn_vote(self, embeddings: np.ndarray, category_scores: np.ndarray) -> np.ndarray:
+        bank = self.few_shot.matrix
+        row_categories = self._knn_categories_of_rows()
+        n_categories = len(self.categories)
+        k = min(self.knn_k, bank.shape[0])
+        
+        counts = self.few_shot.counts()
+        anchors = np.array([idx for idx, category in enumerate(self.categories) if not counts.get(category)],
+                           dtype=np.int64)
         
-        # Применяем softmax для получения вероятностей
-        from scipy.special import softmax
-        probabilities = softmax(scores_np * 5.0)  # Температурное масштабирование
+        probabilities = np.zeros((embeddings.shape[0], n_categories), dtype=np.float64)
+        chunk = max(1, KNN_CHUNK_ELEMENTS // max(bank.shape[0], 1))
+        
+        for start in range(0, embeddings.shape[0], chunk):
+            queries = embeddings[start:start + chunk]
+            rows = np.arange(queries.shape[0])[:, np.newaxis]
+            
+            sims = queries @ bank.T
+            neighbours = np.argpartition(-sims, k - 1, axis=1)[:, :k] if k < bank.shape[0] else \
+                np.broadcast_to(np.arange(bank.shape[0]), (queries.shape[0], bank.shape[0]))
+            
+            # Точные веса выбранных соседей
+            neighbour_sims = np.einsum(
+                'bd,bkd->bk', queries.astype(np.float64), bank[neighbours].astype(np.float64)
+            )
+            neighbour_categories = row_categories[neighbours]
+            
+            if anchors.size:
+                anchor_sims = category_scores[start:start + chunk][:, anchors].astype(np.float64)
+                neighbour_sims = np.hstack([neighbour_sims, anchor_sims])
+                neighbour_categories = np.hstack([
+                    neighbour_categories, np.broadcast_to(anchors, (queries.shape[0], anchors.size))
+                ])
+                best = np.argsort(-neighbour_sims, axis=1, kind='stable')[:, :k]
+                neighbour_sims = neighbour_sims[rows, best]
+                neighbour_categories = neighbour_categories[rows, best]
+            
+            weights = np.where(neighbour_categories >= 0, np.maximum(neighbour_sims, 0.0), 0.0)
+            flat = rows * n_categories + np.maximum(neighbour_categories, 0)
+            votes = np.bincount(flat.ravel(), weights=weights.ravel(),
+                                minlength=queries.shape[0] * n_categories).reshape(-1, n_categories)
+            
+            totals = votes.sum(axis=1, keepdims=True)
+            probabilities[start:start + chunk] = np.where(
+                totals > 0, votes / np.maximum(totals, 1e-12), 1.0 / n_categories
+            )
+        
+        return probabilities
+    
+    def _similarities_to_result(self, scores_np: np.ndarray, top_n: int) -> Dict:
+        """Преобразование сходств с категориями в результат классификации"""
+        # Применяем softmax для получения вероятностей (температурное масштабирование)
+        logits = scores_np.astype(np.float64) * 5.0
+        exp_scores = np.exp(logits - logits.max())
+        probabilities = exp_scores / exp_scores.sum()
+        
+        return self._build_result(probabilities, scores_np, top_n, method='zero-shot-transformer')
+    
+    def _build_result(self, probabilities: np.ndarray, scores_np: np.ndarray, top_n: int,
+                      method: str) -> Dict:
+        """Результат по вероятностям и сходствам категорий"""
+        enhanced_categories = self.categories
         
         # Находим лучшую категорию
         best_idx = np.argmax(probabilities)
@@ -445,118 +1529,32 @@ class ZeroShotMailClassifier:
             top_categories=top_categories,
             all_scores=all_scores,
             all_similarities=all_similarities,
-            method='zero-shot-transformer',
+            method=method,
             model_used=self.model_name
         )
     
     def _demo_classify(self, text: str, features: Dict, top_n: int) -> Dict:
-        """Демо-классификация если модель не загружена"""
-        text_lower = text.lower()
+        """Демо-классификация если модель не загружена
         
-        # Улучшенная демо-логика с учетом фич
-        category_scores = {}
-        
-        for category in self.categories:
-            category_lower = category.lower()
-            score = 0.0
-            
-            # Ключевые слова для категорий
-            if 'business' in category_lower or 'делов' in category_lower:
-                if any(word in text_lower for word in ['предложен', 'сотрудничеств', 'партнерств', 'коммерческ', 'договор']):
-                    score += 0.8
-                if features.get('formal_score', 0) > 0:
-                    score += 0.2
-                if features.get('formality_ratio', 0) > 0.7:
-                    score += 0.15
-            
-            elif 'complaint' in category_lower or 'жалоб' in category_lower:
-                if any(word in text_lower for word in ['жалоб', 'недовол', 'проблем', 'претензи', 'возражен']):
-                    score += 0.8
-                if features.get('exclamation_count', 0) > 1:
-                    score += 0.2
-                if features.get('negative_score', 0) > features.get('positive_score', 0):
-                    score += 0.15
-            
-            elif 'support' in category_lower or 'поддерж' in category_lower or 'технич' in category_lower:
-                if any(word in text_lower for word in ['помощ', 'поддержк', 'ошибк', 'техническ', 'сбо', 'не работ']):
-                    score += 0.8
-                if features.get('question_count', 0) > 0:
-                    score += 0.2
-                if features.get('has_questions', False):
-                    score += 0.15
-            
-            elif 'spam' in category_lower or 'реклам' in category_lower:
-                if any(word in text_lower for word in ['выиграл', 'приз', 'акци', 'бесплатно', 'congratulation', 'распродаж', 'скидк']):
-                    score += 0.9
-                if features.get('uppercase_ratio', 0) > 0.3:
-                    score += 0.2
-                if features.get('exclamation_count', 0) > 2:
-                    score += 0.15
-            
-            elif 'personal' in category_lower or 'личн' in category_lower:
-                if any(word in text_lower for word in ['привет', 'здравств', 'спасиб', 'личн', 'встреч', 'как дела']):
-                    score += 0.7
-                if features.get('has_greeting'):
-                    score += 0.3
-                if features.get('informal_score', 0) > 0:
-                    score += 0.15
-            
-            elif 'finance' in category_lower or 'финанс' in category_lower:
-                if any(word in text_lower for word in ['счет', 'оплат', 'деньг', 'финанс', 'бюджет', 'платеж']):
-                    score += 0.8
-                if features.get('has_numbers'):
-                    score += 0.2
-                if features.get('has_money'):
-                    score += 0.15
-            
-            elif 'hr' in category_lower or 'кадр' in category_lower or 'рекрут' in category_lower:
-                if any(word in text_lower for word in ['ваканс', 'резюме', 'собеседован', 'работ', 'зарплат', 'отпуск']):
-                    score += 0.8
-                if features.get('formal_score', 0) > 0:
-                    score += 0.2
-            
-            elif 'legal' in category_lower or 'юрид' in category_lower or 'правов' in category_lower:
-                if any(word in text_lower for word in ['договор', 'юрид', 'закон', 'прав', 'соглашен', 'контракт']):
-                    score += 0.8
-                if features.get('formality_ratio', 0) > 0.8:
-                    score += 0.2
-            
-            elif 'news' in category_lower or 'новост' in category_lower:
-                if any(word in text_lower for word in ['новост', 'анонс', 'объявлен', 'информиру', 'сообща']):
-                    score += 0.8
-                if features.get('formal_score', 0) > 0:
-                    score += 0.2
-            
-            elif 'marketing' in category_lower or 'маркетинг' in category_lower:
-                if any(word in text_lower for word in ['маркетинг', 'реклам', 'продвижен', 'клиент', 'продаж']):
-                    score += 0.8
-            
-            elif 'not defined' in category_lower or 'не определен' in category_lower:
-                score = 0.1  # Базовая вероятность
-            
-            else:
-                # Для неизвестных категорий - случайный score
-                random.seed(hash(category + text[:50]) % 10000)
-                score = random.uniform(0.1, 0.4)
-            
-            # Учет сложности текста
-            if features.get('text_complexity', 0) > 0.7:
-                score = score * 0.9  # Снижаем уверенность для сложных текстов
-            
-            category_scores[category] = min(1.0, max(0.0, score))
+        Ключевые слова всех категорий ищутся за один проход по тексту
+        (keyword_rules.py), оценки считаются numpy-вектором.
+        """
+        # Одна оценка на название, как у словаря оценок: повторы категорий не учитываются
+        categories = list(dict.fromkeys(self.categories))
+        scores = demo_scorer.score(text, features, categories)
         
-        # Нормализация
-        total = sum(category_scores.values())
+        # Нормализация (сумма - по порядку категорий, как в исходной цепочке правил)
+        total = sum(scores.tolist())
         if total > 0:
-            probabilities = {cat: score/total for cat, score in category_scores.items()}
+            probabilities = scores / total
         else:
-            probabilities = {cat: 1.0/len(category_scores) for cat in category_scores}
+            probabilities = np.full(len(categories), 1.0 / len(categories)) if categories else scores
         
         # Находим лучшую категорию
-        if probabilities:
-            best_category = max(probabilities.items(), key=lambda x: x[1])
-            best_prob = best_category[1]
-            best_cat_name = best_category[0]
+        if categories:
+            best_idx = int(probabilities.argmax())
+            best_prob = float(probabilities[best_idx])
+            best_cat_name = categories[best_idx]
         else:
             best_cat_name = "Not Defined"
             best_prob = 0.0
@@ -568,19 +1566,15 @@ class ZeroShotMailClassifier:
             'не определен' in best_cat_name.lower()
         )
         
-        # Топ-N категорий
-        top_categories = []
-        if probabilities:
-            sorted_items = sorted(probabilities.items(), key=lambda x: x[1], reverse=True)
-            for i, (cat, prob) in enumerate(sorted_items[:top_n]):
-                top_categories.append({
-                    'category': cat,
-                    'score': float(prob),
-                    'similarity': float(prob)
-                })
+        # Топ-N категорий (при равных оценках - в порядке категорий)
+        prob_list = probabilities.tolist()
+        top_categories = [
+            {'category': categories[i], 'score': prob_list[i], 'similarity': prob_list[i]}
+            for i in np.argsort(-probabilities, kind='stable')[:top_n].tolist()
+        ]
         
         # Все оценки
-        all_scores = {cat: float(prob) for cat, prob in probabilities.items()}
+        all_scores = dict(zip(categories, prob_list))
         all_similarities = all_scores.copy()  # Для совместимости
         
         return self._create_result(
@@ -606,7 +1600,7 @@ class ZeroShotMailClassifier:
             'model_used': kwargs.get('model_used', 'unknown'),
             'method': kwargs.get('method', 'unknown'),
             'timestamp': datetime.now().isoformat(),
-            'processing_time_ms': random.randint(80, 180)
+            'processing_time_ms': kwargs.get('processing_time_ms', 0.0)
         }
         
         if 'features' in kwargs:
@@ -614,30 +1608,92 @@ class ZeroShotMailClassifier:
         
         return result
     
-    def _create_cache_key(self, text: str, features: Dict) -> str:
-        """Создание ключа для кэша"""
-        text_part = text[:200]
-        cats_part = ''.join(sorted(self.categories))
-        feat_part = str(sorted(features.items())) if features else ""
+    def _create_cache_key(self, text: str, top_n: int = 5) -> str:
+        """Ключ кэша: blake2b по полному тексту, версии категорий, модели и порогу
         
-        key_string = f"{text_part}|{cats_part}|{feat_part}"
-        return hashlib.md5(key_string.encode()).hexdigest()
+        Хэш параметров вычисляется один раз и копируется для каждого текста.
+        """
+        if self._cache_key_base is None or self._base_cascade_id is not self._cascade_id:
+            self._rebuild_cache_key_base()
+        
+        digest = self._cache_key_base.copy()
+        digest.update(f"|{top_n}|".encode('ascii'))
+        digest.update(text.encode('utf-8', errors='surrogatepass'))
+        return digest.hexdigest()
+    
+    def _rebuild_cache_key_base(self):
+        """Контекст результата (модель, порог, категории, режим) и хэш-префикс ключа кэша"""
+        self._result_context = (
+            f"{self.embedding_model_id}|{self.threshold:.6f}|{self.category_version}|"
+            f"{self.mode}:{self.knn_k}"
+        )
+        self._base_cascade_id = self._cascade_id
+        if self._cascade_id:
+            self._result_context += f"|{self._cascade_id}"
+        base = hashlib.blake2b(digest_size=16)
+        base.update(self._result_context.encode('utf-8'))
+        self._cache_key_base = base
+    
+    def _current_context(self) -> str:
+        if self._cache_key_base is None or self._base_cascade_id is not self._cascade_id:
+            self._rebuild_cache_key_base()
+        return self._result_context
+    
+    @staticmethod
+    def _latency_summary(samples) -> Dict:
+        """Среднее и перцентили по выборке задержек"""
+        if not samples:
+            return {'count': 0, 'avg_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0}
+        values = np.fromiter(samples, dtype=np.float64)
+        return {
+            'count': int(values.size),
+            'avg_ms': float(values.mean()),
+            'p50_ms': float(np.percentile(values, 50)),
+            'p95_ms': float(np.percentile(values, 95))
+        }
     
     def get_model_info(self) -> Dict:
         """Информация о модели"""
         return {
             'model_name': self.model_name,
             'model_loaded': self.model_loaded,
+            'backend': self.backend,
+            'is_ready': self.is_ready,
+            'load_state': self.load_state,
+            'cold_start_ms': self.cold_start_ms,
+            'warmup_ms': self.warmup_ms,
             'device': self.device,
             'categories_count': len(self.categories),
             'threshold': self.threshold,
-            'few_shot_examples': {k: len(v) for k, v in self.few_shot_examples.items()},
-            'cache_size': len(self.cache)
+            'mode': self.mode,
+            'knn_k': self.knn_k,
+            'profiles': len(self._profiles),
+            'few_shot_examples': self.few_shot.counts(),
+            'few_shot_bank': self.few_shot.stats(),
+            'cache_size': len(self.cache),
+            'cache_stats': self.cache.stats(),
+            'cache_latency': {
+                'hit': self._latency_summary(self._hit_latency_ms),
+                'miss': self._latency_summary(self._miss_latency_ms)
+            },
+            'stage_latency': latency.snapshot(),
+            'embedding_store': self.embedding_store.info() if self.embedding_store else None,
+            'projector': self.projector.info() if self.projector else None,
+            'near_duplicates': self.near_duplicates.stats() if self.near_duplicates else None,
+            'cascade': self.cascade.stats() if self.cascade else None,
+            'inference_profile': {
+                key: self.inference_profile.get(key)
+                for key in ('node', 'batch_size', 'num_threads', 'interop_threads',
+                            'throughput_per_sec', 'p95_ms', 'tuned_at')
+            } if self.inference_profile else None,
+            'encode_batch_size': self.encode_batch_size
         }
     
     def clear_cache(self):
         """Очистка кэша"""
         self.cache.clear()
+        if self.near_duplicates is not None:
+            self.near_duplicates.clear()
         logger.info("Кэш очищен")
 
 # ========== SECURITY CHECKER ==========
@@ -654,6 +1710,50 @@ class SecurityChecker:
         """Очистка ввода"""
         return text[:max_length]
 
+# ========== КОНФИГУРАЦИЯ И ТЕСТОВЫЕ ДАННЫЕ ==========
+def load_categories(path: str = "config/categories.json") -> List[str]:
+    """Категории из JSON файла UI или список по умолчанию"""
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка чтения {path}: {e}")
+    return list(DEFAULT_CATEGORIES)
+
+
+def load_labeled_emails(test_emails_dir: str = "test_emails", limit: int = None) -> List[Dict]:
+    """Загрузка размеченного корпуса (labels.csv + файлы писем) без UI-зависимостей"""
+    import csv
+    
+    base_dir = os.path.abspath(test_emails_dir)
+    labels_path = os.path.join(base_dir, "labels.csv")
+    if not os.path.exists(labels_path):
+        logger.warning(f"labels.csv не найден: {labels_path}")
+        return []
+    
+    emails = []
+    with open(labels_path, "r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            filename = str(row.get("filename", "")).strip()
+            file_path = os.path.join(base_dir, filename)
+            if not filename or not os.path.exists(file_path):
+                continue
+            
+            with open(file_path, "rb") as email_file:
+                content = email_file.read().decode("utf-8", errors="ignore")
+            
+            emails.append({
+                "filename": filename,
+                "true_category": str(row.get("true_category", "")).strip(),
+                "text": content
+            })
+            
+            if limit and len(emails) >= limit:
+                break
+    
+    return emails
+
 # ========== ИНИЦИАЛИЗАЦИЯ ==========
 email_processor = EmailProcessor()
 classifier = ZeroShotMailClassifier()  # Используем zero-shot классификатор!
@@ -661,7 +1761,7 @@ security_checker = SecurityChecker()
 
 logger.info("✅ Все компоненты MailLens инициализированы")
 logger.info(f"  • EmailProcessor: готов")
-logger.info(f"  • ZeroShotMailClassifier: готов (ML: {classifier.model_loaded})")
+logger.info(f"  • ZeroShotMailClassifier: готов (модель: {classifier.load_state})")
 logger.info(f"  • SecurityChecker: готов")
 
 # Экспорт
@@ -672,5 +1772,8 @@ __all__ = [
     'EnhancedTextProcessor',
     'EmailProcessor',
     'ZeroShotMailClassifier', 
-    'SecurityChecker'
+    'SecurityChecker',
+    'load_labeled_emails',
+    'DEFAULT_CATEGORIES',
+    'load_categories'
 ]
\ No newline at end of file
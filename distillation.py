@@ -0,0 +1,380 @@
+"""
+DISTILLATION.PY - Дистилляция трансформера в быструю линейную модель
+
+ZeroShotMailClassifier размечает большой неразмеченный корпус (папка .eml,
+mbox или Maildir), его мягкие оценки по категориям сохраняются. На них
+обучается линейная модель: TF-IDF по хэшированным словам и биграммам (без
+словаря, признаки как у лексической модели cascade.py) и логистическая
+регрессия scikit-learn. Цель
+обучения - распределение учителя, а не только его ответ: каждое письмо входит
+в обучение с каждой заметной категорией, вес равен вероятности учителя.
+
+Ученик - уровень 'distilled' каскада (cascade.py): отвечает, когда уверен
+не меньше порога, иначе письмо идёт в трансформер. Порог подбирается на
+отложенной части корпуса по целевому согласию с учителем и сохраняется в
+модели. Отчёт показывает согласие, долю ответов и ускорение.
+
+Пример:
+    python distillation.py label archive.mbox -o distill/teacher.npz --limit 50000
+    python distillation.py train distill/teacher.npz -o config/distilled.npz --target-agreement 0.97
+"""
+
+import os
+import sys
+import time
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from cascade import hashed_token_ids, in_holdout
+
+logger = logging.getLogger(__name__)
+
+DISTILLED_FEATURES = 2 ** 18
+# Категории с меньшей вероятностью учителя не попадают в обучение письма
+MIN_TARGET_WEIGHT = 0.01
+# Доли ответов ученика в таблице отчёта
+COVERAGE_STEPS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+
+def hashed_counts(texts: Sequence[str], n_features: int):
+    """Разреженная матрица частот хэшированных слов и биграмм (письмо x признак)"""
+    from scipy.sparse import csr_matrix
+
+    indptr, indices, values = [0], [], []
+    for text in texts:
+        ids, counts = np.unique(hashed_token_ids(text, n_features), return_counts=True)
+        indices.append(ids)
+        values.append(counts)
+        indptr.append(indptr[-1] + len(ids))
+    return csr_matrix((np.concatenate(values or [[]]).astype(np.float64),
+                       np.concatenate(indices or [[]]).astype(np.int64), indptr),
+                      shape=(len(texts), n_features))
+
+
+# ---------- УЧЕНИК ----------
+class DistilledClassifier:
+    """Хэшированный TF-IDF и логистическая регрессия, обученные на оценках трансформера
+
+    Обучение - TfidfTransformer и LogisticRegression scikit-learn. Для ответа
+    веса переносятся в numpy-массивы: письмо в каскаде оценивается по одному,
+    и вызов sklearn стоил бы дороже самой модели.
+    """
+
+    def __init__(self, n_features: int = DISTILLED_FEATURES, C: float = 10.0):
+        self.n_features = n_features
+        self.C = C
+        self.classes_: List[str] = []
+        self.idf = None         # (n_features,)
+        self.coef = None        # (n_classes, n_features)
+        self.intercept = None   # (n_classes,)
+        self.cutoff: Optional[float] = None   # порог уверенности, подобранный на отложенной части
+        self.teacher_model = ''
+
+    def fit(self, texts: Sequence[str], categories: Sequence[str], scores: np.ndarray) -> 'DistilledClassifier':
+        """Обучение на мягких оценках учителя (строка scores - распределение по categories)"""
+        from sklearn.feature_extraction.text import TfidfTransformer
+        from sklearn.linear_model import LogisticRegression
+
+        tfidf = TfidfTransformer(sublinear_tf=True)
+        features = tfidf.fit_transform(hashed_counts(texts, self.n_features))
+
+        # Обучаются только встреченные признаки: пустые хэш-корзины замедляют lbfgs в сотни раз
+        used = np.unique(features.indices)
+        features = features[:, used]
+
+        # Перекрёстная энтропия с мягкими целями = взвешенные пары (письмо, категория)
+        rows, cols = np.nonzero(scores >= MIN_TARGET_WEIGHT)
+        model = LogisticRegression(C=self.C, max_iter=1000)
+        model.fit(features[rows], cols, sample_weight=scores[rows, cols])
+
+        coef, intercept = model.coef_, model.intercept_
+        if coef.shape[0] == 1:
+            # Два класса: сигмоида = softmax по (0, w)
+            coef = np.vstack([np.zeros_like(coef), coef])
+            intercept = np.concatenate([[0.0], intercept])
+        self.classes_ = [categories[c] for c in model.classes_]
+        self.idf = tfidf.idf_.astype(np.float32)
+        self.coef = np.zeros((len(self.classes_), self.n_features), dtype=np.float32)
+        self.coef[:, used] = coef
+        self.intercept = intercept.astype(np.float64)
+        return self
+
+    def predict_proba(self, texts: Sequence[str]) -> np.ndarray:
+        probabilities = np.empty((len(texts), len(self.classes_)), dtype=np.float64)
+        for row, text in enumerate(texts):
+            ids, counts = np.unique(hashed_token_ids(text, self.n_features), return_counts=True)
+            # sublinear tf * idf с l2-нормой - как TfidfTransformer при обучении
+            weights = (1.0 + np.log(counts)) * self.idf[ids]
+            norm = np.sqrt(weights @ weights)
+            if norm > 0:
+                weights /= norm
+            logits = self.intercept + self.coef[:, ids].astype(np.float64) @ weights
+            logits -= logits.max()
+            exp = np.exp(logits)
+            probabilities[row] = exp / exp.sum()
+        return probabilities
+
+    @property
+    def id(self) -> str:
+        digest = hashlib.blake2b(self.coef.tobytes(), digest_size=4).hexdigest()
+        return f"lr{len(self.classes_)}-{digest}"
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez_compressed(path, classes=np.array(self.classes_), C=self.C, idf=self.idf, coef=self.coef,
+                            intercept=self.intercept, cutoff=np.nan if self.cutoff is None else self.cutoff,
+                            teacher_model=self.teacher_model)
+
+    @classmethod
+    def load(cls, path: str) -> 'DistilledClassifier':
+        with np.load(path, allow_pickle=False) as data:
+            model = cls(n_features=data['coef'].shape[1], C=float(data['C']))
+            model.classes_ = [str(c) for c in data['classes']]
+            model.idf = data['idf']
+            model.coef = data['coef']
+            model.intercept = data['intercept']
+            cutoff = float(data['cutoff'])
+            model.cutoff = None if np.isnan(cutoff) else cutoff
+            model.teacher_model = str(data['teacher_model'])
+        return model
+
+
+# ---------- РАЗМЕТКА УЧИТЕЛЕМ ----------
+def iter_corpus(source: Path, workers: int, limit: Optional[int] = None, chunk_size: int = 256):
+    """Пакеты (id, текст) разобранных писем источника; разбор - в пуле процессов"""
+    from bulk_classify import chunks, parse_message, detect_source_type, iter_messages
+
+    messages = iter_messages(source, detect_source_type(source))
+    taken = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for window in chunks(messages, chunk_size * workers):
+            if limit is not None:
+                window = window[:limit - taken]
+            batch = [(parsed['id'], parsed['cleaned_text'] or parsed['full_text'])
+                     for parsed in executor.map(parse_message, window, chunksize=max(1, chunk_size // 4))
+                     if parsed.get('success') and (parsed['cleaned_text'] or parsed['full_text'])]
+            taken += len(window)
+            if batch:
+                yield batch
+            if limit is not None and taken >= limit:
+                return
+
+
+def teacher_scores(classifier, texts: List[str], batch_size: int = None) -> Tuple[np.ndarray, float]:
+    """Мягкие оценки трансформера (строки в порядке classifier.categories) и время разметки, с"""
+    categories = classifier.categories
+    previous = classifier.cascade
+    try:
+        # Учитель - только трансформер: ответы каскада не должны попасть в цели
+        classifier.set_cascade(None)
+        start = time.perf_counter()
+        results = classifier.classify_batch(texts, batch_size=batch_size, use_cache=False)
+        elapsed = time.perf_counter() - start
+    finally:
+        classifier.set_cascade(previous)
+
+    scores = np.array([[result['all_scores'].get(category, 0.0) for category in categories]
+                       for result in results], dtype=np.float32)
+    return scores, elapsed
+
+
+def label_corpus(classifier, source: Path, output: str, workers: int, limit: Optional[int] = None,
+                 batch_size: int = None) -> Dict:
+    """Разметка корпуса учителем: тексты, мягкие оценки и время трансформера на письмо -> .npz"""
+    if not classifier.model_loaded:
+        raise RuntimeError("Модель не загружена - учитель в демо-режиме не годится")
+
+    ids, texts, scores, elapsed = [], [], [], 0.0
+    for batch in iter_corpus(source, workers, limit):
+        batch_scores, batch_elapsed = teacher_scores(classifier, [text for _, text in batch], batch_size)
+        ids.extend(message_id for message_id, _ in batch)
+        texts.extend(text for _, text in batch)
+        scores.append(batch_scores)
+        elapsed += batch_elapsed
+        logger.info(f"📧 Размечено {len(texts)} писем ({len(texts) / max(elapsed, 1e-9):.1f} писем/с)")
+
+    if not texts:
+        raise RuntimeError(f"В {source} нет писем для разметки")
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    teacher_ms = elapsed * 1000 / len(texts)
+    id_blob, id_offsets = pack_strings(ids)
+    text_blob, text_offsets = pack_strings(texts)
+    np.savez_compressed(output, id_blob=id_blob, id_offsets=id_offsets,
+                        text_blob=text_blob, text_offsets=text_offsets,
+                        categories=np.array(classifier.categories), scores=np.vstack(scores),
+                        teacher_ms_per_email=teacher_ms, model=classifier.model_name)
+    return {'emails': len(texts), 'teacher_ms_per_email': teacher_ms}
+
+
+def pack_strings(strings: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Строки одним буфером UTF-8 и смещениями границ
+
+    Массив np.array(strings) хранит каждую строку с шириной самой длинной -
+    одно огромное письмо раздувает его до N x max_len x 4 байт.
+    """
+    encoded = [string.encode('utf-8', errors='surrogatepass') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(chunk) for chunk in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(blob: np.ndarray, offsets: np.ndarray) -> List[str]:
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    return [data[start:end].decode('utf-8', errors='surrogatepass') for start, end in zip(bounds, bounds[1:])]
+
+
+def load_labels(path: str) -> Dict:
+    with np.load(path, allow_pickle=False) as data:
+        return {
+            'ids': unpack_strings(data['id_blob'], data['id_offsets']),
+            'texts': unpack_strings(data['text_blob'], data['text_offsets']),
+            'categories': [str(c) for c in data['categories']],
+            'scores': data['scores'].astype(np.float64),
+            'teacher_ms_per_email': float(data['teacher_ms_per_email']),
+            'model': str(data['model'])
+        }
+
+
+# ---------- ОТЧЁТ ----------
+def choose_cutoff(confidence: np.ndarray, agree: np.ndarray, target: float) -> Optional[float]:
+    """Наименьший порог, при котором согласие на отвеченных письмах не ниже target"""
+    order = np.argsort(-confidence, kind='stable')
+    ranked = confidence[order]
+    running = np.cumsum(agree[order]) / np.arange(1, len(order) + 1)
+    # Порог отсекает письма только по уверенности: одинаково уверенные отвечаются вместе
+    group_end = np.append(ranked[:-1] != ranked[1:], True)
+    passing = np.flatnonzero((running >= target) & group_end)
+    if not passing.size:
+        return None
+    last = passing[-1]
+    return float(confidence[order[last]])
+
+
+def agreement_report(student: DistilledClassifier, texts: List[str], categories: List[str],
+                     scores: np.ndarray, teacher_ms: float, target: float) -> Dict:
+    """Согласие ученика с учителем, доля ответов при разных порогах и ускорение"""
+    start = time.perf_counter()
+    # По одному письму, как в каскаде
+    probabilities = np.vstack([student.predict_proba([text])[0] for text in texts])
+    student_ms = (time.perf_counter() - start) * 1000 / max(len(texts), 1)
+
+    student_best = np.array(student.classes_, dtype=object)[probabilities.argmax(axis=1)]
+    teacher_best = np.array(categories, dtype=object)[scores.argmax(axis=1)]
+    agree = (student_best == teacher_best).astype(np.float64)
+    confidence = probabilities.max(axis=1)
+
+    order = np.argsort(-confidence, kind='stable')
+    rows = []
+    for share in COVERAGE_STEPS:
+        answered = max(1, int(round(share * len(texts))))
+        rows.append({
+            'coverage': answered / len(texts),
+            'cutoff': float(confidence[order[answered - 1]]),
+            'agreement': float(agree[order[:answered]].mean())
+        })
+
+    cutoff = choose_cutoff(confidence, agree, target)
+    coverage = float((confidence >= cutoff).mean()) if cutoff is not None else 0.0
+    answered_agreement = float(agree[confidence >= cutoff].mean()) if coverage else None
+    # Ученик считается для всех писем, трансформер - для отложенных им
+    cascade_ms = student_ms + (1.0 - coverage) * teacher_ms
+    return {
+        'emails': len(texts),
+        'agreement': float(agree.mean()),
+        'target_agreement': target,
+        'cutoff': cutoff,
+        'coverage': coverage,
+        'answered_agreement': answered_agreement,
+        'student_ms_per_email': student_ms,
+        'teacher_ms_per_email': teacher_ms,
+        'speedup': teacher_ms / max(student_ms, 1e-9),
+        'cascade_speedup': teacher_ms / max(cascade_ms, 1e-9),
+        'coverage_table': rows
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Дистилляция трансформера MailLens в линейную модель")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    label_parser = sub.add_parser("label", help="Разметить неразмеченный корпус оценками трансформера")
+    label_parser.add_argument("source", type=Path, help="Папка .eml, mbox файл или Maildir")
+    label_parser.add_argument("-o", "--output", default="distill/teacher.npz")
+    label_parser.add_argument("--categories", default="config/categories.json")
+    label_parser.add_argument("--limit", type=int, default=None, help="Не больше N писем")
+    label_parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    label_parser.add_argument("--batch-size", type=int, default=None)
+
+    train_parser = sub.add_parser("train", help="Обучить ученика и подобрать порог на отложенной части")
+    train_parser.add_argument("labels", help="Файл разметки учителя (.npz)")
+    train_parser.add_argument("-o", "--output", default=os.getenv("CASCADE_DISTILLED_MODEL") or "config/distilled.npz")
+    train_parser.add_argument("--holdout", type=float, default=0.1,
+                              help="Доля корпуса для отчёта и подбора порога (разбиение по id письма)")
+    train_parser.add_argument("--target-agreement", type=float, default=0.97,
+                              help="Согласие с учителем на письмах, где ученик отвечает сам")
+    train_parser.add_argument("--C", type=float, default=10.0, help="Обратная сила регуляризации")
+    train_parser.add_argument("--features", type=int, default=DISTILLED_FEATURES)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.command == "label":
+        from core import classifier, load_categories
+
+        classifier.set_cascade(None)
+        classifier.set_categories(load_categories(args.categories))
+        classifier.warmup()
+        try:
+            stats = label_corpus(classifier, args.source, args.output, args.workers, args.limit, args.batch_size)
+        except RuntimeError as e:
+            print(f"❌ {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"✅ Размечено {stats['emails']} писем, трансформер {stats['teacher_ms_per_email']:.2f} мс/письмо "
+              f"-> {args.output}")
+        return
+
+    data = load_labels(args.labels)
+    holdout = np.array([in_holdout(message_id, args.holdout) for message_id in data['ids']])
+    train_rows, test_rows = np.flatnonzero(~holdout), np.flatnonzero(holdout)
+    if not train_rows.size or not test_rows.size:
+        print("❌ Слишком мало писем для обучающей и отложенной частей", file=sys.stderr)
+        sys.exit(1)
+
+    texts = data['texts']
+    start = time.perf_counter()
+    student = DistilledClassifier(n_features=args.features, C=args.C).fit(
+        [texts[i] for i in train_rows], data['categories'], data['scores'][train_rows])
+    print(f"🧪 Ученик обучен на {len(train_rows)} письмах за {time.perf_counter() - start:.1f} с")
+
+    report = agreement_report(student, [texts[i] for i in test_rows], data['categories'],
+                              data['scores'][test_rows], data['teacher_ms_per_email'], args.target_agreement)
+    student.cutoff = report['cutoff']
+    student.teacher_model = data['model']
+    student.save(args.output)
+
+    print(f"📊 Отложено {report['emails']} писем, согласие с учителем {report['agreement']:.1%}")
+    for row in report['coverage_table']:
+        print(f"  отвечает на {row['coverage']:6.1%} писем (порог {row['cutoff']:.3f}): "
+              f"согласие {row['agreement']:.1%}")
+    if report['cutoff'] is None:
+        print(f"⚠️ Согласие {args.target_agreement:.0%} не достигается ни при каком пороге - "
+              f"уровень будет отдавать все письма трансформеру")
+    else:
+        print(f"  Порог {report['cutoff']:.3f}: ученик отвечает на {report['coverage']:.1%} писем, "
+              f"согласие на них {report['answered_agreement']:.1%}")
+    print(f"⚡ Ученик {report['student_ms_per_email']:.3f} мс/письмо, трансформер "
+          f"{report['teacher_ms_per_email']:.2f} мс/письмо: ускорение x{report['speedup']:.0f}, "
+          f"с откладыванием в трансформер x{report['cascade_speedup']:.1f}")
+    print(f"💾 Модель сохранена: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
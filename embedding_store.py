@@ -0,0 +1,248 @@
+"""
+EMBEDDING_STORE.PY - Персистентное хранилище эмбеддингов писем
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from compact_embeddings import blob_to_vector, vector_to_blob
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_DTYPES = ('float32', 'float16', 'int8')
+
+# Ограничение SQLite на число параметров в одном запросе
+_SQL_CHUNK = 500
+
+# last_used обновляется при чтении, только если устарел больше чем на столько секунд:
+# точности хватает для вытеснения при компакции, а повторные чтения не пишут в базу
+LAST_USED_RESOLUTION_S = float(os.getenv('EMBEDDING_STORE_LAST_USED_RESOLUTION_S', '600'))
+
+
+class EmbeddingStore:
+    """Хранилище эмбеддингов на SQLite
+
+    Ключ - хэш текста вместе с именем модели, значение - сырой вектор
+    (float32, float16 или int8 с масштабом на вектор), а не итоговый
+    результат классификации. Поэтому записи остаются валидными при смене
+    категорий и порога.
+    """
+
+    def __init__(self, path: str = "config/embeddings.sqlite", dtype: str = "float16"):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Неподдерживаемый тип хранения: {dtype}")
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                dtype TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+
+        logger.info(f"Хранилище эмбеддингов открыто: {self.path} ({self.dtype})")
+
+    @staticmethod
+    def make_key(text: str, model_name: str) -> str:
+        """Ключ записи: blake2b от имени модели и текста"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(model_name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8', errors='surrogatepass'))
+        return digest.hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Пакетное чтение векторов (float32) по ключам"""
+        found = {}
+        if not keys:
+            return found
+
+        unique_keys = list(dict.fromkeys(keys))
+        now = time.time()
+        stale_before = now - LAST_USED_RESOLUTION_S
+        stale = []
+        with self._lock:
+            for start in range(0, len(unique_keys), _SQL_CHUNK):
+                chunk = unique_keys[start:start + _SQL_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, dtype, vector, last_used FROM embeddings WHERE key IN ({placeholders})",
+                    chunk
+                ).fetchall()
+
+                for key, dtype, blob, last_used in rows:
+                    found[key] = blob_to_vector(blob, dtype)
+                    if last_used < stale_before:
+                        stale.append(key)
+
+            if stale:
+                self._touch(stale, now)
+
+            self.hits += len(found)
+            self.misses += len(unique_keys) - len(found)
+
+        return found
+
+    def _touch(self, keys: List[str], now: float):
+        """Обновление last_used одной транзакцией (вызывается под блокировкой)"""
+        self._conn.execute("BEGIN")
+        try:
+            for start in range(0, len(keys), _SQL_CHUNK):
+                chunk = keys[start:start + _SQL_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                self._conn.execute(
+                    f"UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})",
+                    [now] + chunk
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def put_many(self, items: Dict[str, np.ndarray], model_name: str):
+        """Пакетная запись векторов"""
+        if not items:
+            return
+
+        now = time.time()
+        rows = []
+        for key, vector in items.items():
+            rows.append((key, model_name, int(np.shape(vector)[-1]), self.dtype,
+                         vector_to_blob(vector, self.dtype), now, now))
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings "
+                    "(key, model, dim, dtype, vector, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def info(self) -> Dict:
+        """Краткая информация без обращения к базе"""
+        total = self.hits + self.misses
+        return {
+            'path': str(self.path),
+            'dtype': self.dtype,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+    def stats(self) -> Dict:
+        """Учёт размера: число записей, байты векторов и файла по моделям"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT model, COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings GROUP BY model"
+            ).fetchall()
+            page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+            freelist = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+        models = {model: {'entries': count, 'vector_bytes': size} for model, count, size in rows}
+        stats = self.info()
+        stats.update({
+            'entries': sum(m['entries'] for m in models.values()),
+            'vector_bytes': sum(m['vector_bytes'] for m in models.values()),
+            'file_bytes': page_count * page_size,
+            'free_bytes': freelist * page_size,
+            'models': models
+        })
+        return stats
+
+    def compact(self, keep_model: Optional[str] = None, max_entries: Optional[int] = None) -> Dict:
+        """Компакция: удаление записей других моделей, давно неиспользуемых записей и VACUUM"""
+        before = self.stats()
+
+        with self._lock:
+            if keep_model:
+                self._conn.execute("DELETE FROM embeddings WHERE model != ?", (keep_model,))
+
+            if max_entries is not None:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key NOT IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used DESC LIMIT ?)",
+                    (max_entries,)
+                )
+
+            self._conn.execute("VACUUM")
+
+        after = self.stats()
+        logger.info(
+            f"Компакция хранилища эмбеддингов: {before['entries']} -> {after['entries']} записей, "
+            f"{before['file_bytes']} -> {after['file_bytes']} байт"
+        )
+        return {'before': before, 'after': after}
+
+    def clear(self):
+        """Удаление всех записей"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+        logger.info("Хранилище эмбеддингов очищено")
+
+    def close(self):
+        """Закрытие соединения"""
+        with self._lock:
+            self._conn.close()
+
+
+def main():
+    """CLI: статистика и компакция хранилища"""
+    parser = argparse.ArgumentParser(description="Управление хранилищем эмбеддингов MailLens")
+    parser.add_argument("command", choices=["stats", "compact", "clear"])
+    parser.add_argument("--path", default=os.getenv("EMBEDDING_STORE_PATH", "config/embeddings.sqlite"))
+    parser.add_argument("--keep-model", default=None, help="Оставить только записи этой модели")
+    parser.add_argument("--max-entries", type=int, default=None, help="Оставить N последних использованных записей")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.path, dtype=os.getenv("EMBEDDING_STORE_DTYPE", "float16"))
+    try:
+        if args.command == "stats":
+            stats = store.stats()
+            print(f"Записей: {stats['entries']}")
+            print(f"Векторы: {stats['vector_bytes'] / 1024 / 1024:.1f} МБ")
+            print(f"Файл: {stats['file_bytes'] / 1024 / 1024:.1f} МБ (свободно {stats['free_bytes'] / 1024 / 1024:.1f} МБ)")
+            for model, model_stats in stats['models'].items():
+                print(f"  • {model}: {model_stats['entries']} записей")
+        elif args.command == "compact":
+            report = store.compact(keep_model=args.keep_model, max_entries=args.max_entries)
+            print(f"Записей: {report['before']['entries']} -> {report['after']['entries']}")
+            print(f"Файл: {report['before']['file_bytes']} -> {report['after']['file_bytes']} байт")
+        else:
+            store.clear()
+            print("Хранилище очищено")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 Ансамблирование моделей для повышения точности
 """
 
+import re
 import numpy as np
 from typing import Dict, List, Tuple, Any
 from sklearn.feature_extraction.text import TfidfVectorizer
@@ -251,6 +252,11 @@ class HybridMailClassifier:
     
     def __init__(self):
         self.rule_based_rules = self._init_rules()
+        # Выражения компилируются один раз, а не на каждом письме
+        self._compiled_rules = {
+            category: [(re.compile(pattern), weight) for pattern, weight in rules]
+            for category, rules in self.rule_based_rules.items()
+        }
         self.ml_model = None
         
     def _init_rules(self) -> Dict:
@@ -283,10 +289,10 @@ class HybridMailClassifier:
         text_lower = text.lower()
         scores = {}
         
-        for category, rules in self.rule_based_rules.items():
+        for category, rules in self._compiled_rules.items():
             category_score = 0
             for pattern, weight in rules:
-                if re.search(pattern, text_lower):
+                if pattern.search(text_lower):
                     category_score += weight
             
             if category_score > 0:
@@ -0,0 +1,434 @@
+"""
+FEW_SHOT.PY - Банк few-shot примеров с предвычисленными центроидами
+
+Каждый пример кодируется один раз при добавлении. Для категории хранятся
+сумма нормализованных эмбеддингов и число примеров, поэтому центроид
+обновляется за O(dim) при добавлении и удалении примера и не зависит от
+того, сколько примеров уже накоплено.
+
+На диске банк - examples.json (тексты, категории, модель) и
+embeddings-<хэш>.npy, который при старте открывается через mmap без запуска
+модели. examples.json ссылается на файл матрицы по имени и заменяется
+последним, поэтому сбой посреди сохранения оставляет прежнюю согласованную
+пару файлов.
+
+Пример:
+    python few_shot.py import labeled.csv --text-column text --category-column category
+"""
+
+import os
+import csv
+import json
+import hashlib
+import logging
+import argparse
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_DIGEST_MOD = 1 << 128
+BANK_FORMAT_VERSION = 1
+
+
+def _example_digest(category: str, text: str) -> int:
+    data = f"{category}\0{text}".encode('utf-8', errors='surrogatepass')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=16).digest(), 'little')
+
+
+class FewShotBank:
+    """Эмбеддинги few-shot примеров и суммы по категориям
+
+    Эмбеддинги лежат построчно в растущей float32 матрице (ёмкость
+    удваивается). Примеры, добавленные до загрузки модели, ждут в очереди
+    и кодируются одним пакетом в encode_pending().
+    """
+
+    def __init__(self, dim: Optional[int] = None, initial_capacity: int = 64):
+        self.dim = dim
+        self._initial_capacity = initial_capacity
+        self._matrix = None
+        self._size = 0
+
+        self.labels: List[str] = []     # категория каждой строки матрицы
+        self.texts: List[str] = []      # текст каждой строки матрицы
+        self._codes = None              # int32 код категории каждой строки (для kNN)
+        self.label_index: Dict[str, int] = {}
+        self.label_names: List[str] = []
+        self._pending: Dict[Tuple[str, str], None] = {}  # ожидают кодирования, порядок добавления
+        self._pending_counts: Dict[str, int] = {}
+        self._row_of: Dict[Tuple[str, str], int] = {}   # (категория, текст) -> строка
+
+        self._sums: Dict[str, np.ndarray] = {}
+        self._counts: Dict[str, int] = {}
+
+        # Версия содержимого: сумма хэшей примеров, не зависит от порядка добавления
+        self._digest_acc = 0
+        self._lock = threading.RLock()
+
+    # ---------- содержимое ----------
+    @property
+    def version(self) -> str:
+        return f"{self._digest_acc:032x}:{len(self)}"
+
+    def __len__(self) -> int:
+        return self._size + len(self._pending)
+
+    @property
+    def lock(self) -> threading.RLock:
+        """Блокировка изменений: под ней matrix/codes согласованы для чтения"""
+        return self._lock
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Эмбеддинги закодированных примеров (представление без копии)"""
+        if self._matrix is None:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return self._matrix[:self._size]
+
+    @property
+    def codes(self) -> np.ndarray:
+        """Коды категорий строк матрицы (индексы в label_names)"""
+        if self._codes is None:
+            return np.empty(0, dtype=np.int32)
+        return self._codes[:self._size]
+
+    def examples(self) -> Dict[str, List[str]]:
+        """Тексты примеров по категориям (включая ожидающие кодирования)"""
+        result: Dict[str, List[str]] = {}
+        with self._lock:
+            for category, text in zip(self.labels, self.texts):
+                result.setdefault(category, []).append(text)
+            for category, text in self._pending:
+                result.setdefault(category, []).append(text)
+        return result
+
+    def counts(self) -> Dict[str, int]:
+        result = dict(self._counts)
+        for category, count in self._pending_counts.items():
+            result[category] = result.get(category, 0) + count
+        return result
+
+    def has_examples(self, category: str) -> bool:
+        return self._counts.get(category, 0) > 0 or category in self._pending_counts
+
+    def __contains__(self, item: Tuple[str, str]) -> bool:
+        return item in self._row_of or item in self._pending
+
+    # ---------- изменение ----------
+    def add(self, category: str, text: str, vector: Optional[np.ndarray] = None) -> bool:
+        """Добавление примера; без вектора пример ждёт encode_pending()
+
+        Повторное добавление того же примера ничего не делает (False).
+        """
+        with self._lock:
+            if (category, text) in self:
+                return False
+            self._digest_acc = (self._digest_acc + _example_digest(category, text)) % _DIGEST_MOD
+            if vector is None:
+                self._pending[(category, text)] = None
+                self._pending_counts[category] = self._pending_counts.get(category, 0) + 1
+            else:
+                self._append(category, text, vector)
+            return True
+
+    def add_many(self, items: List[Tuple[str, str]], vectors: np.ndarray) -> int:
+        """Пакетное добавление уже закодированных примеров; возвращает число новых"""
+        added = 0
+        with self._lock:
+            for (category, text), vector in zip(items, vectors):
+                if (category, text) in self:
+                    continue
+                added += 1
+                self._digest_acc = (self._digest_acc + _example_digest(category, text)) % _DIGEST_MOD
+                self._append(category, text, vector)
+        return added
+
+    def remove(self, category: str, text: str) -> bool:
+        """Удаление одного примера категории по тексту"""
+        with self._lock:
+            if (category, text) in self._pending:
+                del self._pending[(category, text)]
+                self._pending_counts[category] -= 1
+                if not self._pending_counts[category]:
+                    del self._pending_counts[category]
+            else:
+                row = self._row_of.get((category, text))
+                if row is None:
+                    return False
+                self._remove_row(row)
+
+            self._digest_acc = (self._digest_acc - _example_digest(category, text)) % _DIGEST_MOD
+            return True
+
+    def remove_category(self, category: str) -> int:
+        """Удаление всех примеров категории"""
+        with self._lock:
+            removed = 0
+            for text in self.examples().get(category, []):
+                removed += self.remove(category, text)
+            return removed
+
+    def encode_pending(self, encode_fn: Callable[[List[str]], np.ndarray]) -> List[str]:
+        """Кодирование ожидающих примеров одним пакетом; возвращает их категории"""
+        with self._lock:
+            if not self._pending:
+                return []
+            pending = list(self._pending)
+            vectors = encode_fn([text for _, text in pending])
+            self._pending = {}
+            self._pending_counts = {}
+            for (category, text), vector in zip(pending, vectors):
+                self._append(category, text, vector)
+            return sorted({category for category, _ in pending})
+
+    def _append(self, category: str, text: str, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vector.shape[0]
+
+        if self._matrix is None or self._size == self._matrix.shape[0] or not self._matrix.flags.writeable:
+            capacity = max(self._initial_capacity, 2 * self._size, self._size + 1)
+            grown = np.empty((capacity, self.dim), dtype=np.float32)
+            grown_codes = np.empty(capacity, dtype=np.int32)
+            if self._matrix is not None:
+                grown[:self._size] = self._matrix[:self._size]
+                grown_codes[:self._size] = self._codes[:self._size]
+            self._matrix = grown
+            self._codes = grown_codes
+
+        code = self.label_index.get(category)
+        if code is None:
+            code = self.label_index[category] = len(self.label_names)
+            self.label_names.append(category)
+
+        self._matrix[self._size] = vector
+        self._codes[self._size] = code
+        self._row_of[(category, text)] = self._size
+        self._size += 1
+        self.labels.append(category)
+        self.texts.append(text)
+
+        if category in self._sums:
+            self._sums[category] += vector
+        else:
+            self._sums[category] = vector.astype(np.float64)
+        self._counts[category] = self._counts.get(category, 0) + 1
+
+    def _remove_row(self, row: int):
+        self._ensure_writable()
+        category = self.labels[row]
+        vector = self._matrix[row]
+
+        self._counts[category] -= 1
+        if self._counts[category] == 0:
+            del self._counts[category]
+            del self._sums[category]
+        else:
+            self._sums[category] -= vector
+
+        # Последняя строка переезжает на место удалённой
+        last = self._size - 1
+        del self._row_of[(category, self.texts[row])]
+        if row != last:
+            self._matrix[row] = self._matrix[last]
+            self._codes[row] = self._codes[last]
+            self.labels[row] = self.labels[last]
+            self.texts[row] = self.texts[last]
+            self._row_of[(self.labels[row], self.texts[row])] = row
+        self.labels.pop()
+        self.texts.pop()
+        self._size = last
+
+    # ---------- центроиды ----------
+    def centroid(self, category: str) -> Optional[np.ndarray]:
+        """Нормализованный центроид закодированных примеров категории"""
+        with self._lock:
+            total = self._sums.get(category)
+            if total is None:
+                return None
+            return (total / max(float(np.linalg.norm(total)), 1e-12)).astype(np.float32)
+
+    def clear(self):
+        with self._lock:
+            self._matrix = None
+            self._codes = None
+            self._size = 0
+            self.label_index.clear()
+            self.label_names.clear()
+            self.labels.clear()
+            self.texts.clear()
+            self._pending.clear()
+            self._pending_counts.clear()
+            self._row_of.clear()
+            self._sums.clear()
+            self._counts.clear()
+            self._digest_acc = 0
+
+    def stats(self) -> Dict:
+        return {
+            'examples': len(self),
+            'encoded': self._size,
+            'pending': len(self._pending),
+            'categories': len(self._counts),
+            'matrix_bytes': int(self._matrix.nbytes) if self._matrix is not None else 0,
+            'memory_mapped': isinstance(self._matrix, np.memmap)
+        }
+
+    def _ensure_writable(self):
+        """Копия матрицы в память перед изменением строк (после загрузки через mmap)"""
+        if self._matrix is not None and not self._matrix.flags.writeable:
+            self._matrix = np.array(self._matrix[:self._size], dtype=np.float32)
+
+    # ---------- хранение ----------
+    def save(self, directory, model_id: str):
+        """Сохранение: examples.json (тексты и суммы) и embeddings-<хэш>.npy
+
+        Матрица пишется в новый файл с хэшем содержимого в имени, затем
+        examples.json со ссылкой на него атомарно заменяет старый. Прежние
+        файлы матрицы удаляются только после этого.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        with self._lock:
+            matrix = np.ascontiguousarray(self.matrix, dtype=np.float32)
+            matrix_name = f"embeddings-{hashlib.blake2b(matrix.tobytes(), digest_size=8).hexdigest()}.npy"
+            meta = {
+                'format': BANK_FORMAT_VERSION,
+                'model_id': model_id,
+                'dim': self.dim,
+                'version': self.version,
+                'embeddings': matrix_name,
+                'rows': int(matrix.shape[0]),
+                'examples': [{'category': c, 'text': t} for c, t in zip(self.labels, self.texts)],
+                'pending': [{'category': c, 'text': t} for c, t in self._pending],
+                'sums': {c: total.tolist() for c, total in self._sums.items()},
+                'counts': dict(self._counts)
+            }
+
+            npy_tmp = directory / 'embeddings.tmp.npy'
+            json_tmp = directory / 'examples.tmp.json'
+            np.save(npy_tmp, matrix)
+            os.replace(npy_tmp, directory / matrix_name)
+            with open(json_tmp, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(json_tmp, directory / 'examples.json')
+
+            # Старые матрицы больше не нужны (открытые через mmap остаются доступны до закрытия)
+            for stale in list(directory.glob('embeddings-*.npy')) + [directory / 'embeddings.npy']:
+                if stale.name != matrix_name and stale.exists():
+                    stale.unlink()
+
+        logger.info(f"💾 Few-shot банк сохранён: {len(self)} примеров в {directory}")
+
+    @classmethod
+    def load(cls, directory, model_id: str) -> 'FewShotBank':
+        """Загрузка банка; эмбеддинги открываются через mmap (только чтение)
+
+        Если банк сохранён для другой модели, тексты загружаются как
+        ожидающие кодирования.
+        """
+        directory = Path(directory)
+        bank = cls()
+        meta_path = directory / 'examples.json'
+        if not meta_path.exists():
+            return bank
+
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        examples = [(e['category'], e['text']) for e in meta.get('examples', [])]
+        pending = [(e['category'], e['text']) for e in meta.get('pending', [])]
+
+        if meta.get('format') != BANK_FORMAT_VERSION or meta.get('model_id') != model_id or not examples:
+            if examples and meta.get('model_id') != model_id:
+                logger.warning(
+                    f"Few-shot банк сохранён для {meta.get('model_id')}, текущая модель {model_id}: "
+                    f"{len(examples)} примеров будут перекодированы"
+                )
+            for category, text in examples + pending:
+                bank.add(category, text)
+            return bank
+
+        # Банки старого формата хранили матрицу в embeddings.npy
+        matrix = np.load(directory / meta.get('embeddings', 'embeddings.npy'), mmap_mode='r')
+        if matrix.shape[0] != meta.get('rows', len(examples)) or matrix.shape[0] != len(examples):
+            raise ValueError(f"Повреждён few-shot банк {directory}: {matrix.shape[0]} векторов, "
+                             f"{len(examples)} текстов")
+
+        bank.dim = int(matrix.shape[1])
+        bank._matrix = matrix
+        bank._size = len(examples)
+        bank._codes = np.empty(len(examples), dtype=np.int32)
+        for row, (category, text) in enumerate(examples):
+            code = bank.label_index.get(category)
+            if code is None:
+                code = bank.label_index[category] = len(bank.label_names)
+                bank.label_names.append(category)
+            bank._codes[row] = code
+            bank._row_of[(category, text)] = row
+            bank._digest_acc = (bank._digest_acc + _example_digest(category, text)) % _DIGEST_MOD
+        bank.labels = [c for c, _ in examples]
+        bank.texts = [t for _, t in examples]
+
+        # Суммы сохранены - матрицу для центроидов читать не нужно
+        bank._sums = {c: np.asarray(total, dtype=np.float64) for c, total in meta['sums'].items()}
+        bank._counts = {c: int(n) for c, n in meta['counts'].items()}
+
+        for category, text in pending:
+            bank.add(category, text)
+        return bank
+
+
+def read_labeled_csv(source, text_column: str = 'text',
+                     category_column: str = 'category') -> Iterator[Tuple[str, str]]:
+    """Потоковое чтение (категория, текст) из размеченного CSV (путь или текстовый поток)"""
+    if hasattr(source, 'read'):
+        yield from _read_labeled_rows(source, text_column, category_column)
+        return
+    with open(source, 'r', encoding='utf-8-sig', newline='') as f:
+        yield from _read_labeled_rows(f, text_column, category_column)
+
+
+def _read_labeled_rows(f, text_column: str, category_column: str) -> Iterator[Tuple[str, str]]:
+    reader = csv.DictReader(f)
+    missing = {text_column, category_column} - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f"В CSV нет колонок: {', '.join(sorted(missing))}")
+    for row in reader:
+        text = (row.get(text_column) or '').strip()
+        category = (row.get(category_column) or '').strip()
+        if text and category:
+            yield category, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Few-shot банк MailLens")
+    parser.add_argument("command", choices=["import", "stats"])
+    parser.add_argument("csv", nargs="?", help="Размеченный CSV для импорта")
+    parser.add_argument("--text-column", default="text")
+    parser.add_argument("--category-column", default="category")
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    from core import classifier
+
+    if args.command == "import":
+        if not args.csv:
+            parser.error("укажите CSV для импорта")
+        added = classifier.import_few_shot_csv(args.csv, args.text_column, args.category_column,
+                                               batch_size=args.batch_size)
+        print(f"✅ Добавлено примеров: {added}")
+
+    for key, value in classifier.few_shot.stats().items():
+        print(f"  • {key}: {value}")
+    for category, count in sorted(classifier.few_shot.counts().items()):
+        print(f"    {category}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+INFERENCE_BACKENDS.PY - Бэкенды инференса для ZeroShotMailClassifier
+
+torch      - SentenceTransformer на PyTorch (fp32)
+onnx       - экспортированная ONNX модель в ONNX Runtime
+onnx-int8  - та же модель с динамической int8 квантизацией весов
+"""
+
+import os
+import re
+import time
+import logging
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+
+def _hub_model_name(model_name: str) -> str:
+    """Полное имя модели на HuggingFace Hub"""
+    return model_name if '/' in model_name else f"sentence-transformers/{model_name}"
+
+
+def _load_sentence_transformer(model_name: str, device: str = "cpu"):
+    from sentence_transformers import SentenceTransformer
+
+    if device == "cuda":
+        return SentenceTransformer(model_name, device='cuda')
+    return SentenceTransformer(model_name)
+
+
+class OnnxBackend:
+    """Sentence-эмбеддинги через ONNX Runtime
+
+    Повторяет пайплайн SentenceTransformer (токенизация, mean pooling,
+    нормализация) и предоставляет совместимый метод encode(). Экспорт и
+    квантизация выполняются один раз, артефакт кэшируется на диске.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str = "config/onnx", quantize: bool = False,
+                 num_threads: Optional[int] = None):
+        import onnxruntime as ort
+
+        self.model_name = model_name
+        self.quantize = quantize
+        self.model_dir = Path(cache_dir) / re.sub(r'[^\w.-]+', '_', model_name)
+        self.model_path = self._ensure_exported()
+
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(str(self.model_dir))
+        self.max_seq_length = int((self.model_dir / "max_seq_length.txt").read_text())
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            str(self.model_path), sess_options=options, providers=['CPUExecutionProvider']
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        logger.info(f"✅ ONNX Runtime сессия создана: {self.model_path.name}")
+
+    def _ensure_exported(self) -> Path:
+        """Экспорт в ONNX (и квантизация) при первом запуске"""
+        fp32_path = self.model_dir / "model.onnx"
+        int8_path = self.model_dir / "model-int8.onnx"
+
+        if not fp32_path.exists():
+            self._export(fp32_path)
+
+        if not self.quantize:
+            return fp32_path
+
+        if not int8_path.exists():
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            logger.info("🔄 Динамическая int8 квантизация ONNX модели...")
+            quantize_dynamic(str(fp32_path), str(int8_path), weight_type=QuantType.QInt8)
+            logger.info(f"✅ Квантизованная модель сохранена: {int8_path}")
+
+        return int8_path
+
+    def _export(self, onnx_path: Path):
+        import torch
+
+        logger.info(f"🔄 Экспорт {self.model_name} в ONNX...")
+        self.model_dir.mkdir(parents=True, exist_ok=True)
+
+        st_model = _load_sentence_transformer(self.model_name)
+        transformer = st_model[0].auto_model.eval()
+        tokenizer = st_model.tokenizer
+
+        dummy = tokenizer(["пример текста для экспорта"], return_tensors="pt", padding=True)
+        input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in dummy]
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+        with torch.no_grad():
+            torch.onnx.export(
+                transformer,
+                tuple(dummy[name] for name in input_names),
+                str(onnx_path),
+                input_names=input_names,
+                output_names=["last_hidden_state"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+                do_constant_folding=True
+            )
+
+        tokenizer.save_pretrained(str(self.model_dir))
+        (self.model_dir / "max_seq_length.txt").write_text(str(st_model.max_seq_length))
+        logger.info(f"✅ ONNX модель сохранена: {onnx_path}")
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return int(self.session.get_outputs()[0].shape[-1])
+
+    def encode(self, texts: List[str], batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, show_progress_bar: bool = False, **kwargs) -> np.ndarray:
+        """Кодирование текстов (совместимо с SentenceTransformer.encode)"""
+        if isinstance(texts, str):
+            texts = [texts]
+
+        # Как и SentenceTransformer, группируем тексты близкой длины
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        embeddings = [None] * len(texts)
+
+        for start in range(0, len(texts), batch_size):
+            idx = order[start:start + batch_size]
+            encoded = self.tokenizer(
+                [texts[i] for i in idx],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            feeds = {name: encoded[name].astype(np.int64) for name in self.input_names if name in encoded}
+            hidden = self.session.run(None, feeds)[0]
+
+            # Mean pooling по маске внимания
+            mask = encoded["attention_mask"][..., np.newaxis].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+            if normalize_embeddings:
+                pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+            for row, i in enumerate(idx):
+                embeddings[i] = pooled[row]
+
+        return np.stack(embeddings).astype(np.float32)
+
+
+def create_backend(backend: str, model_name: str, device: str = "cpu", cache_dir: str = None,
+                   num_threads: Optional[int] = None):
+    """Создание модели-кодировщика для выбранного бэкенда (num_threads - потоки ONNX Runtime)"""
+    if backend not in SUPPORTED_BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд инференса: {backend}")
+
+    if backend == 'torch':
+        return _load_sentence_transformer(model_name, device)
+
+    return OnnxBackend(
+        _hub_model_name(model_name),
+        cache_dir=cache_dir or os.getenv('ONNX_CACHE_DIR', 'config/onnx'),
+        quantize=(backend == 'onnx-int8'),
+        num_threads=num_threads
+    )
+
+
+def backend_drift_report(model_name: str, texts: List[str], backends: List[str] = None,
+                         reference: str = 'torch', batch_size: int = 32) -> Dict:
+    """Косинусный дрейф эмбеддингов бэкендов относительно эталонного"""
+    backends = backends or [b for b in SUPPORTED_BACKENDS if b != reference]
+
+    def run(name):
+        encoder = create_backend(name, model_name)
+        encoder.encode(texts[:batch_size], batch_size=batch_size, normalize_embeddings=True)  # прогрев
+        start = time.perf_counter()
+        vectors = encoder.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+        elapsed = time.perf_counter() - start
+        return np.asarray(vectors, dtype=np.float32), elapsed
+
+    ref_vectors, ref_time = run(reference)
+    report = {
+        'reference': reference,
+        'texts': len(texts),
+        'backends': {reference: {'texts_per_sec': len(texts) / ref_time}}
+    }
+
+    for name in backends:
+        vectors, elapsed = run(name)
+        cosine = np.sum(ref_vectors * vectors, axis=1)
+        report['backends'][name] = {
+            'mean_cosine': float(cosine.mean()),
+            'min_cosine': float(cosine.min()),
+            'p05_cosine': float(np.percentile(cosine, 5)),
+            'texts_per_sec': len(texts) / elapsed,
+            'speedup': ref_time / elapsed
+        }
+
+    return report
+
+
+def main():
+    """CLI: экспорт артефактов и проверка дрейфа на размеченном корпусе"""
+    parser = argparse.ArgumentParser(description="Бэкенды инференса MailLens")
+    parser.add_argument("command", choices=["export", "drift"])
+    parser.add_argument("--model", default="paraphrase-multilingual-MiniLM-L12-v2")
+    parser.add_argument("--backend", default="onnx-int8", choices=SUPPORTED_BACKENDS)
+    parser.add_argument("--test-dir", default="test_emails")
+    parser.add_argument("--limit", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        create_backend(args.backend, args.model)
+        print(f"✅ Артефакт {args.backend} готов")
+        return
+
+    from core import load_labeled_emails
+
+    texts = [email['text'] for email in load_labeled_emails(args.test_dir, limit=args.limit)]
+    if not texts:
+        print(f"❌ Нет размеченных писем в {args.test_dir}")
+        return
+
+    report = backend_drift_report(args.model, texts)
+    print(f"Писем: {report['texts']}, эталон: {report['reference']}")
+    for name, stats in report['backends'].items():
+        line = f"  • {name}: {stats['texts_per_sec']:.1f} писем/с"
+        if 'mean_cosine' in stats:
+            line += (f", cos mean={stats['mean_cosine']:.4f} min={stats['min_cosine']:.4f}"
+                     f" p5={stats['p05_cosine']:.4f}, ускорение x{stats['speedup']:.2f}")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+INFERENCE_PROFILE.PY - Профили CPU-инференса по типам узлов
+
+Чтение и запись config/inference_profile.json (его заполняет autotune.py)
+и применение настроек потоков torch. Общая часть для autotune.py и
+ZeroShotMailClassifier, без зависимостей тюнера.
+"""
+
+import os
+import json
+import logging
+import platform
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_PROFILE_VERSION = 1
+
+
+def available_cpus() -> int:
+    """Ядра, доступные процессу (с учётом cpuset контейнера)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _cpu_model() -> str:
+    try:
+        with open('/proc/cpuinfo', 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or 'unknown'
+
+
+def node_signature() -> str:
+    """Тип узла: архитектура, модель CPU и число доступных ядер"""
+    return f"{platform.machine()}|{_cpu_model()}|{available_cpus()}cpu"
+
+
+def load_profiles(path: str) -> Dict[str, Dict]:
+    """Все сохранённые профили: сигнатура узла -> профиль"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version') != INFERENCE_PROFILE_VERSION:
+        raise ValueError(f"Неподдерживаемая версия профиля инференса: {data.get('version')}")
+    return data.get('profiles', {})
+
+
+def load_profile_for_node(path: str, model_name: str, backend: str) -> Optional[Dict]:
+    """Профиль текущего узла для модели и бэкенда или None"""
+    try:
+        profiles = load_profiles(path)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ Профиль инференса не прочитан ({path}): {e}")
+        return None
+
+    signature = node_signature()
+    profile = profiles.get(signature)
+    if profile is None:
+        if profiles:
+            logger.info(f"Профиля инференса для узла {signature} нет - настройки по умолчанию")
+        return None
+    if profile.get('model') != model_name or profile.get('backend') != backend:
+        logger.warning(
+            f"⚠️ Профиль инференса подобран для {profile.get('model')} ({profile.get('backend')}), "
+            f"а загружается {model_name} ({backend}) - не применяю"
+        )
+        return None
+    return profile
+
+
+def save_profile(path: str, profile: Dict):
+    """Запись профиля узла; профили других узлов в файле сохраняются"""
+    profiles = load_profiles(path) if os.path.exists(path) else {}
+    profiles[profile['node']] = profile
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': INFERENCE_PROFILE_VERSION, 'profiles': profiles}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def apply_thread_settings(profile: Dict):
+    """Потоки torch из профиля (до загрузки модели и первого инференса)"""
+    try:
+        import torch
+    except ImportError:
+        return
+    if profile.get('num_threads'):
+        torch.set_num_threads(int(profile['num_threads']))
+    if profile.get('interop_threads'):
+        try:
+            torch.set_num_interop_threads(int(profile['interop_threads']))
+        except RuntimeError as e:
+            logger.warning(f"⚠️ Межоператорные потоки уже заданы, профиль не применён: {e}")
@@ -0,0 +1,211 @@
+"""
+INFERENCE_SCHEDULER.PY - Микро-батчинг запросов к классификатору
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future, InvalidStateError
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_MAX_BATCH = int(os.getenv('SCHEDULER_MAX_BATCH', '32'))
+SCHEDULER_MAX_WAIT_MS = float(os.getenv('SCHEDULER_MAX_WAIT_MS', '5'))
+
+_STOP = object()
+
+
+class _Request:
+    __slots__ = ('text', 'top_n', 'use_cache', 'classifier', 'future', 'enqueued_at')
+
+    def __init__(self, text: str, top_n: int, use_cache: bool, classifier):
+        self.text = text
+        self.top_n = top_n
+        self.use_cache = use_cache
+        self.classifier = classifier
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatchScheduler:
+    """Планировщик инференса: объединяет запросы из многих потоков в пакеты
+
+    Пакет отправляется, когда набралось max_batch_size запросов или когда
+    первый запрос в пакете ждёт дольше max_wait_ms. Один пакет - один вызов
+    classify_batch, то есть один проход модели. Запрос может указать профиль
+    классификатора (classifier.profile()): пакет делится по профилям.
+    """
+
+    def __init__(self, classifier, max_batch_size: int = SCHEDULER_MAX_BATCH,
+                 max_wait_ms: float = SCHEDULER_MAX_WAIT_MS, history_size: int = 10000):
+        self.classifier = classifier
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0.0, max_wait_ms)
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # Статистика
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes = Counter()
+        self._wait_ms = deque(maxlen=history_size)
+        self._latency_ms = deque(maxlen=history_size)
+
+    def start(self):
+        """Запуск рабочего потока (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="maillens-batch-scheduler", daemon=True
+                )
+                self._thread.start()
+                logger.info(
+                    f"Планировщик запущен: пакет до {self.max_batch_size}, ожидание до {self.max_wait_ms} мс"
+                )
+        return self
+
+    def stop(self, timeout: float = 5.0):
+        """Остановка после обработки уже поставленных запросов"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def submit(self, text: str, top_n: int = 5, use_cache: bool = True, classifier=None) -> Future:
+        """Постановка запроса в очередь; результат - Future с dict как у classify()"""
+        # Поток перезапускается и после аварийного завершения
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        request = _Request(text, top_n, use_cache, classifier or self.classifier)
+        self._queue.put(request)
+        return request.future
+
+    def classify(self, text: str, top_n: int = 5, use_cache: bool = True,
+                 timeout: Optional[float] = None, classifier=None) -> Dict:
+        """Блокирующая классификация через общий пакет"""
+        return self.submit(text, top_n=top_n, use_cache=use_cache, classifier=classifier).result(timeout)
+
+    def classify_many(self, texts: List[str], top_n: int = 5, use_cache: bool = True,
+                      timeout: Optional[float] = None, classifier=None) -> List[Dict]:
+        """Классификация списка писем через общий пакет"""
+        futures = [self.submit(text, top_n=top_n, use_cache=use_cache, classifier=classifier)
+                   for text in texts]
+        return [future.result(timeout) for future in futures]
+
+    def _collect_batch(self, first: _Request) -> List[_Request]:
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait_ms / 1000.0
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+
+            # Отменённые вызывающей стороной запросы не обрабатываются
+            batch = [request for request in self._collect_batch(first)
+                     if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+
+            # classify_batch принимает один профиль и top_n - группируем по параметрам
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.classifier, request.top_n, request.use_cache), []).append(request)
+
+            for (classifier, top_n, use_cache), requests in groups.items():
+                try:
+                    # Размер пакета кодирования - из профиля инференса классификатора
+                    results = classifier.classify_batch(
+                        [r.text for r in requests],
+                        top_n=top_n,
+                        use_cache=use_cache
+                    )
+                    for request, result in zip(requests, results):
+                        self._resolve(request.future.set_result, result)
+                except Exception as e:
+                    logger.error(f"Ошибка пакетной классификации в планировщике: {e}")
+                    self.errors += len(requests)
+                    metrics.ERRORS.inc('scheduler', len(requests))
+                    for request in requests:
+                        self._resolve(request.future.set_exception, e)
+
+            finished = time.perf_counter()
+            self.batches += 1
+            self.requests += len(batch)
+            self.batch_sizes[len(batch)] += 1
+            for request in batch:
+                self._wait_ms.append((started - request.enqueued_at) * 1000)
+                self._latency_ms.append((finished - request.enqueued_at) * 1000)
+
+    @staticmethod
+    def _resolve(setter, value):
+        """Результат в Future; уже завершённый Future не должен останавливать поток"""
+        try:
+            setter(value)
+        except InvalidStateError:
+            logger.warning("Результат запроса планировщика уже установлен - пропускаю")
+
+    @staticmethod
+    def _percentiles(samples) -> Dict:
+        if not samples:
+            return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+        values = np.fromiter(list(samples), dtype=np.float64)
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(values.max())}
+
+    def stats(self) -> Dict:
+        """Глубина очереди, гистограмма размеров пакетов, перцентили ожидания и задержки"""
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'queue_depth': self._queue.qsize(),
+            'requests': self.requests,
+            'batches': self.batches,
+            'errors': self.errors,
+            'avg_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+            'wait_ms': self._percentiles(self._wait_ms),
+            'latency_ms': self._percentiles(self._latency_ms)
+        }
+
+
+_shared_scheduler = None
+_shared_lock = threading.Lock()
+
+
+def shared_scheduler(classifier, **kwargs) -> MicroBatchScheduler:
+    """Общий для процесса планировщик (один на все сессии UI)"""
+    global _shared_scheduler
+    with _shared_lock:
+        if _shared_scheduler is None or _shared_scheduler.classifier is not classifier:
+            if _shared_scheduler is not None:
+                _shared_scheduler.stop()
+            _shared_scheduler = MicroBatchScheduler(classifier, **kwargs).start()
+        return _shared_scheduler
@@ -0,0 +1,229 @@
+"""
+KEYWORD_RULES.PY - Ключевые слова категорий для демо-режима классификатора
+
+Таблицы ключевых слов всех групп категорий компилируются в одно регулярное
+выражение: текст проходится один раз, независимо от числа категорий и слов.
+Оценки категорий собираются в numpy-вектор.
+
+Слова собраны в префиксное дерево, и выражение строится по нему. Поэтому
+движок re быстро пропускает позиции, с которых не начинается ни одно слово.
+Каждое совпадение - самое длинное слово в своей позиции. Остальные слова,
+которые начинаются там же, - его префиксы, поэтому маска групп слова заранее
+включает группы его префиксов. Следующий поиск идёт со следующего символа,
+так что пересекающиеся слова тоже находятся.
+"""
+
+import re
+import hashlib
+import functools
+from typing import Callable, Dict, Sequence, Tuple
+
+import numpy as np
+
+# Категории без правил получают стабильную псевдослучайную оценку из этого диапазона
+UNKNOWN_SCORE_RANGE = (0.1, 0.4)
+UNDEFINED_SCORE = 0.1
+# Снижение уверенности для сложных текстов
+COMPLEX_TEXT_THRESHOLD = 0.7
+COMPLEX_TEXT_FACTOR = 0.9
+
+# Номера групп для особых категорий
+UNDEFINED = -1
+UNKNOWN = -2
+
+
+class KeywordRule:
+    """Группа категорий: признаки в названии, ключевые слова и бонусы по фичам"""
+
+    __slots__ = ('name', 'name_markers', 'keywords', 'weight', 'bonuses')
+
+    def __init__(self, name: str, name_markers: Sequence[str], keywords: Sequence[str], weight: float,
+                 bonuses: Sequence[Tuple[float, Callable[[Dict], bool]]] = ()):
+        self.name = name
+        self.name_markers = tuple(name_markers)
+        self.keywords = tuple(keywords)
+        self.weight = weight
+        self.bonuses = tuple(bonuses)
+
+
+# Порядок важен: категория относится к первой группе, признак которой есть в названии
+DEMO_RULES = [
+    KeywordRule('business', ('business', 'делов'),
+                ('предложен', 'сотрудничеств', 'партнерств', 'коммерческ', 'договор'), 0.8,
+                ((0.2, lambda f: f.get('formal_score', 0) > 0),
+                 (0.15, lambda f: f.get('formality_ratio', 0) > 0.7))),
+    KeywordRule('complaint', ('complaint', 'жалоб'),
+                ('жалоб', 'недовол', 'проблем', 'претензи', 'возражен'), 0.8,
+                ((0.2, lambda f: f.get('exclamation_count', 0) > 1),
+                 (0.15, lambda f: f.get('negative_score', 0) > f.get('positive_score', 0)))),
+    KeywordRule('support', ('support', 'поддерж', 'технич'),
+                ('помощ', 'поддержк', 'ошибк', 'техническ', 'сбо', 'не работ'), 0.8,
+                ((0.2, lambda f: f.get('question_count', 0) > 0),
+                 (0.15, lambda f: f.get('has_questions', False)))),
+    KeywordRule('spam', ('spam', 'реклам'),
+                ('выиграл', 'приз', 'акци', 'бесплатно', 'congratulation', 'распродаж', 'скидк'), 0.9,
+                ((0.2, lambda f: f.get('uppercase_ratio', 0) > 0.3),
+                 (0.15, lambda f: f.get('exclamation_count', 0) > 2))),
+    KeywordRule('personal', ('personal', 'личн'),
+                ('привет', 'здравств', 'спасиб', 'личн', 'встреч', 'как дела'), 0.7,
+                ((0.3, lambda f: f.get('has_greeting')),
+                 (0.15, lambda f: f.get('informal_score', 0) > 0))),
+    KeywordRule('finance', ('finance', 'финанс'),
+                ('счет', 'оплат', 'деньг', 'финанс', 'бюджет', 'платеж'), 0.8,
+                ((0.2, lambda f: f.get('has_numbers')),
+                 (0.15, lambda f: f.get('has_money')))),
+    KeywordRule('hr', ('hr', 'кадр', 'рекрут'),
+                ('ваканс', 'резюме', 'собеседован', 'работ', 'зарплат', 'отпуск'), 0.8,
+                ((0.2, lambda f: f.get('formal_score', 0) > 0),)),
+    KeywordRule('legal', ('legal', 'юрид', 'правов'),
+                ('договор', 'юрид', 'закон', 'прав', 'соглашен', 'контракт'), 0.8,
+                ((0.2, lambda f: f.get('formality_ratio', 0) > 0.8),)),
+    KeywordRule('news', ('news', 'новост'),
+                ('новост', 'анонс', 'объявлен', 'информиру', 'сообща'), 0.8,
+                ((0.2, lambda f: f.get('formal_score', 0) > 0),)),
+    KeywordRule('marketing', ('marketing', 'маркетинг'),
+                ('маркетинг', 'реклам', 'продвижен', 'клиент', 'продаж'), 0.8),
+]
+
+UNDEFINED_MARKERS = ('not defined', 'не определен')
+
+
+def unknown_category_score(category: str, text: str) -> float:
+    """Стабильная между процессами оценка категории без правил (вместо random.seed(hash(...)))"""
+    digest = hashlib.blake2b(f"{category}\x00{text[:50]}".encode('utf-8', errors='surrogatepass'),
+                             digest_size=8).digest()
+    low, high = UNKNOWN_SCORE_RANGE
+    return low + (high - low) * (int.from_bytes(digest, 'little') / 2 ** 64)
+
+
+def trie_pattern(words: Sequence[str]) -> str:
+    """Регулярное выражение по префиксному дереву слов (жадно - самое длинное слово)"""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def build(node) -> str:
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie)
+
+
+class KeywordScorer:
+    """Оценки категорий по ключевым словам за один проход по тексту"""
+
+    def __init__(self, rules: Sequence[KeywordRule] = DEMO_RULES):
+        self.rules = list(rules)
+        self.weights = np.array([rule.weight for rule in self.rules], dtype=np.float64)
+
+        groups_by_keyword: Dict[str, int] = {}
+        for idx, rule in enumerate(self.rules):
+            for keyword in rule.keywords:
+                groups_by_keyword[keyword] = groups_by_keyword.get(keyword, 0) | (1 << idx)
+
+        # Найденное в позиции слово - самое длинное; его префиксы-слова тоже есть в тексте
+        self._masks = {}
+        for keyword in groups_by_keyword:
+            mask = 0
+            for other, groups in groups_by_keyword.items():
+                if keyword.startswith(other):
+                    mask |= groups
+            self._masks[keyword] = mask
+
+        self._pattern = re.compile(trie_pattern(list(groups_by_keyword)))
+        self._bits = 1 << np.arange(len(self.rules), dtype=np.int64)
+        self._hit_vectors: Dict[int, np.ndarray] = {}   # маска групп -> вектор весов найденных групп
+
+        self._bonus_slots = max((len(rule.bonuses) for rule in self.rules), default=0)
+
+    @functools.lru_cache(maxsize=256)
+    def category_groups(self, categories: Tuple[str, ...]) -> np.ndarray:
+        """Номер группы правил для каждой категории (UNDEFINED, UNKNOWN - особые)"""
+        groups = np.full(len(categories), UNKNOWN, dtype=np.int64)
+        for i, category in enumerate(categories):
+            category_lower = category.lower()
+            for idx, rule in enumerate(self.rules):
+                if any(marker in category_lower for marker in rule.name_markers):
+                    groups[i] = idx
+                    break
+            else:
+                if any(marker in category_lower for marker in UNDEFINED_MARKERS):
+                    groups[i] = UNDEFINED
+        groups.setflags(write=False)
+        return groups
+
+    def _bonus_conditions(self, groups) -> list:
+        """Плоский список (вес, условие) групп: по _bonus_slots на группу, пропуски - (0, None)"""
+        return [
+            self.rules[idx].bonuses[slot] if slot < len(self.rules[idx].bonuses) else (0.0, None)
+            for idx in groups for slot in range(self._bonus_slots)
+        ]
+
+    @functools.lru_cache(maxsize=256)
+    def _plan(self, categories: Tuple[str, ...]):
+        """Разбор набора категорий (один раз на набор): какие группы правил нужны и куда их оценки"""
+        groups = self.category_groups(categories)
+        ruled = np.flatnonzero(groups >= 0)
+        # Только группы, которые есть среди категорий: лишние условия по фичам не проверяются
+        used, position = np.unique(groups[ruled], return_inverse=True)
+        return (ruled, position, used, self._bonus_conditions(used.tolist()),
+                np.flatnonzero(groups == UNDEFINED), np.flatnonzero(groups == UNKNOWN).tolist())
+
+    def matched_mask(self, text_lower: str) -> int:
+        """Битовая маска групп, ключевые слова которых есть в тексте"""
+        mask = 0
+        search = self._pattern.search
+        match = search(text_lower)
+        while match is not None:
+            mask |= self._masks[match.group()]
+            match = search(text_lower, match.start() + 1)
+        return mask
+
+    def matched_groups(self, text_lower: str) -> np.ndarray:
+        """Булев вектор групп, ключевые слова которых есть в тексте"""
+        return (self.matched_mask(text_lower) & self._bits) != 0
+
+    def _hit_weights(self, mask: int) -> np.ndarray:
+        weights = self._hit_vectors.get(mask)
+        if weights is None:
+            weights = np.where((mask & self._bits) != 0, self.weights, 0.0)
+            weights.setflags(write=False)
+            self._hit_vectors[mask] = weights
+        return weights
+
+    def feature_bonuses(self, features: Dict, conditions: list = None) -> np.ndarray:
+        """Бонусы групп по фичам письма: строка - группа, столбец - бонус по порядку правила"""
+        if conditions is None:
+            conditions = self._bonus_conditions(range(len(self.rules)))
+        values = [weight if condition is not None and condition(features) else 0.0
+                  for weight, condition in conditions]
+        return np.array(values, dtype=np.float64).reshape(-1, self._bonus_slots)
+
+    def score(self, text: str, features: Dict, categories: Sequence[str]) -> np.ndarray:
+        """Оценки категорий в [0, 1] в порядке categories"""
+        ruled, position, used, conditions, undefined, unknown = self._plan(tuple(categories))
+        scores = np.zeros(len(categories), dtype=np.float64)
+
+        if ruled.size:
+            group_scores = self._hit_weights(self.matched_mask(text.lower()))[used]
+            # Бонусы прибавляются по одному в порядке правила - суммы как у цепочки if
+            for column in self.feature_bonuses(features, conditions).T:
+                group_scores += column
+            scores[ruled] = group_scores[position]
+        scores[undefined] = UNDEFINED_SCORE
+        for i in unknown:
+            scores[i] = unknown_category_score(categories[i], text)
+
+        if features.get('text_complexity', 0) > COMPLEX_TEXT_THRESHOLD:
+            scores *= COMPLEX_TEXT_FACTOR
+        # Оценки неотрицательны - ограничиваем только сверху
+        return np.minimum(scores, 1.0, out=scores)
+
+
+demo_scorer = KeywordScorer(DEMO_RULES)
@@ -0,0 +1,180 @@
+"""
+LATENCY.PY - Замер задержек по стадиям обработки письма
+
+Каждая стадия (декодирование, заголовки, очистка, фичи, кэш, почти-дубликаты,
+каскад, кодирование, сходство, сборка результата) пишется в общую для процесса гистограмму с
+фиксированными корзинами. Перцентили считаются по корзинам, поэтому память
+и стоимость записи не растут с числом запросов.
+"""
+
+import time
+import bisect
+import threading
+from typing import Dict, Optional
+
+STAGES = (
+    'decode', 'header_parse', 'clean', 'features',
+    'cache_lookup', 'near_duplicate', 'cascade', 'encode', 'similarity', 'result_build', 'total'
+)
+
+# Геометрические границы корзин: от 1 мкс до ~2 минут, шаг 2^(1/4) (~19%)
+BUCKET_BOUNDS_MS = [0.001 * 2 ** (i / 4) for i in range(108)]
+
+
+class LatencyHistogram:
+    """Гистограмма задержек (мс) с фиксированными корзинами"""
+
+    def __init__(self, bounds=BUCKET_BOUNDS_MS):
+        self.bounds = list(bounds)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # Последняя корзина - всё, что больше верхней границы
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.sum_ms = 0.0
+            self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        idx = bisect.bisect_left(self.bounds, ms)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum_ms += ms
+            if ms > self.max_ms:
+                self.max_ms = ms
+
+    def state(self):
+        """Согласованная копия (counts, count, sum_ms)"""
+        with self._lock:
+            return list(self.counts), self.count, self.sum_ms
+
+    def take(self):
+        """Копия (counts, count, sum_ms, max_ms) с обнулением гистограммы"""
+        with self._lock:
+            taken = self.counts, self.count, self.sum_ms, self.max_ms
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.sum_ms = 0.0
+            self.max_ms = 0.0
+        return taken
+
+    def merge(self, counts, count: int, sum_ms: float, max_ms: float):
+        """Добавление замеров другой гистограммы с теми же корзинами"""
+        with self._lock:
+            for idx, bucket_count in enumerate(counts):
+                self.counts[idx] += bucket_count
+            self.count += count
+            self.sum_ms += sum_ms
+            if max_ms > self.max_ms:
+                self.max_ms = max_ms
+
+    def percentile(self, q: float) -> float:
+        """Перцентиль q (0-100) с линейной интерполяцией внутри корзины"""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+            max_ms = self.max_ms
+        if total == 0:
+            return 0.0
+
+        rank = q / 100.0 * total
+        cumulative = 0
+        for idx, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.bounds[idx - 1] if idx > 0 else 0.0
+                upper = self.bounds[idx] if idx < len(self.bounds) else max_ms
+                fraction = (rank - cumulative) / bucket_count
+                return min(lower + (upper - lower) * fraction, max_ms)
+            cumulative += bucket_count
+        return max_ms
+
+    def summary(self) -> Dict:
+        return {
+            'count': self.count,
+            'avg_ms': self.sum_ms / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': self.max_ms
+        }
+
+
+_histograms = {stage: LatencyHistogram() for stage in STAGES}
+_histograms_lock = threading.Lock()
+
+
+def histogram(stage: str) -> LatencyHistogram:
+    """Гистограмма стадии (создаётся при первом обращении)"""
+    hist = _histograms.get(stage)
+    if hist is None:
+        with _histograms_lock:
+            hist = _histograms.setdefault(stage, LatencyHistogram())
+    return hist
+
+
+def histograms() -> Dict[str, LatencyHistogram]:
+    return dict(_histograms)
+
+
+def observe(stage: str, ms: float):
+    histogram(stage).observe(ms)
+
+
+def snapshot() -> Dict[str, Dict]:
+    """Сводка по всем стадиям, в которых были замеры"""
+    return {stage: hist.summary() for stage, hist in list(_histograms.items()) if hist.count}
+
+
+def drain() -> Dict[str, tuple]:
+    """Замеры стадий с прошлого вызова (для передачи в другой процесс), гистограммы обнуляются"""
+    return {stage: hist.take() for stage, hist in list(_histograms.items()) if hist.count}
+
+
+def merge(states: Dict[str, tuple]):
+    """Добавление замеров drain() другого процесса"""
+    for stage, state in states.items():
+        histogram(stage).merge(*state)
+
+
+def reset():
+    for hist in list(_histograms.values()):
+        hist.reset()
+
+
+class StageTimer:
+    """Секундомер стадий одного письма
+
+    lap(stage) записывает время с предыдущей отметки, add(stage, ms) -
+    готовую длительность (например, долю пакетного прохода модели).
+    publish() отправляет замеры в гистограммы процесса.
+    """
+
+    __slots__ = ('timings', '_last')
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def restart(self):
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str) -> float:
+        now = time.perf_counter()
+        ms = (now - self._last) * 1000
+        self._last = now
+        self.timings[stage] = self.timings.get(stage, 0.0) + ms
+        return ms
+
+    def add(self, stage: str, ms: float):
+        self.timings[stage] = self.timings.get(stage, 0.0) + ms
+
+    def publish(self, total_ms: Optional[float] = None) -> Dict[str, float]:
+        """Запись в гистограммы; возвращает замеры с итоговым total"""
+        timings = dict(self.timings)
+        timings['total'] = sum(self.timings.values()) if total_ms is None else total_ms
+        for stage, ms in timings.items():
+            observe(stage, ms)
+        return timings
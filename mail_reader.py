@@ -0,0 +1,365 @@
+"""
+MAIL_READER.PY - Потоковое чтение mbox и Maildir по индексу смещений
+
+mbox сканируется один раз через mmap: для каждого письма запоминаются
+смещение, длина и хэш заголовков. Индекс хранится компактно в numpy
+массивах (24 байта на письмо) и сохраняется на диск. Письма читаются
+лениво срезом mmap, поэтому случайный доступ и раздача диапазонов
+по процессам не требуют загрузки ящика в память.
+
+Пример:
+    python mail_reader.py index archive.mbox
+"""
+
+import os
+import mmap
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAIL_INDEX_DIR = os.getenv('MAIL_INDEX_DIR', 'config/mail_index')
+INDEX_VERSION = 1
+
+FROM_LINE = b'From '
+SEPARATOR = b'\nFrom '
+
+# Ссылка на письмо: (путь к файлу, смещение, длина) - дёшево передаётся в другие процессы
+MessageRef = Tuple[str, int, int]
+
+
+def _header_end(buf, start: int = 0, end: Optional[int] = None) -> int:
+    """Конец блока заголовков (пустая строка) внутри buf[start:end]"""
+    end = len(buf) if end is None else end
+    pos = buf.find(b'\n\n', start, end)
+    if pos < 0:
+        pos = buf.find(b'\r\n\r\n', start, end)
+    return end if pos < 0 else pos
+
+
+def header_hash(buf, start: int = 0, end: Optional[int] = None) -> int:
+    """64-битный хэш блока заголовков письма buf[start:end]"""
+    headers = buf[start:_header_end(buf, start, end)]
+    return int.from_bytes(hashlib.blake2b(headers, digest_size=8).digest(), 'little')
+
+
+def _open_mmap(path: str) -> Optional[mmap.mmap]:
+    """mmap только для чтения (None для пустого файла)"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# ---------- MBOX ----------
+class MboxIndex:
+    """Индекс писем mbox: смещение, длина и хэш заголовков каждого письма
+
+    Смещение указывает на начало заголовков (после строки-разделителя
+    "From "). При росте файла (дописывание в конец) досканируется
+    только новый хвост.
+    """
+
+    def __init__(self, path, index_dir: Optional[str] = MAIL_INDEX_DIR):
+        self.path = Path(path)
+        self.index_path = self._index_path(index_dir) if index_dir else None
+
+        self.offsets = np.empty(0, dtype=np.uint64)
+        self.lengths = np.empty(0, dtype=np.uint64)
+        self.header_hashes = np.empty(0, dtype=np.uint64)
+        self.scanned_bytes = 0
+
+        self._mmap = None
+        self._mtime_ns = None
+
+        self.refresh()
+
+    def _index_path(self, index_dir: str) -> Path:
+        source_id = hashlib.blake2b(str(self.path.resolve()).encode('utf-8'), digest_size=8).hexdigest()
+        return Path(index_dir) / f"{self.path.name}.{source_id}.npz"
+
+    # ---------- построение ----------
+    def refresh(self) -> int:
+        """Актуализация индекса; возвращает число новых писем"""
+        stat = self.path.stat()
+        if self._mtime_ns == stat.st_mtime_ns and self.scanned_bytes == stat.st_size:
+            return 0
+
+        if self._mtime_ns is None and self.index_path is not None:
+            self._load()
+
+        self._reopen()
+        if self.scanned_bytes > stat.st_size or not self._tail_matches():
+            # Файл переписан целиком (не просто дописан) - полный скан
+            self._reset()
+
+        before = len(self)
+        if self.scanned_bytes < stat.st_size:
+            self._scan(self.scanned_bytes)
+            if self.index_path is not None:
+                self._save(stat)
+
+        self._mtime_ns = stat.st_mtime_ns
+        added = len(self) - before
+        if added:
+            logger.info(f"📬 Индекс {self.path.name}: +{added} писем, всего {len(self)}")
+        return added
+
+    def _reset(self):
+        self.offsets = np.empty(0, dtype=np.uint64)
+        self.lengths = np.empty(0, dtype=np.uint64)
+        self.header_hashes = np.empty(0, dtype=np.uint64)
+        self.scanned_bytes = 0
+
+    def _reopen(self):
+        self._release_mmap()
+        self._mmap = _open_mmap(str(self.path))
+
+    def _release_mmap(self):
+        """Закрытие mmap; при живых view() он освобождается, когда их отпустят"""
+        if self._mmap is None:
+            return
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # view() держат ссылку на mmap - отображение снимется вместе с последним из них
+        self._mmap = None
+
+    def _tail_matches(self) -> bool:
+        """Последнее проиндексированное письмо на месте - файл только дописывали"""
+        if not len(self):
+            return True
+        if self._mmap is None or len(self._mmap) < self.scanned_bytes:
+            return False
+        start = int(self.offsets[-1])
+        return header_hash(self._mmap, start, start + int(self.lengths[-1])) == int(self.header_hashes[-1])
+
+    def _scan(self, start: int):
+        """Поиск разделителей "From " в mmap от позиции start"""
+        mm = self._mmap
+        if mm is None:
+            return
+        size = len(mm)
+
+        # Хвост предыдущего скана заканчивается на последнем письме - пересканируем его
+        if len(self):
+            start = int(self.offsets[-1]) - 1
+            start = mm.rfind(b'\n', 0, start) + 1 if start > 0 else 0
+            self.offsets = self.offsets[:-1]
+            self.lengths = self.lengths[:-1]
+            self.header_hashes = self.header_hashes[:-1]
+
+        offsets, lengths, hashes = [], [], []
+
+        pos = start
+        if mm[pos:pos + len(FROM_LINE)] != FROM_LINE:
+            found = mm.find(SEPARATOR, pos)
+            pos = size if found < 0 else found + 1
+
+        while pos < size:
+            line_end = mm.find(b'\n', pos)
+            message_start = size if line_end < 0 else line_end + 1
+
+            next_sep = mm.find(SEPARATOR, message_start)
+            message_end = size if next_sep < 0 else next_sep + 1
+
+            offsets.append(message_start)
+            lengths.append(message_end - message_start)
+
+            hashes.append(header_hash(mm, message_start, message_end))
+
+            pos = message_end
+
+        self.offsets = np.concatenate([self.offsets, np.asarray(offsets, dtype=np.uint64)])
+        self.lengths = np.concatenate([self.lengths, np.asarray(lengths, dtype=np.uint64)])
+        self.header_hashes = np.concatenate([self.header_hashes, np.asarray(hashes, dtype=np.uint64)])
+        self.scanned_bytes = size
+
+    # ---------- хранение ----------
+    def _load(self):
+        if not self.index_path.exists():
+            return
+        try:
+            with np.load(self.index_path) as data:
+                if int(data['version']) != INDEX_VERSION:
+                    return
+                self.offsets = data['offsets']
+                self.lengths = data['lengths']
+                self.header_hashes = data['header_hashes']
+                self.scanned_bytes = int(data['scanned_bytes'])
+        except Exception as e:
+            logger.warning(f"Индекс {self.index_path} не прочитан, будет построен заново: {e}")
+            self._reset()
+
+    def _save(self, stat: os.stat_result):
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.index_path.with_suffix('.tmp.npz')
+            np.savez(
+                tmp_path,
+                version=INDEX_VERSION,
+                offsets=self.offsets,
+                lengths=self.lengths,
+                header_hashes=self.header_hashes,
+                scanned_bytes=self.scanned_bytes,
+                source_size=stat.st_size
+            )
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить индекс {self.index_path}: {e}")
+
+    # ---------- доступ ----------
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def ref(self, i: int) -> MessageRef:
+        return str(self.path), int(self.offsets[i]), int(self.lengths[i])
+
+    def view(self, i: int) -> memoryview:
+        """Письмо без копирования (срез mmap)
+
+        Для коротких операций внутри процесса; сохранять результат - через
+        get_bytes(). view() держит текущее отображение файла: после refresh()
+        или close() он по-прежнему читает старое отображение, которое
+        освобождается, когда отпущен последний view() (release() или del).
+        """
+        start = int(self.offsets[i])
+        return memoryview(self._mmap)[start:start + int(self.lengths[i])]
+
+    def get_bytes(self, i: int) -> bytes:
+        start = int(self.offsets[i])
+        return self._mmap[start:start + int(self.lengths[i])]
+
+    def iter_refs(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, MessageRef]]:
+        for i in range(start, len(self) if stop is None else min(stop, len(self))):
+            yield i, self.ref(i)
+
+    def stats(self) -> Dict:
+        return {
+            'path': str(self.path),
+            'messages': len(self),
+            'scanned_bytes': self.scanned_bytes,
+            'index_bytes': int(self.offsets.nbytes + self.lengths.nbytes + self.header_hashes.nbytes),
+            'index_path': str(self.index_path) if self.index_path else None
+        }
+
+    def close(self):
+        self._release_mmap()
+
+
+# ---------- MAILDIR ----------
+class MaildirIndex:
+    """Индекс Maildir: файлы cur/ и new/ с временем изменения и размером"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.keys = []
+        self.mtimes = np.empty(0, dtype=np.float64)
+        self.sizes = np.empty(0, dtype=np.uint64)
+        self.refresh()
+
+    def refresh(self) -> int:
+        """Пересканирование каталогов (порядок - по времени изменения)"""
+        entries = []
+        for sub in ('new', 'cur'):
+            directory = self.path / sub
+            if not directory.is_dir():
+                continue
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, f"{sub}/{entry.name}", stat.st_size))
+
+        entries.sort()
+        before = len(self.keys)
+        self.keys = [key for _, key, _ in entries]
+        self.mtimes = np.asarray([mtime for mtime, _, _ in entries], dtype=np.float64)
+        self.sizes = np.asarray([size for _, _, size in entries], dtype=np.uint64)
+        return len(self.keys) - before
+
+    @staticmethod
+    def message_id(key: str) -> str:
+        """Ключ Maildir без подкаталога и флагов (":2,S" меняется при прочтении)"""
+        return key.split('/', 1)[-1].split(':', 1)[0]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def ref(self, i: int) -> MessageRef:
+        return str(self.path / self.keys[i]), 0, int(self.sizes[i])
+
+    def get_bytes(self, i: int) -> bytes:
+        return read_message(self.ref(i))
+
+    def iter_refs(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, MessageRef]]:
+        for i in range(start, len(self) if stop is None else min(stop, len(self))):
+            yield i, self.ref(i)
+
+    def modified_since(self, timestamp: float) -> List[int]:
+        """Номера писем, изменённых после timestamp"""
+        return np.flatnonzero(self.mtimes > timestamp).tolist()
+
+    def stats(self) -> Dict:
+        return {
+            'path': str(self.path),
+            'messages': len(self),
+            'total_bytes': int(self.sizes.sum()) if len(self) else 0
+        }
+
+    def close(self):
+        pass
+
+
+# ---------- ЧТЕНИЕ ПО ССЫЛКЕ ----------
+_mmap_cache = {}
+
+
+def read_message(ref: MessageRef) -> bytes:
+    """Чтение письма по ссылке (в том числе из процесса-воркера)
+
+    mmap большого файла открывается один раз на процесс; отдельные
+    файлы (Maildir, .eml) читаются напрямую.
+    """
+    path, offset, length = ref
+    # Смещение 0 - отдельный файл (в mbox письмо начинается после строки "From ")
+    if offset == 0:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    mm = _mmap_cache.get(path)
+    if mm is None or len(mm) < offset + length:
+        if mm is not None:
+            mm.close()
+        mm = _mmap_cache[path] = _open_mmap(path)
+    return mm[offset:offset + length]
+
+
+def open_mail_source(path):
+    """Индекс источника: MaildirIndex для каталога с cur/ и new/, иначе MboxIndex"""
+    path = Path(path)
+    if path.is_dir():
+        return MaildirIndex(path)
+    return MboxIndex(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Индекс почтовых ящиков MailLens")
+    parser.add_argument("command", choices=["index", "stats"])
+    parser.add_argument("path", help="mbox файл или Maildir")
+    args = parser.parse_args()
+
+    source = open_mail_source(args.path)
+    for key, value in source.stats().items():
+        print(f"  • {key}: {value}")
+    source.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+NEAR_DUPLICATE.PY - Индекс почти-дубликатов писем (SimHash)
+
+Рассылки и уведомления приходят тысячами писем из одного шаблона, которые
+отличаются именем, ссылкой или номером. Точный ключ кэша на них промахивается,
+а SimHash-отпечаток почти не меняется. Индекс возвращает результат похожего
+ранее классифицированного письма до прохода модели.
+
+Поиск - полосами (pigeonhole): 64 бита делятся на d+1 полос, где d - допустимое
+расстояние Хэмминга. Два отпечатка на расстоянии не больше d совпадают хотя
+бы в одной полосе, поэтому кандидаты ищутся по словарям полос, а не перебором.
+"""
+
+import re
+import hashlib
+import functools
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+FINGERPRINT_BITS = 64
+# Предел числа контекстов (профиль x top_n); при превышении индекс очищается
+MAX_SCOPES = 256
+
+# Изменчивые части шаблонов заменяются метками до подсчёта отпечатка
+_URL_RE = re.compile(r'(?:https?://|www\.)\S+', re.IGNORECASE)
+_EMAIL_RE = re.compile(r'\b[\w.+-]+@[\w-]+(?:\.[\w-]+)+\b')
+_NUMBER_RE = re.compile(r'\d+(?:[.,:/-]\d+)*')
+_TOKEN_RE = re.compile(r'\w+')
+
+_BIT_VALUES = np.left_shift(np.uint64(1), np.arange(FINGERPRINT_BITS, dtype=np.uint64))
+# Число единичных битов байта - popcount для массива отпечатков без np.bitwise_count
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def normalize_tokens(text: str) -> List[str]:
+    """Токены в нижнем регистре; ссылки, адреса и числа - общими метками"""
+    # Проверки подстрок дешевле прохода регулярного выражения по всему тексту
+    if '://' in text or 'www.' in text:
+        text = _URL_RE.sub(' urltoken ', text)
+    if '@' in text:
+        text = _EMAIL_RE.sub(' emailtoken ', text)
+    text = _NUMBER_RE.sub(' 0 ', text.lower())
+    return _TOKEN_RE.findall(text)
+
+
+@functools.lru_cache(maxsize=65536)
+def _hash64(token: str) -> int:
+    """Стабильный между процессами хэш слова (словарь рассылок повторяется - кэшируем)"""
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8', errors='surrogatepass'),
+                                          digest_size=8).digest(), 'little')
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    """Финализатор splitmix64: перемешивание битов массива uint64"""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def simhash(tokens: List[str], shingle_size: int = 2) -> int:
+    """64-битный SimHash по словам и шинглам из shingle_size слов
+
+    Хэш шингла - перемешанная комбинация хэшей его слов, поэтому blake2b
+    считается только для новых слов.
+    """
+    word_hashes = np.fromiter((_hash64(token) for token in tokens), dtype=np.uint64, count=len(tokens))
+    parts = [word_hashes]
+    if shingle_size > 1 and len(tokens) >= shingle_size:
+        combined = word_hashes[:len(tokens) - shingle_size + 1].copy()
+        for offset in range(1, shingle_size):
+            combined = _mix64(combined) ^ word_hashes[offset:len(tokens) - shingle_size + 1 + offset]
+        parts.append(_mix64(combined))
+    hashes = np.concatenate(parts)
+
+    # Бит отпечатка - большинство голосов признаков (биты от младшего к старшему)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    majority = bits.sum(axis=0, dtype=np.int64) * 2 > len(hashes)
+    return int(_BIT_VALUES[majority].sum(dtype=np.uint64))
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def hamming_many(fingerprint: int, fingerprints: np.ndarray) -> np.ndarray:
+    """Расстояния Хэмминга от отпечатка до массива отпечатков (uint64)"""
+    xor = np.bitwise_xor(fingerprints, np.uint64(fingerprint))
+    return _POPCOUNT8[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int32)
+
+
+def similarity(a: int, b: int) -> float:
+    """Доля совпадающих битов отпечатков"""
+    return 1.0 - hamming(a, b) / FINGERPRINT_BITS
+
+
+class NearDuplicateIndex:
+    """Отпечатки и результаты классифицированных писем с LRU-вытеснением
+
+    Результаты привязаны к контексту (модель, порог, категории, режим) и top_n:
+    записи другого контекста не выдаются и уходят по LRU, поэтому профили с
+    разными настройками делят один индекс. Отпечатки лежат в numpy-массиве слотов, поэтому кандидаты из полос
+    проверяются одной векторной операцией.
+    """
+
+    def __init__(self, threshold: float = 0.9, max_entries: int = 50000,
+                 min_tokens: int = 8, shingle_size: int = 2):
+        if not 0.5 < threshold <= 1.0:
+            raise ValueError("Порог сходства почти-дубликатов должен быть в (0.5, 1]")
+        self.threshold = threshold
+        self.max_distance = int((1.0 - threshold) * FINGERPRINT_BITS + 1e-9)
+        self.max_entries = max_entries
+        self.min_tokens = min_tokens
+        self.shingle_size = shingle_size
+
+        # Полосы: (сдвиг, маска) - d+1 полос почти равной ширины
+        widths = [len(part) for part in np.array_split(np.arange(FINGERPRINT_BITS), self.max_distance + 1)]
+        self._bands = []
+        offset = 0
+        for width in widths:
+            self._bands.append((offset, (1 << width) - 1))
+            offset += width
+
+        self._scopes = {}               # (контекст, top_n) -> номер области
+        self._fingerprints = np.zeros(max_entries, dtype=np.uint64)
+        self._scope_of = np.zeros(max_entries, dtype=np.int32)
+        self._results = [None] * max_entries
+        self._order = OrderedDict()     # занятые слоты от давно использованных к свежим
+        self._free = list(range(max_entries - 1, -1, -1))
+        self._buckets = [dict() for _ in self._bands]   # значение полосы -> set(слот)
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.hits = 0
+        self.skipped = 0
+        self.candidates_checked = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def fingerprint(self, text: str) -> Optional[int]:
+        """Отпечаток текста или None, если текст слишком короткий для SimHash"""
+        tokens = normalize_tokens(text)
+        if len(tokens) < self.min_tokens:
+            return None
+        return simhash(tokens, self.shingle_size)
+
+    def _band_keys(self, fingerprint: int):
+        return [(fingerprint >> shift) & mask for shift, mask in self._bands]
+
+    def _scope(self, context: str, top_n: int, create: bool) -> Optional[int]:
+        scope = self._scopes.get((context, top_n))
+        if scope is None and create:
+            if len(self._scopes) >= MAX_SCOPES:
+                self.invalidations += 1
+                self._clear()
+            scope = self._scopes[(context, top_n)] = len(self._scopes)
+        return scope
+
+    def lookup(self, fingerprint: Optional[int], context: str, top_n: int) -> Optional[Tuple[Dict, float]]:
+        """Результат самого похожего письма не ниже порога и его сходство"""
+        with self._lock:
+            self.lookups += 1
+            if fingerprint is None:
+                self.skipped += 1
+                return None
+            scope = self._scope(context, top_n, create=False)
+            if scope is None:
+                return None
+
+            groups = [bucket[key] for bucket, key in zip(self._buckets, self._band_keys(fingerprint))
+                      if key in bucket]
+            if not groups:
+                return None
+            slots = np.fromiter(itertools.chain.from_iterable(groups), dtype=np.int64)
+            self.candidates_checked += len(slots)
+
+            distances = hamming_many(fingerprint, self._fingerprints[slots])
+            distances[self._scope_of[slots] != scope] = FINGERPRINT_BITS + 1
+            best = int(distances.argmin())
+            if distances[best] > self.max_distance:
+                return None
+
+            slot = int(slots[best])
+            self.hits += 1
+            self._order.move_to_end(slot)
+            return self._results[slot], 1.0 - int(distances[best]) / FINGERPRINT_BITS
+
+    def add(self, fingerprint: Optional[int], context: str, top_n: int, result: Dict):
+        if fingerprint is None:
+            return
+        with self._lock:
+            scope = self._scope(context, top_n, create=True)
+            if not self._free:
+                self._evict(next(iter(self._order)))
+                self.evictions += 1
+
+            slot = self._free.pop()
+            self._fingerprints[slot] = fingerprint
+            self._scope_of[slot] = scope
+            self._results[slot] = result
+            self._order[slot] = None
+            for bucket, key in zip(self._buckets, self._band_keys(fingerprint)):
+                bucket.setdefault(key, set()).add(slot)
+
+    def _evict(self, slot: int):
+        del self._order[slot]
+        for bucket, key in zip(self._buckets, self._band_keys(int(self._fingerprints[slot]))):
+            slots = bucket.get(key)
+            if slots is not None:
+                slots.discard(slot)
+                if not slots:
+                    del bucket[key]
+        self._results[slot] = None
+        self._free.append(slot)
+
+    def _clear(self):
+        self._scopes.clear()
+        self._order.clear()
+        self._results = [None] * self.max_entries
+        self._free = list(range(self.max_entries - 1, -1, -1))
+        for bucket in self._buckets:
+            bucket.clear()
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            checked = self.lookups - self.skipped
+            return {
+                'entries': len(self._order),
+                'contexts': len(self._scopes),
+                'threshold': self.threshold,
+                'max_distance': self.max_distance,
+                'bands': len(self._bands),
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'skipped_short': self.skipped,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'avg_candidates': self.candidates_checked / checked if checked else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
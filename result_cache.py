@@ -0,0 +1,174 @@
+"""
+RESULT_CACHE.PY - Ограниченный кэш результатов классификации
+"""
+
+import sys
+import time
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Optional
+
+SUPPORTED_POLICIES = ('lru', 'lfu')
+
+
+def estimate_size(obj: Any) -> int:
+    """Приблизительный размер объекта в байтах (с вложенными dict/list)"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += estimate_size(key) + estimate_size(value)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            size += estimate_size(item)
+    return size
+
+
+class ResultCache:
+    """Кэш с бюджетом по записям и байтам, вытеснением LRU/LFU и TTL
+
+    Потокобезопасен. Счётчики попаданий, промахов, вытеснений и занятых
+    байт доступны через stats().
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: Optional[int] = 64 * 1024 * 1024,
+                 policy: str = 'lru', ttl_seconds: Optional[float] = None):
+        if policy not in SUPPORTED_POLICIES:
+            raise ValueError(f"Неизвестная политика вытеснения: {policy}")
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = threading.Lock()
+        self._data = {}                 # key -> (value, size, expires_at)
+        self._order = OrderedDict()     # LRU: порядок использования
+        self._freq = {}                 # LFU: key -> частота
+        self._freq_buckets = defaultdict(OrderedDict)
+        self._min_freq = 0
+
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Получение значения (None при промахе или истёкшем TTL)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, _, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._touch(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any):
+        """Добавление значения с вытеснением при превышении бюджета"""
+        size = estimate_size(value)
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+            # Значение больше всего бюджета не кэшируем
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._data[key] = (value, size, expires_at)
+            self.resident_bytes += size
+            if self.policy == 'lru':
+                self._order[key] = None
+            else:
+                self._freq[key] = 1
+                self._freq_buckets[1][key] = None
+                self._min_freq = 1
+
+            while self._over_budget():
+                self._evict_one()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self):
+        """Полная очистка (счётчики сохраняются)"""
+        with self._lock:
+            self._data.clear()
+            self._order.clear()
+            self._freq.clear()
+            self._freq_buckets.clear()
+            self._min_freq = 0
+            self.resident_bytes = 0
+
+    def stats(self) -> Dict:
+        """Счётчики кэша"""
+        total = self.hits + self.misses
+        return {
+            'policy': self.policy,
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'resident_bytes': self.resident_bytes,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+    def _over_budget(self) -> bool:
+        if self.max_entries is not None and len(self._data) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.resident_bytes > self.max_bytes
+
+    def _touch(self, key: str):
+        if self.policy == 'lru':
+            self._order.move_to_end(key)
+            return
+
+        freq = self._freq[key]
+        bucket = self._freq_buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._freq_buckets[freq]
+            if self._min_freq == freq:
+                self._min_freq = freq + 1
+        self._freq[key] = freq + 1
+        self._freq_buckets[freq + 1][key] = None
+
+    def _evict_one(self):
+        if self.policy == 'lru':
+            key = next(iter(self._order))
+        else:
+            if self._min_freq not in self._freq_buckets:
+                self._min_freq = min(self._freq_buckets)
+            key = next(iter(self._freq_buckets[self._min_freq]))
+        self._remove(key)
+        self.evictions += 1
+
+    def _remove(self, key: str):
+        _, size, _ = self._data.pop(key)
+        self.resident_bytes -= size
+        if self.policy == 'lru':
+            self._order.pop(key, None)
+        else:
+            freq = self._freq.pop(key)
+            bucket = self._freq_buckets[freq]
+            bucket.pop(key, None)
+            if not bucket:
+                del self._freq_buckets[freq]
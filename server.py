@@ -0,0 +1,274 @@
+"""
+SERVER.PY - HTTP сервис классификации (без Streamlit)
+
+Эндпоинты:
+    GET  /health          - процесс жив
+    GET  /ready           - модель загружена (503 пока идёт загрузка)
+    GET  /info            - get_model_info() классификатора
+    GET  /metrics         - метрики в текстовом формате Prometheus
+    POST /classify        - {"text": "...", "top_n": 5}
+    POST /classify/batch  - {"texts": ["...", ...], "top_n": 5}
+    POST /classify/eml    - сырое .eml письмо в теле запроса (?filename=...)
+"""
+
+import os
+import json
+import logging
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from core import email_processor, classifier, security_checker, load_categories
+import metrics
+from inference_scheduler import shared_scheduler
+from worker_pool import WorkerPool, WORKER_POOL_SIZE
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = int(os.getenv('SERVER_MAX_BODY_BYTES', str(10 * 1024 * 1024)))
+MAX_TEXT_LENGTH = int(os.getenv('MAX_TEXT_LENGTH', '10000'))
+MAX_BATCH_TEXTS = int(os.getenv('SERVER_MAX_BATCH_TEXTS', '1000'))
+
+# Пул воркеров (--workers > 0); без него запросы идут через планировщик в этом процессе
+_worker_pool = None
+
+
+def _dispatcher():
+    """Куда отправлять запросы: пул воркеров или общий планировщик"""
+    return _worker_pool if _worker_pool is not None else shared_scheduler(classifier)
+
+
+def _json_default(obj):
+    """Сериализация numpy-типов в результатах"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Объект типа {type(obj).__name__} не сериализуется в JSON")
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов к классификатору"""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "MailLensHTTP/1.0"
+
+    # Тело текущего запроса прочитано (выставляется в do_GET/do_POST и _read_body)
+    _body_read = False
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+    # ---------- ответы ----------
+    def _send_json(self, status: int, payload):
+        body = json.dumps(payload, ensure_ascii=False, default=_json_default).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self._end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status: int, text: str, content_type: str):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self._end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        self._send_json(status, {'error': message})
+
+    def _end_headers(self):
+        # Непрочитанное тело нельзя оставлять в keep-alive соединении: его разберут как запрос
+        if self._body_pending():
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+    def _body_pending(self) -> bool:
+        """В соединении осталось непрочитанное тело запроса"""
+        if self._body_read or self.headers is None:
+            return False
+        if self.headers.get("Transfer-Encoding"):
+            return True
+        return (self.headers.get("Content-Length") or "0").strip() != "0"
+
+    def _read_body(self) -> bytes:
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            # Непрочитанное тело нельзя оставлять в keep-alive соединении
+            self.close_connection = True
+            raise ValueError("Некорректный Content-Length")
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            raise ValueError(f"Тело запроса больше {MAX_BODY_BYTES} байт")
+        body = self.rfile.read(length) if length > 0 else b""
+        self._body_read = True
+        return body
+
+    def _read_json(self) -> dict:
+        body = self._read_body()
+        try:
+            payload = json.loads(body.decode('utf-8')) if body else {}
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError(f"Некорректный JSON: {e}")
+        if not isinstance(payload, dict):
+            raise ValueError("Ожидается JSON объект")
+        return payload
+
+    @staticmethod
+    def _top_n(payload: dict) -> int:
+        top_n = payload.get('top_n', 5)
+        if not isinstance(top_n, int) or top_n < 1:
+            raise ValueError("top_n должен быть положительным целым")
+        return top_n
+
+    @classmethod
+    def _query_top_n(cls, query: dict) -> int:
+        value = query.get('top_n', ['5'])[0]
+        try:
+            top_n = int(value)
+        except ValueError:
+            raise ValueError("top_n должен быть положительным целым")
+        return cls._top_n({'top_n': top_n})
+
+    # ---------- маршруты ----------
+    def do_GET(self):
+        self._body_read = False
+        path = urlparse(self.path).path
+
+        if path == "/health":
+            self._send_json(200, {'status': 'ok'})
+        elif path == "/ready":
+            ready = classifier.is_ready
+            self._send_json(200 if ready else 503, {
+                'ready': ready,
+                'load_state': classifier.load_state,
+                'model_loaded': classifier.model_loaded
+            })
+        elif path == "/info":
+            info = classifier.get_model_info()
+            if _worker_pool is not None:
+                info['worker_pool'] = _worker_pool.stats()
+            else:
+                info['scheduler'] = shared_scheduler(classifier).stats()
+            self._send_json(200, info)
+        elif path == "/metrics":
+            self._send_text(200, metrics.render(), metrics.CONTENT_TYPE)
+        else:
+            self._send_error(404, f"Неизвестный путь: {path}")
+
+    def do_POST(self):
+        self._body_read = False
+        parsed = urlparse(self.path)
+        try:
+            if parsed.path == "/classify":
+                self._handle_classify()
+            elif parsed.path == "/classify/batch":
+                self._handle_batch()
+            elif parsed.path == "/classify/eml":
+                self._handle_eml(parse_qs(parsed.query))
+            else:
+                self._send_error(404, f"Неизвестный путь: {parsed.path}")
+        except ValueError as e:
+            self._send_error(400, str(e))
+        except Exception as e:
+            logger.error(f"Ошибка обработки {parsed.path}: {e}")
+            metrics.ERRORS.inc('http')
+            self._send_error(500, str(e))
+
+    def _handle_classify(self):
+        payload = self._read_json()
+        text = payload.get('text')
+        if not isinstance(text, str):
+            raise ValueError("Поле text обязательно")
+
+        text = security_checker.sanitize_input(text, MAX_TEXT_LENGTH)
+        result = _dispatcher().classify(text, top_n=self._top_n(payload))
+        self._send_json(200, result)
+
+    def _handle_batch(self):
+        payload = self._read_json()
+        texts = payload.get('texts')
+        if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+            raise ValueError("Поле texts должно быть списком строк")
+        if len(texts) > MAX_BATCH_TEXTS:
+            raise ValueError(f"Не больше {MAX_BATCH_TEXTS} писем в пакете")
+
+        texts = [security_checker.sanitize_input(t, MAX_TEXT_LENGTH) for t in texts]
+        results = _dispatcher().classify_many(texts, top_n=self._top_n(payload))
+        self._send_json(200, {'results': results})
+
+    def _handle_eml(self, query: dict):
+        content = self._read_body()
+        if not content:
+            raise ValueError("Пустое тело запроса")
+
+        filename = query.get('filename', ['upload.eml'])[0]
+        top_n = self._query_top_n(query)
+
+        parsed = email_processor.parse_email(content, filename)
+        if not parsed.get('success'):
+            raise ValueError(f"Не удалось разобрать письмо: {parsed.get('error')}")
+
+        text = parsed['cleaned_text'] or parsed['full_text']
+        text = security_checker.sanitize_input(text, MAX_TEXT_LENGTH)
+        result = _dispatcher().classify(text, top_n=top_n)
+
+        email_info = {k: parsed[k] for k in ('filename', 'subject', 'from', 'to', 'date', 'language',
+                                             'word_count', 'char_count', 'has_attachments')}
+        self._send_json(200, {'email': email_info, 'result': result})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP сервис классификации MailLens")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVER_PORT", "8080")))
+    parser.add_argument("--categories", default="config/categories.json")
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("DEFAULT_THRESHOLD", "0.35")))
+    parser.add_argument("--workers", type=int, default=WORKER_POOL_SIZE,
+                        help="Процессы-воркеры с общей моделью (0 - инференс в этом процессе)")
+    args = parser.parse_args()
+
+    global _worker_pool
+    classifier.set_categories(load_categories(args.categories))
+    classifier.set_threshold(args.threshold)
+    metrics.register_classifier_gauges(classifier)
+
+    if args.workers > 0:
+        # Модель грузится до fork и до старта потоков сервера: /ready сразу отвечает 200
+        _worker_pool = WorkerPool(classifier, workers=args.workers).start()
+        metrics.register_gauge('maillens_worker_pool_alive', 'Живых процессов-воркеров',
+                               lambda: _worker_pool.alive_workers)
+        metrics.register_gauge('maillens_worker_pool_queue_depth', 'Пакетов в очереди пула воркеров',
+                               lambda: _worker_pool.stats()['queue_depth'])
+    else:
+        # Модель грузится в фоне, /ready отвечает 503 до окончания загрузки
+        classifier.load_in_background()
+        scheduler = shared_scheduler(classifier)
+        metrics.register_gauge('maillens_scheduler_queue_depth', 'Запросов в очереди планировщика',
+                               lambda: scheduler.stats()['queue_depth'])
+
+    httpd = ThreadingHTTPServer((args.host, args.port), ClassificationHandler)
+    httpd.daemon_threads = True
+    logger.info(f"🚀 HTTP сервис MailLens слушает {args.host}:{args.port}")
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if _worker_pool is not None:
+            _worker_pool.stop()
+        else:
+            shared_scheduler(classifier).stop()
+
+
+if __name__ == "__main__":
+    main()
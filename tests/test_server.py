@@ -0,0 +1,42 @@
+"""
+TEST_SERVER.PY - проверки HTTP-сервера классификации
+"""
+
+import socket
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+
+from server import ClassificationHandler
+
+
+class KeepAliveTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), ClassificationHandler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_unread_body_is_not_parsed_as_next_request(self):
+        """Тело запроса к неизвестному пути не разбирается как следующий запрос"""
+        smuggled = b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n"
+        request = (b"POST /nope HTTP/1.1\r\nHost: x\r\n"
+                   b"Content-Length: " + str(len(smuggled)).encode() + b"\r\n\r\n" + smuggled)
+        with socket.create_connection(self.httpd.server_address, timeout=5) as sock:
+            sock.sendall(request)
+            response = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                response += chunk
+        self.assertEqual(response.count(b"HTTP/1.1 "), 1)
+        self.assertTrue(response.startswith(b"HTTP/1.1 404"))
+        self.assertIn(b"Connection: close", response)
+
+
+if __name__ == '__main__':
+    unittest.main()
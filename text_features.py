@@ -0,0 +1,255 @@
+"""
+TEXT_FEATURES.PY - Фичи текста письма за один проход по словарям
+
+Все словари фич (приветствие, благодарность, срочность, встреча, позитив,
+негатив, формальность) собраны в одно регулярное выражение по префиксному
+дереву (как в keyword_rules.py). Текст приводится к нижнему регистру один
+раз, каждое совпадение сразу отмечает флаги и счётчики всех своих словарей.
+
+Результат совпадает с поочерёдными проверками `word in text.lower()` и
+`text.lower().count(word)`: поиск перезапускается со следующего символа,
+поэтому находятся все вхождения, и пересекающиеся слова разных словарей
+('пока' и 'ок') считаются каждое. Вхождения одного слова не пересекаются, как
+в str.count. Заглавные буквы и цифры считаются по таблице классов символов
+numpy, а не циклом Python по символам.
+"""
+
+import re
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+
+from keyword_rules import trie_pattern
+
+# Флаги: есть ли в тексте хотя бы одно слово словаря
+FLAG_LEXICONS = {
+    'has_greeting': ('уважаемый', 'уважаемая', 'здравствуйте', 'добрый день',
+                     'привет', 'дорогой', 'дорогая', 'hello', 'hi', 'dear'),
+    'has_thanks': ('спасибо', 'благодарю', 'thank you', 'thanks', 'благодарность'),
+    'has_urgent': ('срочно', 'urgent', 'asap', 'немедленно', 'важно', 'important'),
+    'has_meeting': ('встреча', 'звонок', 'совещание', 'конференция',
+                    'meeting', 'call', 'conference'),
+}
+
+# Счётчики: сумма числа вхождений слов словаря (все четыре нужны extract)
+COUNT_LEXICONS = {
+    'positive_score': ('отличн', 'хорош', 'прекрасн', 'супер', 'great', 'good', 'excellent', 'спасиб'),
+    'negative_score': ('плох', 'ужасн', 'кошмар', 'разочарован', 'bad', 'terrible', 'disappointed', 'жалоб'),
+    'formal_score': ('прошу', 'предлагаю', 'сообщаю', 'уведомляю', 'информирую'),
+    'informal_score': ('привет', 'пока', 'ок', 'ладно', 'чё', 'ага'),
+}
+
+# Дата и время ищутся от разделителя (быстрый поиск по первому символу шаблона) с цифрой
+# перед ним - совпадения есть там же, где у r'\d{1,2}[-./]\d{1,2}[-./]\d{2,4}' и r'\d{1,2}[:]\d{2}'
+_DATE_RE = re.compile(r'[-./](?<=\d[-./])\d{1,2}[-./]\d{2,4}')
+_TIME_RE = re.compile(r':(?<=\d:)\d{2}')
+_MONEY_RE = re.compile(r'\$\d+|€\d+|£\d+|\d+\s*(руб|р\.|долл|евро)')
+_URL_RE = re.compile(r'https?://\S+|www\.\S+')
+# Совпадает там же, где r'\S+@\S+\.\S+' (все \S+ можно сократить до символа), без перебора начал
+_EMAIL_RE = re.compile(r'\S@\S+\.\S')
+# Без одной из этих подстрок шаблон денег не совпадёт
+_MONEY_MARKERS = ('$', '€', '£', 'руб', 'р.', 'долл', 'евро')
+# С этой длины начала слов словарей отбираются векторно: на коротких текстах
+# накладные расходы numpy больше, чем проход регулярного выражения
+VECTOR_FILTER_MIN_CHARS = 256
+
+# Классы символов (биты) для всех кодов Unicode. Заглавные буквы и цифры есть только в
+# плоскостях 0-1, дальше - иероглифы, теги и частное использование
+_UPPER, _DIGIT, _SENTENCE_END = 1, 2, 4
+_CLASS_VALUES = 8
+# Соседние знаки конца предложения: без них число серий равно числу знаков
+_SENTENCE_END_PAIR_RE = re.compile(r'[.!?][.!?]')
+_UNICODE_SIZE = 0x110000
+_CASED_PLANES_SIZE = 0x20000
+
+
+def _char_class_table() -> np.ndarray:
+    table = np.zeros(_UNICODE_SIZE, dtype=np.uint8)
+    # Символ не бывает одновременно заглавной буквой и цифрой: у каждого не больше одного бита
+    table[:_CASED_PLANES_SIZE] = [(_UPPER if char.isupper() else 0) | (_DIGIT if char.isdigit() else 0)
+                                  for char in map(chr, range(_CASED_PLANES_SIZE))]
+    for char in '.!?':
+        table[ord(char)] |= _SENTENCE_END
+    table.setflags(write=False)
+    return table
+
+
+_CHAR_CLASSES = _char_class_table()
+
+
+def char_codes(text: str) -> np.ndarray:
+    """Коды символов строки: индекс в массиве = индекс в строке"""
+    if text.isascii():
+        return np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    return np.frombuffer(text.encode('utf-32-le', errors='surrogatepass'), dtype=np.uint32)
+
+
+def char_classes(text: str) -> np.ndarray:
+    """Битовые классы символов текста (заглавная, цифра, конец предложения)"""
+    return _CHAR_CLASSES.take(char_codes(text))
+
+
+def char_statistics(text: str) -> Tuple[int, int, int, bool, bool]:
+    """Заглавные буквы, цифры (str.isupper/isdigit), серии [.!?]+, есть ли дата и время"""
+    classes = char_classes(text)
+    totals = np.bincount(classes, minlength=_CLASS_VALUES).tolist()
+    upper_count, digit_count, sentence_ends = totals[_UPPER], totals[_DIGIT], totals[_SENTENCE_END]
+    # Серий меньше, чем знаков, на число пар соседних знаков
+    sentence_runs = sentence_ends
+    if sentence_ends > 1 and _SENTENCE_END_PAIR_RE.search(text) is not None:
+        sentence_runs -= int(np.count_nonzero(classes[:-1] & classes[1:] & _SENTENCE_END))
+    has_date = digit_count > 0 and _DATE_RE.search(text) is not None
+    has_time = digit_count > 0 and _TIME_RE.search(text) is not None
+    return upper_count, digit_count, sentence_runs, has_date, has_time
+
+
+class TextFeatureExtractor:
+    """Фичи текста: словари за один проход, классы символов - векторно
+
+    В длинных текстах кандидаты в начала слов словарей отбираются векторно
+    по первым трём символам (таблица допустимых триграмм), и регулярное
+    выражение по префиксному дереву проверяется только в этих позициях.
+    """
+
+    def __init__(self, flag_lexicons: Dict[str, Sequence[str]] = FLAG_LEXICONS,
+                 count_lexicons: Dict[str, Sequence[str]] = COUNT_LEXICONS):
+        self.flag_names = list(flag_lexicons)
+        self.count_names = list(count_lexicons)
+
+        flags_by_word: Dict[str, int] = {}
+        slots_by_word: Dict[str, Tuple[int, ...]] = {}
+        for idx, name in enumerate(self.flag_names):
+            for word in flag_lexicons[name]:
+                flags_by_word[word] = flags_by_word.get(word, 0) | (1 << idx)
+        for idx, name in enumerate(self.count_names):
+            for word in count_lexicons[name]:
+                slots_by_word[word] = slots_by_word.get(word, ()) + (idx,)
+        words = sorted(set(flags_by_word) | set(slots_by_word))
+
+        # Найденное в позиции слово - самое длинное; его префиксы-слова начинаются там же
+        self._hits = {}
+        for word in words:
+            self._hits[word] = tuple(
+                (other, flags_by_word.get(other, 0), slots_by_word.get(other, ()), len(other))
+                for other in words if word.startswith(other)
+            )
+        self._flag_masks = [1 << idx for idx in range(len(self.flag_names))]
+        self._score_slots = [self.count_names.index(name) for name in
+                             ('positive_score', 'negative_score', 'formal_score', 'informal_score')]
+        self._pattern = re.compile(trie_pattern(words))
+
+        # Номера символов начал слов (0 - любой другой) и допустимые триграммы начал
+        letters = sorted({ch for word in words for ch in word[:3]})
+        self._char_ids = np.zeros(_UNICODE_SIZE, dtype=np.uint8)
+        for idx, ch in enumerate(letters, start=1):
+            self._char_ids[ord(ch)] = idx
+        self._char_ids.setflags(write=False)
+        if len(letters) >= 255:
+            raise ValueError("Слишком много разных начальных символов слов словарей")
+        self._radix = len(letters) + 1
+        starts = np.zeros((self._radix,) * 3, dtype=bool)
+        for word in words:
+            # Короткие слова допускают любые следующие символы (и конец текста)
+            starts[tuple(int(self._char_ids[ord(ch)]) for ch in word[:3])] = True
+        starts.setflags(write=False)
+        self._starts = starts.reshape(-1)
+
+    def candidate_starts(self, text_lower: str) -> np.ndarray:
+        """Позиции, с которых может начинаться слово словарей (по первым трём символам)"""
+        codes = char_codes(text_lower)
+        ids = np.zeros(len(codes) + 2, dtype=np.int32)
+        ids[:len(codes)] = self._char_ids.take(codes)
+        radix = self._radix
+        trigrams = (ids[:-2] * radix + ids[1:-1]) * radix + ids[2:]
+        return np.flatnonzero(self._starts[trigrams])
+
+    def _lexicon_matches(self, text_lower: str):
+        """Самое длинное слово словарей в каждой позиции, где слово начинается"""
+        if len(text_lower) < VECTOR_FILTER_MIN_CHARS:
+            search = self._pattern.search
+            found = search(text_lower)
+            while found is not None:
+                yield found
+                found = search(text_lower, found.start() + 1)
+            return
+        match = self._pattern.match
+        for start in self.candidate_starts(text_lower).tolist():
+            found = match(text_lower, start)
+            if found is not None:
+                yield found
+
+    def scan_lexicons(self, text_lower: str) -> Tuple[int, list]:
+        """Битовая маска флагов и счётчики словарей по тексту в нижнем регистре"""
+        flags = 0
+        counts = [0] * len(self.count_names)
+        next_free = {}   # слово -> позиция, с которой его вхождение не пересекается с посчитанным
+        for found in self._lexicon_matches(text_lower):
+            start = found.start()
+            for word, word_flags, slots, length in self._hits[found.group()]:
+                flags |= word_flags
+                if slots and start >= next_free.get(word, 0):
+                    next_free[word] = start + length
+                    for slot in slots:
+                        counts[slot] += 1
+        return flags, counts
+
+    def extract(self, text: str) -> Dict:
+        """Фичи текста - те же значения и порядок ключей, что у прежних поочерёдных проверок"""
+        text_lower = text.lower()
+        words = text.split()
+        word_count = len(words)
+        upper_count, digit_count, sentence_runs, has_date, has_time = char_statistics(text)
+        flags, counts = self.scan_lexicons(text_lower)
+
+        char_count = len(text)
+        exclamation_count = text.count('!')
+        question_count = text.count('?')
+        features = {
+            'char_count': char_count,
+            'word_count': word_count,
+            # Кусков re.split(r'[.!?]+') на один больше, чем серий знаков
+            'sentence_count': sentence_runs + 1,
+            'exclamation_count': exclamation_count,
+            'question_count': question_count,
+            'uppercase_ratio': upper_count / max(char_count, 1),
+            'digit_count': digit_count,
+        }
+        for name, mask in zip(self.flag_names, self._flag_masks):
+            features[name] = bool(flags & mask)
+        features['has_date'] = has_date
+        features['has_time'] = has_time
+        features['has_money'] = (digit_count > 0 and any(marker in text_lower for marker in _MONEY_MARKERS)
+                                 and _MONEY_RE.search(text_lower) is not None)
+        features['has_url'] = ('://' in text or 'www.' in text) and _URL_RE.search(text) is not None
+        at = text.find('@')
+        features['has_email'] = at >= 0 and _EMAIL_RE.search(text, max(at - 1, 0)) is not None
+
+        positive, negative, formal, informal = [counts[slot] for slot in self._score_slots]
+        features['positive_score'] = positive
+        features['negative_score'] = negative
+
+        if word_count > 0:
+            features['sentiment_ratio'] = (positive - negative) / word_count
+            features['formal_score'] = formal
+            features['informal_score'] = informal
+            formality_total = formal + informal
+            features['formality_ratio'] = formal / formality_total if formality_total > 0 else 0.5
+
+            avg_word_len = sum(map(len, words)) / word_count
+            ttr = len(set(words)) / word_count
+            complexity = (avg_word_len * 0.3 + (sentence_runs + 1) * 0.4 + ttr * 0.3) / 10
+            # Те же операции double, что с np.mean; тип - np.float64, как у min(np.float64, 1.0)
+            features['text_complexity'] = np.float64(complexity) if complexity <= 1.0 else 1.0
+        else:
+            features['sentiment_ratio'] = 0
+            features['formality_ratio'] = 0.5
+            features['text_complexity'] = 0
+
+        features['is_short'] = word_count < 20
+        features['is_long'] = word_count > 500
+        features['has_questions'] = question_count > 0
+        features['is_emotional'] = exclamation_count > 2
+        return features
+
+
+feature_extractor = TextFeatureExtractor()
@@ -4,6 +4,7 @@ UI.PY - Интеллектуальный классификатор писем
 
 import streamlit as st
 import pandas as pd
+import io
 import json
 import time
 import os
@@ -70,14 +71,39 @@ if 'benchmark_results' not in st.session_state:
 
 # Загрузка ML моделей
 ML_AVAILABLE = False
+shared_classifier = None
 classifier = None
 email_processor = None
 
+
+@st.cache_resource
+def get_shared_classifier():
+    """Модель одна на процесс: все сессии работают с общим экземпляром"""
+    from core import classifier as core_classifier
+    # Модель грузится в фоне, страница отрисовывается сразу
+    core_classifier.load_in_background()
+    return core_classifier
+
+
+def session_classifier():
+    """Профиль сессии: свои категории, порог и режим поверх общей модели
+    
+    Настройки сессии не меняют общий классификатор, поэтому параллельные
+    сессии не сбрасывают друг другу категории и кэш.
+    """
+    return shared_classifier.profile(
+        st.session_state.categories,
+        st.session_state.threshold / 100.0,
+        mode=st.session_state.get('classifier_mode'),
+        knn_k=st.session_state.get('knn_k')
+    )
+
+
 try:
-    from core import email_processor, classifier
-    if classifier:
-        classifier.set_categories(st.session_state.categories)
-        classifier.set_threshold(st.session_state.threshold / 100.0)
+    from core import email_processor
+    shared_classifier = get_shared_classifier()
+    if shared_classifier:
+        classifier = session_classifier()
         ML_AVAILABLE = True
 except Exception as e:
     st.sidebar.warning(f"⚠️ ML модели не загружены: {type(e).__name__}")
@@ -282,9 +308,27 @@ with st.sidebar:
     
     if ML_AVAILABLE and threshold != st.session_state.threshold:
         st.session_state.threshold = threshold
-        classifier.set_threshold(threshold / 100.0)
+        classifier = session_classifier()
         st.success(f"Порог установлен: {threshold}%")
     
+    # Режим классификации
+    if ML_AVAILABLE:
+        mode_labels = {'centroid': "Центроиды категорий", 'knn': "k ближайших примеров"}
+        mode = st.radio(
+            "Режим классификации",
+            options=list(mode_labels),
+            index=list(mode_labels).index(classifier.mode),
+            format_func=mode_labels.get,
+            help="kNN голосует ближайшими few-shot примерами и лучше для разнородных категорий"
+        )
+        knn_k = classifier.knn_k
+        if mode == 'knn':
+            knn_k = st.number_input("k соседей", min_value=1, max_value=100, value=classifier.knn_k)
+        if mode != classifier.mode or knn_k != classifier.knn_k:
+            st.session_state.classifier_mode = mode
+            st.session_state.knn_k = knn_k
+            classifier = session_classifier()
+    
     # Категории
     st.markdown("### 🏷️ Категории")
     st.caption("Управление категориями для классификации")
@@ -314,8 +358,6 @@ with st.sidebar:
                     st.session_state.categories.remove(category)
                     with open(CATEGORIES_FILE, "w", encoding="utf-8") as f:
                         json.dump(st.session_state.categories, f, ensure_ascii=False, indent=2)
-                    if ML_AVAILABLE:
-                        classifier.set_categories(st.session_state.categories)
                     st.rerun()
     
     # Добавление новой категории
@@ -333,8 +375,6 @@ with st.sidebar:
                 st.session_state.categories.append(new_category.strip())
                 with open(CATEGORIES_FILE, "w", encoding="utf-8") as f:
                     json.dump(st.session_state.categories, f, ensure_ascii=False, indent=2)
-                if ML_AVAILABLE:
-                    classifier.set_categories(st.session_state.categories)
                 st.success(f"Категория '{new_category.strip()}' добавлена")
                 st.rerun()
     
@@ -343,8 +383,6 @@ with st.sidebar:
             st.session_state.categories = DEFAULT_CATEGORIES.copy()
             with open(CATEGORIES_FILE, "w", encoding="utf-8") as f:
                 json.dump(st.session_state.categories, f, ensure_ascii=False, indent=2)
-            if ML_AVAILABLE:
-                classifier.set_categories(st.session_state.categories)
             st.rerun()
     
     # Информация о системе
@@ -354,8 +392,30 @@ with st.sidebar:
     if ML_AVAILABLE:
         model_info = classifier.get_model_info()
         st.metric("ML модель", model_info.get('model_name', 'Demo'))
+        if not model_info.get('is_ready'):
+            st.info("⏳ Модель загружается в фоне...")
+            if st.button("🔄 Обновить статус", use_container_width=True):
+                st.rerun()
+        elif model_info.get('cold_start_ms') is not None:
+            st.caption(f"Холодный старт: {model_info['cold_start_ms'] / 1000:.1f} с")
         st.metric("Категории", model_info.get('categories_count', 0))
         st.metric("Порог", f"{threshold}%")
+        
+        cache_stats = model_info.get('cache_stats')
+        if cache_stats:
+            st.metric("Кэш: попадания", f"{cache_stats['hit_rate']:.0%}")
+            st.caption(
+                f"Записей: {cache_stats['entries']} • "
+                f"{cache_stats['resident_bytes'] / 1024 / 1024:.1f} МБ\n\n"
+                f"Попаданий: {cache_stats['hits']} • Промахов: {cache_stats['misses']} • "
+                f"Вытеснено: {cache_stats['evictions']}"
+            )
+            cache_latency = model_info.get('cache_latency', {})
+            if cache_latency.get('hit', {}).get('count') or cache_latency.get('miss', {}).get('count'):
+                st.caption(
+                    f"Задержка p95: попадание {cache_latency['hit']['p95_ms']:.2f} мс • "
+                    f"промах {cache_latency['miss']['p95_ms']:.1f} мс"
+                )
     else:
         st.warning("ML модель в демо-режиме")
     
@@ -436,7 +496,11 @@ with tab1:
                 start_time = time.time()
                 
                 if ML_AVAILABLE:
-                    result = classifier.classify(text_to_classify, top_n=3)
+                    # Запросы всех сессий объединяются в общие пакеты
+                    from inference_scheduler import shared_scheduler
+                    result = shared_scheduler(shared_classifier).classify(
+                        text_to_classify, top_n=3, classifier=classifier
+                    )
                 else:
                     # Демо-режим
                     result = {
@@ -479,6 +543,13 @@ with tab1:
                 method = result.get('method', 'unknown')
                 st.caption(f"Метод: {method}")
                 
+                # Время по стадиям обработки
+                timings = result.get('timings_ms')
+                if timings:
+                    st.caption(" • ".join(
+                        f"{stage}: {ms:.2f} мс" for stage, ms in timings.items() if stage != 'total'
+                    ))
+                
                 # Топ категории
                 if 'top_categories' in result and result['top_categories']:
                     st.markdown("### 🏆 Топ категории")
@@ -528,22 +599,43 @@ with tab2:
                 try:
                     classifier.add_few_shot_example(selected_category, example_text)
                     st.success(f"✅ Пример добавлен для категории '{selected_category}'")
-                    
-                    # Показываем статистику
-                    model_info = classifier.get_model_info()
-                    few_shot_stats = model_info.get('few_shot_examples', {})
-                    
-                    st.markdown("### 📊 Статистика Few-Shot примеров")
-                    stats_df = pd.DataFrame([
-                        {"Категория": cat, "Примеров": count}
-                        for cat, count in few_shot_stats.items()
-                    ])
-                    
-                    if not stats_df.empty:
-                        st.dataframe(stats_df, use_container_width=True)
                 except Exception as e:
                     st.error(f"❌ Ошибка добавления примера: {e}")
         
+        # Массовый импорт из размеченного CSV
+        st.markdown("### 📥 Импорт из CSV")
+        uploaded_csv = st.file_uploader(
+            "CSV с колонками text и category",
+            type=["csv"],
+            key="fewshot_csv"
+        )
+        if uploaded_csv is not None and st.button("📥 Импортировать примеры", use_container_width=True):
+            try:
+                with st.spinner("Кодирование примеров..."):
+                    added = classifier.import_few_shot_csv(
+                        io.StringIO(uploaded_csv.getvalue().decode('utf-8-sig'))
+                    )
+                st.success(f"✅ Импортировано примеров: {added}")
+            except Exception as e:
+                st.error(f"❌ Ошибка импорта: {e}")
+        
+        # Статистика банка
+        few_shot_stats = classifier.few_shot.counts()
+        if few_shot_stats:
+            st.markdown("### 📊 Статистика Few-Shot примеров")
+            stats_df = pd.DataFrame([
+                {"Категория": cat, "Примеров": count}
+                for cat, count in sorted(few_shot_stats.items())
+            ])
+            st.dataframe(stats_df, use_container_width=True)
+            
+            bank_stats = classifier.few_shot.stats()
+            storage = classifier.few_shot_dir or "только в памяти"
+            st.caption(
+                f"Всего: {bank_stats['examples']} • ожидают кодирования: {bank_stats['pending']} • "
+                f"{bank_stats['matrix_bytes'] / 1024 / 1024:.1f} МБ • хранение: {storage}"
+            )
+        
         # Очистка кэша
         st.markdown("---")
         if st.button("🧹 Очистить кэш классификатора", use_container_width=True):
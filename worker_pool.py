@@ -0,0 +1,585 @@
+"""
+WORKER_POOL.PY - Пул процессов-воркеров с общей копией весов модели
+
+Модель загружается и прогревается один раз в родительском процессе, затем
+воркеры создаются через fork: страницы с весами общие (copy-on-write), поэтому
+N воркеров занимают память примерно одной модели. Потоки torch делятся между
+воркерами, чтобы воркеры не конкурировали за ядра.
+
+Воркеры создаются не из родителя, а из процесса-шаблона: он создаётся fork
+до запуска потоков диспетчеров и сам потоков не имеет. Поэтому fork при
+перезапуске воркера не уносит в него блокировку, захваченную другим потоком
+(логирование, очереди, кэш). restart() создаёт новый шаблон из родителя,
+предварительно дождавшись, пока все диспетчеры закончат текущие пакеты и
+встанут на паузу. Соединение SQLite хранилища эмбеддингов через
+fork не передаётся: перед созданием шаблона оно закрывается, и каждый
+воркер открывает хранилище заново.
+
+Запросы уходят воркерам через pipe. На каждый воркер в родителе есть поток-
+диспетчер: он забирает из общей очереди подряд идущие запросы с одинаковыми
+параметрами (до max_batch_size писем) и отправляет их одним пакетом. Упавший
+или зависший воркер перезапускается, его пакет повторяется один раз. Вместе
+с результатами пакета воркер возвращает приращения своих метрик (кэш,
+задержки стадий), и родитель добавляет их к своим - /metrics видит всё.
+
+ONNX Runtime не переживает fork, поэтому для бэкендов onnx/onnx-int8 сессия
+создаётся заново в каждом воркере (без общей памяти весов).
+
+Пример:
+    pool = WorkerPool(classifier, workers=8).start()
+    result = pool.classify("текст письма", top_n=3)
+"""
+
+import gc
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from typing import Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WORKER_POOL_SIZE = int(os.getenv('WORKER_POOL_SIZE', '0'))
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '0'))
+WORKER_MAX_BATCH = int(os.getenv('WORKER_MAX_BATCH', '32'))
+WORKER_TASK_TIMEOUT_S = float(os.getenv('WORKER_TASK_TIMEOUT_S', '300'))
+
+# Попыток на пакет: пакет, который повторно роняет воркер, завершается ошибкой
+MAX_ATTEMPTS = 2
+
+
+class WorkerCrashed(RuntimeError):
+    """Воркер завершился или завис во время обработки пакета"""
+
+
+class _Job:
+    __slots__ = ('texts', 'top_n', 'use_cache', 'profile', 'future', 'attempts')
+
+    def __init__(self, texts: List[str], top_n: int, use_cache: bool, profile):
+        self.texts = texts
+        self.top_n = top_n
+        self.use_cache = use_cache
+        self.profile = profile
+        self.future = Future()
+        self.attempts = 0
+
+    @property
+    def key(self):
+        return (self.top_n, self.use_cache, self.profile)
+
+
+def _profile_spec(classifier, base) -> Optional[tuple]:
+    """Настройки профиля для воркера (None - базовый классификатор)"""
+    if classifier is None or classifier is base:
+        return None
+    return (tuple(classifier.categories), classifier.threshold, classifier.mode, classifier.knn_k)
+
+
+def _configure_threads(classifier, threads: int):
+    """Ограничение потоков инференса в воркере"""
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # межоператорный пул уже создан в родителе - оставляем как есть
+    except ImportError:
+        pass
+
+    if classifier.model_loaded and classifier.backend != 'torch':
+        from inference_backends import create_backend
+        classifier.model = create_backend(classifier.backend, classifier.model_name,
+                                          classifier.device, num_threads=threads)
+
+
+def _drain_stats(classifier) -> Dict:
+    """Метрики и задержки кэша воркера с прошлого пакета - родитель добавляет их к своим"""
+    stats = {
+        'metrics': metrics.drain(),
+        'hit_latency_ms': list(classifier._hit_latency_ms),
+        'miss_latency_ms': list(classifier._miss_latency_ms)
+    }
+    classifier._hit_latency_ms.clear()
+    classifier._miss_latency_ms.clear()
+    return stats
+
+
+def _worker_main(conn, classifier, threads: int, store_config: Optional[tuple]):
+    """Цикл воркера: пакет из pipe -> classify_batch -> результаты и метрики в pipe"""
+    # Значения до fork уже учтены в родителе - воркер передаёт только свои приращения
+    metrics.reset()
+    _drain_stats(classifier)
+    if store_config is not None:
+        classifier.enable_embedding_store(*store_config)
+    _configure_threads(classifier, threads)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+
+        texts, top_n, use_cache, spec = message
+        try:
+            target = classifier.profile(*spec) if spec else classifier
+            reply = ('ok', target.classify_batch(texts, top_n=top_n, use_cache=use_cache))
+        except Exception as e:
+            reply = ('error', f"{type(e).__name__}: {e}")
+        conn.send(reply + (_drain_stats(classifier),))
+
+
+def _template_main(conn, inherited_conns, classifier, threads: int, store_config: Optional[tuple]):
+    """Процесс-шаблон: по запросу родителя создаёт воркер через fork
+
+    Родитель передаёт дескриптор конца pipe воркера и получает pid воркера.
+    """
+    # Чужие концы pipe, унаследованные при fork, мешают заметить смерть родителя
+    for other in inherited_conns:
+        other.close()
+    # Завершённые воркеры удаляет ядро - шаблону не нужно их ждать
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+
+        fd = reduction.recv_handle(conn)
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                conn.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _worker_main(Connection(fd), classifier, threads, store_config)
+            except BaseException:
+                logger.exception("Воркер завершился с ошибкой")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        # Дескриптор остаётся только у воркера: следующие воркеры его не наследуют
+        os.close(fd)
+        conn.send(pid)
+
+
+def _is_alive(pid: Optional[int]) -> bool:
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # процесс есть, но принадлежит другому пользователю
+    return True
+
+
+class _Worker:
+    __slots__ = ('slot', 'pid', 'conn', 'generation', 'tasks', 'texts', 'restarts', 'started_at')
+
+    def __init__(self, slot: int):
+        self.slot = slot
+        self.generation = 0
+        self.pid = None
+        self.conn = None
+        self.tasks = 0
+        self.texts = 0
+        self.restarts = 0
+        self.started_at = 0.0
+
+
+class WorkerPool:
+    """Пул воркеров, созданных fork от процесса с загруженной моделью
+
+    Интерфейс как у MicroBatchScheduler: submit/classify/classify_many и
+    classify_batch с параметром classifier для профилей. Few-shot примеры и
+    категории, изменённые в родителе после старта, попадают в воркеры только
+    через профиль запроса или после restart().
+    """
+
+    def __init__(self, classifier, workers: int = WORKER_POOL_SIZE, threads_per_worker: int = WORKER_THREADS,
+                 max_batch_size: int = WORKER_MAX_BATCH, task_timeout: float = WORKER_TASK_TIMEOUT_S):
+        self.classifier = classifier
+        cpus = os.cpu_count() or 1
+        self.workers = max(1, workers or cpus)
+        self.threads_per_worker = max(1, threads_per_worker or cpus // self.workers)
+        self.max_batch_size = max(1, max_batch_size)
+        self.task_timeout = task_timeout
+
+        self._context = multiprocessing.get_context('fork')
+        self._template = None
+        self._template_conn = None
+        self._store_config = None
+        self._workers = [_Worker(slot) for slot in range(self.workers)]
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._spawn_lock = threading.Lock()
+        self._threads = []
+        self._running = False
+        self._paused = False
+        self._busy = 0
+        self._generation = 0
+
+        # Статистика
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.restarts = 0
+
+    # ---------- жизненный цикл ----------
+    def start(self):
+        """Загрузка модели в родителе и запуск воркеров"""
+        if self._running:
+            return self
+
+        # Прогрев в один поток: пул OpenMP, созданный до fork, в дочернем процессе не работает.
+        # Загрузка применяет профиль инференса узла, поэтому потоки сбрасываются после неё
+        self.classifier._ensure_model()
+        try:
+            import torch
+            if self.classifier.warmup_ms is None:
+                torch.set_num_threads(1)
+        except ImportError:
+            pass
+        self.classifier.warmup()
+        if not self.classifier.model_loaded:
+            logger.warning("⚠️ Модель не загружена - воркеры работают в демо-режиме")
+
+        store = self.classifier.embedding_store
+        self._store_config = (str(store.path), store.dtype) if store is not None else None
+        self._start_template()
+
+        self._running = True
+        for worker in self._workers:
+            self._spawn(worker)
+            thread = threading.Thread(target=self._dispatch, args=(worker,),
+                                      name=f"maillens-worker-dispatch-{worker.slot}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info(
+            f"🚀 Пул воркеров запущен: {self.workers} процессов по {self.threads_per_worker} потоков, "
+            f"бэкенд {self.classifier.backend}"
+        )
+        return self
+
+    def stop(self, timeout: float = 5.0):
+        """Остановка воркеров; запросы из очереди завершаются ошибкой"""
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            pending = list(self._pending)
+            self._pending.clear()
+            self._cond.notify_all()
+
+        for job in pending:
+            job.future.set_exception(RuntimeError("Пул воркеров остановлен"))
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+        for worker in self._workers:
+            self._terminate(worker, timeout)
+        self._stop_template(self._template, self._template_conn, timeout)
+        self._template = self._template_conn = None
+        logger.info("Пул воркеров остановлен")
+
+    def restart(self):
+        """Перезапуск воркеров после изменения банка или категорий в родителе
+
+        Диспетчеры ставятся на паузу и дообрабатывают текущие пакеты, после
+        чего шаблон создаётся заново из текущего состояния родителя. Каждый
+        воркер пересоздаётся своим диспетчером перед следующим пакетом, запросы
+        во время паузы ждут в очереди. Вызывать, когда другие потоки не работают
+        с классификатором напрямую: их блокировки попадут в новый шаблон.
+        """
+        with self._cond:
+            # Ни один диспетчер не держит блокировок пула и не пишет в pipe во время fork
+            self._paused = True
+            while self._busy:
+                self._cond.wait()
+            try:
+                old_template, old_conn = self._template, self._template_conn
+                self._start_template()
+                self._generation += 1
+            finally:
+                self._paused = False
+                self._cond.notify_all()
+        self._stop_template(old_template, old_conn, 5.0)
+
+    def _start_template(self):
+        """Создание процесса-шаблона воркеров из текущего состояния родителя"""
+        # Соединение SQLite нельзя переносить через fork: закрываем на время создания шаблона
+        if self._store_config is not None:
+            self.classifier.embedding_store.close()
+
+        parent_conn, child_conn = self._context.Pipe()
+        inherited = [parent_conn] + [w.conn for w in self._workers if w.conn is not None]
+        process = self._context.Process(
+            target=_template_main,
+            args=(child_conn, inherited, self.classifier, self.threads_per_worker, self._store_config),
+            name="maillens-worker-template",
+            daemon=True
+        )
+        # GC шаблона и воркеров не обходит объекты, созданные до fork, и не пишет
+        # в их заголовки - copy-on-write не копирует эти страницы в каждый воркер.
+        # Родитель сразу размораживает их, иначе они не освободятся после restart()
+        gc.collect()
+        gc.freeze()
+        try:
+            process.start()
+        finally:
+            gc.unfreeze()
+        child_conn.close()
+        self._template = process
+        self._template_conn = parent_conn
+
+        if self._store_config is not None:
+            self.classifier.enable_embedding_store(*self._store_config)
+
+    @staticmethod
+    def _stop_template(process, conn, timeout: float):
+        if conn is not None:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        if process is not None:
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+                process.join(timeout)
+
+    def _spawn(self, worker: _Worker):
+        """Новый воркер от шаблона (вызывается под _spawn_lock или до запуска диспетчеров)"""
+        parent_conn, child_conn = self._context.Pipe()
+        try:
+            self._template_conn.send('spawn')
+            reduction.send_handle(self._template_conn, child_conn.fileno(), self._template.pid)
+            worker.pid = self._template_conn.recv()
+        finally:
+            child_conn.close()
+
+        worker.conn = parent_conn
+        worker.generation = self._generation
+        worker.started_at = time.time()
+
+    def _terminate(self, worker: _Worker, timeout: float, graceful: bool = True):
+        if worker.conn is not None:
+            if graceful:
+                try:
+                    worker.conn.send(None)
+                except OSError:
+                    pass
+            worker.conn.close()
+            worker.conn = None
+        if worker.pid is not None:
+            deadline = time.monotonic() + (timeout if graceful else 0)
+            while _is_alive(worker.pid) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            if _is_alive(worker.pid):
+                os.kill(worker.pid, signal.SIGKILL)
+                deadline = time.monotonic() + timeout
+                while _is_alive(worker.pid) and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            worker.pid = None
+
+    def _respawn(self, worker: _Worker, reason: str):
+        with self._spawn_lock:
+            logger.error(f"💥 Воркер {worker.slot} ({reason}, pid {worker.pid}) - перезапускаю")
+            self._terminate(worker, 1.0, graceful=False)
+            worker.restarts += 1
+            self.restarts += 1
+            metrics.ERRORS.inc('worker')
+            if self._running:
+                try:
+                    self._spawn(worker)
+                except (EOFError, OSError) as e:
+                    logger.error(f"❌ Шаблон воркеров недоступен, воркер {worker.slot} не создан: {e}")
+
+    # ---------- постановка запросов ----------
+    def submit(self, text: str, top_n: int = 5, use_cache: bool = True, classifier=None) -> Future:
+        """Постановка одного письма; результат - Future с dict как у classify()"""
+        future = self._enqueue([text], top_n, use_cache, classifier)
+        result = Future()
+        future.add_done_callback(lambda done: result.set_exception(done.exception()) if done.exception()
+                                 else result.set_result(done.result()[0]))
+        return result
+
+    def classify(self, text: str, top_n: int = 5, use_cache: bool = True,
+                 timeout: Optional[float] = None, classifier=None) -> Dict:
+        return self._enqueue([text], top_n, use_cache, classifier).result(timeout)[0]
+
+    def classify_many(self, texts: List[str], top_n: int = 5, use_cache: bool = True,
+                      timeout: Optional[float] = None, classifier=None) -> List[Dict]:
+        """Список писем делится на пакеты, которые воркеры обрабатывают параллельно"""
+        futures = [self._enqueue(texts[start:start + self.max_batch_size], top_n, use_cache, classifier)
+                   for start in range(0, len(texts), self.max_batch_size)]
+        results = []
+        for future in futures:
+            results.extend(future.result(timeout))
+        return results
+
+    def classify_batch(self, texts: List[str], batch_size: int = 32, top_n: int = 5,
+                       use_cache: bool = True, classifier=None) -> List[Dict]:
+        """Совместимость с ZeroShotMailClassifier.classify_batch (bulk_classify, бенчмарки)"""
+        return self.classify_many(texts, top_n=top_n, use_cache=use_cache, classifier=classifier)
+
+    def _enqueue(self, texts: List[str], top_n: int, use_cache: bool, classifier) -> Future:
+        job = _Job(list(texts), top_n, use_cache, _profile_spec(classifier, self.classifier))
+        if not texts:
+            job.future.set_result([])
+            return job.future
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("Пул воркеров не запущен")
+            self._pending.append(job)
+            self._cond.notify()
+        return job.future
+
+    # ---------- диспетчеризация ----------
+    def _next_batch(self) -> Optional[List[_Job]]:
+        """Подряд идущие задачи с одинаковыми параметрами, до max_batch_size писем"""
+        with self._cond:
+            while self._running and (self._paused or not self._pending):
+                self._cond.wait()
+            if not self._running:
+                return None
+
+            batch = [self._pending.popleft()]
+            size = len(batch[0].texts)
+            while (self._pending and self._pending[0].key == batch[0].key
+                   and size + len(self._pending[0].texts) <= self.max_batch_size):
+                job = self._pending.popleft()
+                batch.append(job)
+                size += len(job.texts)
+            self._busy += 1
+            return batch
+
+    def _requeue(self, jobs: List[_Job], error: Exception):
+        retry = []
+        for job in jobs:
+            job.attempts += 1
+            if job.attempts >= MAX_ATTEMPTS:
+                self.errors += len(job.texts)
+                job.future.set_exception(error)
+            else:
+                retry.append(job)
+        with self._cond:
+            self._pending.extendleft(reversed(retry))
+            self._cond.notify()
+
+    def _dispatch(self, worker: _Worker):
+        while True:
+            jobs = self._next_batch()
+            if jobs is None:
+                break
+            try:
+                self._run_batch(worker, jobs)
+            except Exception as e:
+                # Диспетчер не должен умирать: иначе слот пула молча перестаёт обрабатывать очередь
+                logger.exception(f"Ошибка диспетчера воркера {worker.slot}")
+                for job in jobs:
+                    if not job.future.done():
+                        self.errors += len(job.texts)
+                        job.future.set_exception(e)
+                # Состояние pipe после ошибки неизвестно - воркер пересоздаётся
+                try:
+                    self._respawn(worker, f"{type(e).__name__}: {e}")
+                except Exception:
+                    logger.exception(f"Воркер {worker.slot} не перезапущен")
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._cond.notify_all()
+
+    def _run_batch(self, worker: _Worker, jobs: List[_Job]):
+        first = jobs[0]
+        texts = [text for job in jobs for text in job.texts]
+        try:
+            if worker.generation != self._generation:
+                with self._spawn_lock:
+                    self._terminate(worker, 5.0)
+                    self._spawn(worker)
+            elif not _is_alive(worker.pid):
+                self._respawn(worker, "процесс не отвечает")
+            if worker.conn is None:
+                raise OSError("воркер не запущен")
+            worker.conn.send((texts, first.top_n, first.use_cache, first.profile))
+            if not worker.conn.poll(self.task_timeout):
+                raise TimeoutError(f"пакет дольше {self.task_timeout:.0f} с")
+            status, payload, worker_stats = worker.conn.recv()
+        except (EOFError, OSError, TimeoutError) as e:
+            self._respawn(worker, str(e) or type(e).__name__)
+            self._requeue(jobs, WorkerCrashed(f"Воркер {worker.slot} упал при обработке пакета"))
+            return
+
+        self._merge_stats(worker_stats)
+        worker.tasks += 1
+        worker.texts += len(texts)
+        self.batches += 1
+        self.requests += len(texts)
+
+        if status != 'ok':
+            logger.error(f"Ошибка пакетной классификации в воркере {worker.slot}: {payload}")
+            self.errors += len(texts)
+            metrics.ERRORS.inc('worker', len(texts))
+            for job in jobs:
+                job.future.set_exception(RuntimeError(payload))
+            return
+
+        # Учёт результатов (метод, неопределённые) уже пришёл в метриках воркера
+        offset = 0
+        for job in jobs:
+            job.future.set_result(payload[offset:offset + len(job.texts)])
+            offset += len(job.texts)
+
+    def _merge_stats(self, stats: Dict):
+        metrics.merge(stats['metrics'])
+        self.classifier._hit_latency_ms.extend(stats['hit_latency_ms'])
+        self.classifier._miss_latency_ms.extend(stats['miss_latency_ms'])
+
+    # ---------- состояние ----------
+    @property
+    def alive_workers(self) -> int:
+        return sum(1 for w in self._workers if _is_alive(w.pid))
+
+    def stats(self) -> Dict:
+        return {
+            'running': self._running,
+            'workers': self.workers,
+            'alive': self.alive_workers,
+            'threads_per_worker': self.threads_per_worker,
+            'queue_depth': len(self._pending),
+            'requests': self.requests,
+            'batches': self.batches,
+            'errors': self.errors,
+            'restarts': self.restarts,
+            'avg_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'per_worker': [
+                {
+                    'slot': w.slot,
+                    'pid': w.pid,
+                    'tasks': w.tasks,
+                    'texts': w.texts,
+                    'restarts': w.restarts
+                }
+                for w in self._workers
+            ]
+        }